@@ -1,12 +1,48 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
-from datetime import datetime, timedelta
+from datetime import datetime
 import sys
 import time
-import random
+import mongo_pool
+import metrics
+from db_indexes import ensure_indexes_once
+from sequences import next_id
+from qr_ids import insert_location, is_valid_qr_id, QRIDSpaceExhausted
+from location_trail import record_fix, get_trail, parse_time, trail_enabled, MAX_TRAIL_POINTS
+from live_location import apply_location_batch, MAX_BATCH_SIZE
+from location_buffer import buffer as location_buffer, write_behind_enabled
+from location_dead_band import dead_band, ACCEPT, REFRESH
+from location_codec import is_binary_payload, decode_fixes, issue_token, partner_directory, PayloadError
+from partner_cache import partner_cache
+from live_grid import grid as live_grid, parse_bbox, DEFAULT_QUERY_LIMIT, MAX_QUERY_LIMIT
+from geofence import engine as geofence_engine
+from partner_positions import (
+    record_positions, find_nearby_partners, DEFAULT_RADIUS_METERS, DEFAULT_MAX_AGE_SECONDS, DEFAULT_LIMIT, MAX_RADIUS_METERS,
+    MAX_NEARBY_LIMIT
+)
+from here_client import HereClient, HereUnavailable, shared_key_budget, build_route_cache, parse_point, TRANSPORT_MODES
+from geocode_cache import build_geocode_cache, SEARCH_KINDS, MAX_QUERY_LENGTH, MAX_LIMIT
+from response_cache import (
+    response_cache, json_response, COMPANIES, COMPANIES_FULL, USERS, USERS_FULL, DELIVERY_PARTNERS, company_partners_key
+)
+from change_versions import (
+    bump_versions, bump_qr_versions, current_etag, not_modified, tag_response,
+    qr_scope, company_scope, company_orders_scope, USERS_SCOPE
+)
+from tracking_events import bus as tracking_bus, event_stream, parse_last_event_id, publish_location, publish_delivered
+from change_hub import hub as tracking_hub, subscription_stream
 from email_service import send_qr_email, send_simple_notification
+from metric_rollups import (
+    record_order_created, record_partner_assigned, record_delivery_completed,
+    get_partner_summary, get_company_summary, get_partner_daily, compute_rates
+)
+from shipment_store import (
+    get_qr_collection, get_completion_collection, shipments_enabled,
+    get_company_orders_page, normalize_order_status, is_valid_order_cursor, get_partner_metrics,
+    ORDERS_PAGE_SIZE, MAX_ORDERS_PAGE_SIZE
+)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -35,6 +71,84 @@ def get_here_keys():
     """Get HERE Maps API keys for frontend use"""
     return jsonify({'keys': HERE_API_KEYS})
 
+# HERE calls go through the server so results are cached and key quota is budgeted
+here = HereClient(HERE_API_KEYS, shared_budget=shared_key_budget(mongo_pool.get_database, mongo_pool.is_available))
+route_cache = build_route_cache(here)
+geocode_cache = build_geocode_cache(here)
+
+@app.route('/api/route')
+def get_route():
+    """Road route between two points via the cached HERE routing proxy"""
+    try:
+        origin = parse_point(request.args.get('origin'))
+        destination = parse_point(request.args.get('destination'))
+    except ValueError:
+        return jsonify({'message': 'origin and destination must be given as lat,lng'}), 400
+    
+    transport_mode = request.args.get('transportMode', 'car')
+    if transport_mode not in TRANSPORT_MODES:
+        return jsonify({'message': f'transportMode must be one of {", ".join(TRANSPORT_MODES)}'}), 400
+    
+    try:
+        route, source = route_cache.get_route(origin, destination, transport_mode)
+        response = jsonify(route)
+        response.headers['X-Route-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Route unavailable: {str(e)}")
+        return jsonify({'message': 'Routing temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error calculating route: {str(e)}")
+        return jsonify({'message': 'Failed to calculate route'}), 500
+
+@app.route('/api/geocode')
+def geocode():
+    """Geocode or autosuggest a search query through the shared geocode cache"""
+    query = (request.args.get('q') or '').strip()
+    mode = request.args.get('mode', 'geocode')
+    if not query or len(query) > MAX_QUERY_LENGTH:
+        return jsonify({'message': f'q is required (at most {MAX_QUERY_LENGTH} characters)'}), 400
+    if mode not in SEARCH_KINDS:
+        return jsonify({'message': f'mode must be one of {", ".join(SEARCH_KINDS)}'}), 400
+    
+    try:
+        at = parse_point(request.args['at']) if request.args.get('at') else None
+        limit = min(max(int(request.args.get('limit', 5)), 1), MAX_LIMIT)
+    except ValueError:
+        return jsonify({'message': 'at must be lat,lng and limit a number'}), 400
+    
+    try:
+        result, source = geocode_cache.search(mode, query, at, request.args.get('countryCode'), limit)
+        response = jsonify(result)
+        response.headers['X-Geocode-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Geocoding unavailable: {str(e)}")
+        return jsonify({'message': 'Geocoding temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error geocoding query: {str(e)}")
+        return jsonify({'message': 'Failed to geocode query'}), 500
+
+@app.route('/api/reverse-geocode')
+def reverse_geocode():
+    """Address at a point through the shared geocode cache"""
+    try:
+        lat, lng = parse_point(request.args.get('at'))
+    except ValueError:
+        return jsonify({'message': 'at must be given as lat,lng'}), 400
+    
+    try:
+        result, source = geocode_cache.reverse(lat, lng)
+        response = jsonify(result)
+        response.headers['X-Geocode-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Reverse geocoding unavailable: {str(e)}")
+        return jsonify({'message': 'Reverse geocoding temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error reverse geocoding point: {str(e)}")
+        return jsonify({'message': 'Failed to reverse geocode location'}), 500
+
 # Routes
 @app.route('/')
 def index():
@@ -115,17 +229,8 @@ def company_register():
         if existing_company:
             return jsonify({'message': 'Company with this name or email already exists'}), 400
         
-        # Generate unique company ID starting from 1
-        # Get the highest existing company_id and increment by 1
-        highest_id_company = companies_collection.find_one(
-            {},
-            sort=[('company_id', -1)]
-        )
-        
-        if highest_id_company and 'company_id' in highest_id_company:
-            company_id = highest_id_company['company_id'] + 1
-        else:
-            company_id = 1
+        # Allocate the next company ID atomically from the counters collection
+        company_id = next_id(db, 'company_id')
         
         # Create company document
         company_doc = {
@@ -142,6 +247,7 @@ def company_register():
         
         # Insert into companies collection
         result = companies_collection.insert_one(company_doc)
+        response_cache.invalidate(COMPANIES, COMPANIES_FULL)
         
         app.logger.info(f"Company registered: {data['name']} ({data['email']}) - ID: {company_id}")
         
@@ -225,7 +331,7 @@ def company_login():
 
 @app.route('/store-location', methods=['POST'])
 def store_location():
-    """Store QR location data with unique 4-digit ID - collection created only when downloaded"""
+    """Store QR location data with a unique QR ID - collection created only when downloaded"""
     try:
         data = request.get_json()
         
@@ -236,22 +342,10 @@ def store_location():
         if not mongo_client:
             return jsonify({'message': 'Database connection failed'}), 500
         
-        # Generate unique 4-digit ID
-        import random
-        qr_id = str(random.randint(1000, 9999))
-        
-        # Check if this ID already exists and generate new one if needed
         db = mongo_client.get_database("tracksmart")
-        attempts = 0
-        while attempts < 10:  # Prevent infinite loop
-            if qr_id not in db.list_collection_names():
-                break
-            qr_id = str(random.randint(1000, 9999))
-            attempts += 1
         
         # Store location data in locations collection (temporary storage)
         location_doc = {
-            'qr_id': qr_id,
             'name': data.get('name', ''),
             'address': data.get('address', ''),
             'latitude': data.get('latitude'),
@@ -265,9 +359,12 @@ def store_location():
             'status': 'pending_download'  # Collection will be created when downloaded
         }
         
-        # Insert into locations collection
-        locations_collection = db.get_collection("locations")
-        result = locations_collection.insert_one(location_doc)
+        # Allocate a unique QR ID and insert into locations collection
+        try:
+            qr_id = insert_location(db, location_doc)
+        except QRIDSpaceExhausted as e:
+            app.logger.error(f"QR ID allocation failed: {str(e)}")
+            return jsonify({'message': 'Failed to generate unique QR ID'}), 500
         app.logger.info(f"QR location stored with ID {qr_id}: {data.get('name', 'Unknown')} (pending download)")
         
         # Send email notification to assigned user
@@ -309,7 +406,7 @@ def store_location():
         return jsonify({
             'message': 'Location data stored successfully! User notified via email.',
             'qr_id': qr_id,
-            'location_id': str(result.inserted_id),
+            'location_id': str(location_doc['_id']),
             'status': 'pending_download'
         })
         
@@ -321,7 +418,7 @@ def store_location():
 def activate_qr(qr_id):
     """Activate QR code and create QR-specific collection when downloaded"""
     try:
-        if not qr_id or len(qr_id) != 4 or not qr_id.isdigit():
+        if not is_valid_qr_id(qr_id):
             return jsonify({'message': 'Invalid QR ID format'}), 400
         
         # Try to initialize MongoDB if not connected
@@ -340,7 +437,7 @@ def activate_qr(qr_id):
             return jsonify({'message': 'QR code not found'}), 404
         
         # Create QR-specific collection with destination info (Coordinate A)
-        qr_collection = db.get_collection(qr_id)
+        qr_collection = get_qr_collection(db, qr_id)
         
         qr_info_doc = {
             'type': 'destination_info',  # This is Coordinate A - the destination
@@ -373,6 +470,10 @@ def activate_qr(qr_id):
             {'$set': {'status': 'active', 'activated_at': datetime.utcnow()}}
         )
         
+        # Count the order in the company's daily rollup on first activation only
+        if qr_data.get('status') != 'active':
+            record_order_created(db, qr_data.get('company_id'))
+        
         app.logger.info(f"QR code {qr_id} activated and collection created")
         
         return jsonify({
@@ -418,29 +519,37 @@ def get_companies():
         
         if mongo_client:
             try:
-                # Get all companies from database
+                # Get all companies from database (cached until the next company registration)
                 companies_collection = mongo_client.get_database("tracksmart").get_collection("companies")
-                companies = list(companies_collection.find({}, {
-                    'company_id': 1,
-                    'name': 1,
-                    'email': 1,
-                    'phone': 1,
-                    'address': 1,
-                    'created_at': 1,
-                    'status': 1,
-                    '_id': 0
-                }))
                 
-                # Sort by company_id
-                companies.sort(key=lambda x: x.get('company_id', 0))
+                def load_companies():
+                    companies = list(companies_collection.find({}, {
+                        'company_id': 1,
+                        'name': 1,
+                        'email': 1,
+                        'phone': 1,
+                        'address': 1,
+                        'created_at': 1,
+                        'status': 1,
+                        '_id': 0
+                    }))
+                    
+                    # Sort by company_id
+                    companies.sort(key=lambda x: x.get('company_id', 0))
+                    
+                    app.logger.info(f"Retrieved {len(companies)} companies")
+                    return companies
                 
-                app.logger.info(f"Retrieved {len(companies)} companies")
-                return jsonify(companies)
+                return json_response(response_cache.fetch(COMPANIES, load_companies))
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching companies: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(COMPANIES)
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch companies")
             return jsonify({'message': 'Database connection failed'}), 500
         
@@ -458,27 +567,43 @@ def get_users():
         
         if mongo_client:
             try:
-                # Get all users from database
-                users_collection = mongo_client.get_database("tracksmart").get_collection("users")
-                users = list(users_collection.find({}, {
-                    'user_id': 1,
-                    'name': 1,
-                    'email': 1,
-                    'phone': 1,
-                    'active': 1,
-                    '_id': 0
-                }))
+                db = mongo_client.get_database("tracksmart")
                 
-                # Sort by user_id
-                users.sort(key=lambda x: x.get('user_id', 0))
+                # No registration since the client's copy - skip the scan
+                etag = current_etag(db, USERS_SCOPE)
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
                 
-                app.logger.info(f"Retrieved {len(users)} users")
-                return jsonify(users)
+                # Get all users from database (cached until the next user registration)
+                users_collection = db.get_collection("users")
+                
+                def load_users():
+                    users = list(users_collection.find({}, {
+                        'user_id': 1,
+                        'name': 1,
+                        'email': 1,
+                        'phone': 1,
+                        'active': 1,
+                        '_id': 0
+                    }))
+                    
+                    # Sort by user_id
+                    users.sort(key=lambda x: x.get('user_id', 0))
+                    
+                    app.logger.info(f"Retrieved {len(users)} users")
+                    return users
+                
+                return tag_response(json_response(response_cache.fetch(USERS, load_users, version=etag)), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching users: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(USERS)
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch users")
             return jsonify({'message': 'Database connection failed'}), 500
         
@@ -498,25 +623,33 @@ def get_delivery_partners():
             try:
                 # Get all delivery partners from database
                 partners_collection = mongo_client.get_database("tracksmart").get_collection("delivery_partners")
-                partners = list(partners_collection.find({}, {
-                    'name': 1,
-                    'email': 1,
-                    'phone': 1,
-                    'role': 1,
-                    'vehicle_type': 1,
-                    'companies': 1,  # Include companies field
-                    'active': 1,
-                    'created_at': 1,
-                    '_id': 0
-                }))
                 
-                app.logger.info(f"Retrieved {len(partners)} delivery partners")
-                return jsonify(partners)
+                def load_partners():
+                    partners = list(partners_collection.find({}, {
+                        'name': 1,
+                        'email': 1,
+                        'phone': 1,
+                        'role': 1,
+                        'vehicle_type': 1,
+                        'companies': 1,  # Include companies field
+                        'active': 1,
+                        'created_at': 1,
+                        '_id': 0
+                    }))
+                    
+                    app.logger.info(f"Retrieved {len(partners)} delivery partners")
+                    return partners
+                
+                return json_response(response_cache.fetch(DELIVERY_PARTNERS, load_partners))
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching delivery partners: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(DELIVERY_PARTNERS)
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch delivery partners")
             return jsonify({'message': 'Database connection failed'}), 500
         
@@ -537,31 +670,38 @@ def get_company_delivery_partners(company_id):
                 # Get delivery partners assigned to this company
                 partners_collection = mongo_client.get_database("tracksmart").get_collection("delivery_partners")
                 
-                # Find partners where companies array contains the company_id
-                partners = list(partners_collection.find(
-                    {'active': True, 'companies': company_id}, 
-                    {
-                        'name': 1,
-                        'email': 1,
-                        'phone': 1,
-                        'role': 1,
-                        'vehicle_type': 1,
-                        'companies': 1,
-                        'created_at': 1,
-                        '_id': 0
-                    }
-                ))
-                
-                # Sort by created_at
-                partners.sort(key=lambda x: x.get('created_at', datetime.min))
+                def load_partners():
+                    # Find partners where companies array contains the company_id
+                    partners = list(partners_collection.find(
+                        {'active': True, 'companies': company_id}, 
+                        {
+                            'name': 1,
+                            'email': 1,
+                            'phone': 1,
+                            'role': 1,
+                            'vehicle_type': 1,
+                            'companies': 1,
+                            'created_at': 1,
+                            '_id': 0
+                        }
+                    ))
+                    
+                    # Sort by created_at
+                    partners.sort(key=lambda x: x.get('created_at', datetime.min))
+                    
+                    app.logger.info(f"Retrieved {len(partners)} delivery partners for company {company_id}")
+                    return partners
                 
-                app.logger.info(f"Retrieved {len(partners)} delivery partners for company {company_id}")
-                return jsonify(partners)
+                return json_response(response_cache.fetch(company_partners_key(company_id), load_partners))
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching company delivery partners: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(company_partners_key(company_id))
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch company delivery partners")
             return jsonify({'message': 'Database connection failed'}), 500
         
@@ -597,11 +737,35 @@ def debug_users():
         app.logger.error(f"Error fetching users: {str(e)}")
         return jsonify({'message': 'Failed to fetch users'}), 500
 
+def decode_location_payload():
+    """Fixes from a binary location payload (see location_codec); raises PayloadError"""
+    # Try to initialize MongoDB if not connected
+    if not mongo_connected:
+        initialize_mongodb()
+    
+    if not mongo_client:
+        raise ConnectionError('Database connection failed')
+    
+    return decode_fixes(request.get_data(), partner_directory.resolver(mongo_client.get_database("tracksmart")))
+
 @app.route('/store-live-location', methods=['POST'])
 def store_live_location():
     """Store live location data - special handling for QR tracking"""
     try:
-        data = request.get_json()
+        # Arrival checks for this worker's fixes (GEOFENCE_ENABLED=true)
+        geofence_engine.start()
+        
+        if is_binary_payload(request.content_type):
+            # Compact binary payload carrying exactly one fix
+            try:
+                fixes = decode_location_payload()
+            except PayloadError as e:
+                return jsonify({'message': str(e)}), 400
+            if len(fixes) != 1:
+                return jsonify({'message': 'Send one fix per request or use /store-live-location/batch'}), 400
+            data = fixes[0]
+        else:
+            data = request.get_json()
         
         # Get user email and QR ID from request
         user_email = data.get('user_email') or data.get('email')
@@ -638,16 +802,15 @@ def store_live_location():
             # During QR tracking, ONLY store in QR-specific collection
             # Do NOT store in user's personal collection
             try:
-                qr_collection = db.get_collection(qr_id)
+                qr_collection = get_qr_collection(db, qr_id)
                 
-                # Get delivery partner's info from database
-                partners_collection = db.get_collection("delivery_partners")
-                delivery_partner = partners_collection.find_one({'email': user_email})
+                # Get delivery partner's info (cached per worker, see partner_cache)
+                delivery_partner = partner_cache.get(user_email)
                 
                 # If user_email is 'anonymous', try to find the most recent delivery partner
                 if user_email == 'anonymous' or not delivery_partner:
                     # Find the most recently active delivery partner as a fallback
-                    recent_partner = partners_collection.find_one({}, sort=[('created_at', -1)])
+                    recent_partner = partner_cache.most_recent()
                     if recent_partner:
                         delivery_partner = recent_partner
                         user_email = recent_partner['email']  # Update the user_email for storage
@@ -686,12 +849,58 @@ def store_live_location():
                     }
                     app.logger.info(f"Storing live location data for {partner_role}: {partner_name} ({user_email})")
                 
-                # Store in QR collection (upsert based on user_email to keep only latest location)
-                qr_collection.update_one(
-                    {'type': 'delivery_location', 'user_email': user_email},
-                    {'$set': qr_location_doc},
-                    upsert=True
-                )
+                # Partner standing still - drop the fix or only move the stored timestamp forward
+                decision, refreshed_doc = dead_band.apply(qr_location_doc)
+                if decision != ACCEPT:
+                    if decision == REFRESH:
+                        if write_behind_enabled():
+                            location_buffer.add(refreshed_doc, partner_name)
+                        else:
+                            qr_collection.update_one(
+                                {'type': 'delivery_location', 'user_email': user_email},
+                                {'$max': {'timestamp': refreshed_doc['timestamp']}}
+                            )
+                            bump_qr_versions(db, [qr_id])
+                            record_positions(db, [refreshed_doc])
+                    
+                    return jsonify({
+                        'message': 'QR tracking location unchanged',
+                        'timestamp': datetime.utcnow().isoformat(),
+                        'user_email': user_email,
+                        'delivery_partner_name': partner_name,
+                        'qr_id': qr_id,
+                        'suppressed': decision,
+                        'tracking_mode': 'qr_only'
+                    })
+                
+                if write_behind_enabled():
+                    # Coalesced with the partner's next fixes and written by the background flusher
+                    trail_point = None
+                    if qr_location_doc['location_type'] == 'coordinates':
+                        trail_point = (qr_id, user_email, data['latitude'], data['longitude'], qr_location_doc['timestamp'])
+                    location_buffer.add(qr_location_doc, partner_name, trail_point)
+                else:
+                    # Store in QR collection (upsert based on user_email to keep only latest location)
+                    update_result = qr_collection.update_one(
+                        {'type': 'delivery_location', 'user_email': user_email},
+                        {'$set': qr_location_doc},
+                        upsert=True
+                    )
+                    bump_qr_versions(db, [qr_id])
+                    record_positions(db, [qr_location_doc])
+                    
+                    # First fix from this partner for this QR - count it as one of their orders
+                    if update_result.upserted_id is not None:
+                        qr_location = db.get_collection("locations").find_one({'qr_id': qr_id}, {'company_id': 1})
+                        if qr_location:
+                            record_partner_assigned(db, qr_location.get('company_id'), user_email, partner_name)
+                    
+                    # Append coordinate fixes to the location trail (LOCATION_TRAIL=true)
+                    if qr_location_doc['location_type'] == 'coordinates':
+                        record_fix(db, qr_id, user_email, data['latitude'], data['longitude'])
+                
+                # Push the new position to tracking streams
+                publish_location(qr_location_doc)
                 
                 app.logger.info(f"QR tracking location (Coordinate B) stored in collection {qr_id} for {partner_name} ({user_email})")
                 
@@ -720,6 +929,9 @@ def store_live_location():
                 {'$set': location_doc},
                 upsert=True
             )
+            record_positions(db, [dict(location_doc, location_type='coordinates')])
+            # QR fixes reach the live grid through the tracking bus; normal tracking does not publish
+            live_grid.record(user_email, location_doc['latitude'], location_doc['longitude'], location_doc['timestamp'].isoformat())
             
             app.logger.info(f"Normal location stored for user {user_email}")
             
@@ -734,6 +946,50 @@ def store_live_location():
         app.logger.error(f"Error storing live location: {str(e)}")
         return jsonify({'message': 'Failed to store live location'}), 500
 
+@app.route('/store-live-location/batch', methods=['POST'])
+def store_live_location_batch():
+    """Store many timestamped QR tracking fixes (one or many partners) in one request"""
+    try:
+        # Arrival checks for this worker's fixes (GEOFENCE_ENABLED=true)
+        geofence_engine.start()
+        
+        if is_binary_payload(request.content_type):
+            try:
+                fixes = decode_location_payload()
+            except PayloadError as e:
+                return jsonify({'message': str(e)}), 400
+        else:
+            data = request.get_json(silent=True) or {}
+            fixes = data.get('fixes') if isinstance(data, dict) else None
+        
+        if not isinstance(fixes, list) or not fixes:
+            return jsonify({'message': 'fixes must be a non-empty array'}), 400
+        
+        if len(fixes) > MAX_BATCH_SIZE:
+            return jsonify({'message': f'At most {MAX_BATCH_SIZE} fixes per batch'}), 413
+        
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if not mongo_client:
+            return jsonify({'message': 'Database connection failed'}), 500
+        
+        results, summary = apply_location_batch(mongo_client.get_database("tracksmart"), fixes)
+        
+        app.logger.info(f"Location batch of {len(fixes)} fixes applied: {summary}")
+        
+        return jsonify({
+            'message': 'Location batch processed',
+            'timestamp': datetime.utcnow().isoformat(),
+            'results': results,
+            'summary': summary
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error storing location batch: {str(e)}")
+        return jsonify({'message': 'Failed to store location batch'}), 500
+
 @app.route('/stop-qr-tracking', methods=['POST'])
 def stop_qr_tracking():
     """Stop QR tracking when Done button pressed or someone else scans QR"""
@@ -754,7 +1010,7 @@ def stop_qr_tracking():
             return jsonify({'message': 'Database connection failed'}), 500
         
         db = mongo_client.get_database("tracksmart")
-        qr_collection = db.get_collection(qr_id)
+        qr_collection = get_qr_collection(db, qr_id)
         
         # Update tracking status
         qr_collection.update_one(
@@ -798,22 +1054,47 @@ def list_collections():
         delivery_collections = [name for name in collections if name.startswith('delivery_')]
         other_collections = [name for name in collections if not name.isdigit() and not name.startswith('delivery_')]
         
-        return jsonify({
+        response_data = {
+            'storage_mode': 'shipments' if shipments_enabled() else 'per_qr',
             'qr_collections': qr_collections,
             'delivery_collections': delivery_collections,
             'other_collections': other_collections,
             'total_collections': len(collections)
-        })
+        }
+
+        # In shipments mode QR codes live in one collection - report them by qr_id
+        if shipments_enabled():
+            response_data['shipment_qr_ids'] = db.get_collection("shipments").distinct('qr_id')
+
+        return jsonify(response_data)
         
     except Exception as e:
         return jsonify({'message': f'Error listing collections: {str(e)}'}), 500
 
 @app.route('/live-locations')
+@app.route('/api/live-locations')
 def get_live_locations():
-    """Get live location data"""
+    """Live partner positions inside an optional bbox=south,west,north,east, served from the in-memory grid"""
     try:
-        # Return empty list for now
-        return jsonify([])
+        bbox = parse_bbox(request.args['bbox']) if request.args.get('bbox') else (-90.0, -180.0, 90.0, 180.0)
+        company_id = int(request.args['company_id']) if request.args.get('company_id') else None
+        limit = int(request.args.get('limit', DEFAULT_QUERY_LIMIT))
+    except ValueError:
+        return jsonify({'message': 'bbox must be south,west,north,east; company_id and limit must be numbers'}), 400
+    if not 0 < limit <= MAX_QUERY_LIMIT:
+        return jsonify({'message': f'limit must be between 1 and {MAX_QUERY_LIMIT}'}), 400
+    
+    try:
+        # Change-stream mode feeds every worker's grid from MongoDB
+        tracking_hub.start()
+        
+        # Recent positions from before this worker started
+        if not mongo_connected:
+            initialize_mongodb()
+        if mongo_client:
+            live_grid.ensure_loaded(mongo_client.get_database("tracksmart"))
+        
+        return jsonify(live_grid.query(*bbox, company_id=company_id, limit=limit))
         
     except Exception as e:
         app.logger.error(f"Error fetching live locations: {str(e)}")
@@ -869,6 +1150,9 @@ def delivery_register():
                 
                 # Store in main delivery partners collection
                 result = partners_collection.insert_one(delivery_partner)
+                partner_cache.invalidate(email)  # cached as unknown (and as the newest partner) until now
+                bump_versions(mongo_client.get_database("tracksmart"), [company_scope(company_id) for company_id in delivery_partner['companies']])
+                response_cache.invalidate(DELIVERY_PARTNERS, *[company_partners_key(company_id) for company_id in delivery_partner['companies']])
                 
                 # Create individual collection for this delivery partner (empty collection)
                 collection_name = f"delivery_{email.replace('@', '_').replace('.', '_')}"
@@ -940,7 +1224,8 @@ def delivery_login():
                     'phone': partner['phone'],
                     'vehicle_type': partner['vehicle_type'],
                     'license': partner['license'],
-                    'active': partner['active']
+                    'active': partner['active'],
+                    'uplink_token': issue_token(partner['_id'])  # replaces the email in binary location payloads
                 }
                 
                 collection_name = f"delivery_{email.replace('@', '_').replace('.', '_')}"
@@ -996,17 +1281,8 @@ def user_register():
                 if existing_user:
                     return jsonify({'message': 'Email already registered'}), 400
                 
-                # Generate unique user ID starting from 1000
-                # Get the highest existing user_id and increment by 1
-                highest_id_user = users_collection.find_one(
-                    {},
-                    sort=[('user_id', -1)]
-                )
-                
-                if highest_id_user and 'user_id' in highest_id_user:
-                    user_id = highest_id_user['user_id'] + 1
-                else:
-                    user_id = 1000
+                # Allocate the next user ID atomically from the counters collection
+                user_id = next_id(mongo_client.get_database("tracksmart"), 'user_id')
                 
                 # Create user document
                 user = {
@@ -1023,6 +1299,8 @@ def user_register():
                 
                 # Store in users collection
                 result = users_collection.insert_one(user)
+                bump_versions(mongo_client.get_database("tracksmart"), [USERS_SCOPE])
+                response_cache.invalidate(USERS, USERS_FULL)
                 
                 app.logger.info(f"User registered: {data['name']} ({email})")
                 
@@ -1110,10 +1388,10 @@ def user_login():
 
 @app.route('/api/qr-code/<qr_id>')
 def get_qr_code_data(qr_id):
-    """Get QR code data by 4-digit ID"""
+    """Get QR code data by QR ID"""
     try:
-        if not qr_id or len(qr_id) != 4 or not qr_id.isdigit():
-            return jsonify({'message': 'Invalid QR code format. Must be 4 digits.'}), 400
+        if not is_valid_qr_id(qr_id):
+            return jsonify({'message': 'Invalid QR code format'}), 400
         
         # Try to initialize MongoDB if not connected
         if not mongo_connected:
@@ -1122,7 +1400,7 @@ def get_qr_code_data(qr_id):
         if mongo_client:
             try:
                 # Look for QR code in the specific collection named after the QR ID
-                qr_collection = mongo_client.get_database("tracksmart").get_collection(qr_id)
+                qr_collection = get_qr_collection(mongo_client.get_database("tracksmart"), qr_id)
                 qr_data = qr_collection.find_one({'type': 'qr_info'})
                 
                 if not qr_data:
@@ -1159,7 +1437,7 @@ def get_qr_code_data(qr_id):
 def check_qr_access(qr_id, user_id):
     """Check if a user has access to a specific QR code"""
     try:
-        if not qr_id or len(qr_id) != 4 or not qr_id.isdigit():
+        if not is_valid_qr_id(qr_id):
             return jsonify({'message': 'Invalid QR ID format', 'access': False}), 400
         
         # Try to initialize MongoDB if not connected
@@ -1172,7 +1450,7 @@ def check_qr_access(qr_id, user_id):
         db = mongo_client.get_database("tracksmart")
         
         # Get QR data from QR-specific collection
-        qr_collection = db.get_collection(qr_id)
+        qr_collection = get_qr_collection(db, qr_id)
         qr_data = qr_collection.find_one({'type': 'destination_info'})
         
         if not qr_data:
@@ -1214,6 +1492,22 @@ def check_qr_access(qr_id, user_id):
 def get_company_orders(company_id):
     """Get orders for a specific company - only accessible by company employees"""
     try:
+        # Cursor-based pagination and optional status filter
+        cursor = request.args.get('cursor')
+        status = None
+        if request.args.get('status'):
+            status = normalize_order_status(request.args.get('status'))
+            if not status:
+                return jsonify({'message': f"Invalid status filter: {request.args.get('status')}"}), 400
+        
+        try:
+            limit = min(max(int(request.args.get('limit', ORDERS_PAGE_SIZE)), 1), MAX_ORDERS_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        
+        if cursor and not is_valid_order_cursor(cursor):
+            return jsonify({'message': 'Invalid cursor'}), 400
+        
         # SECURITY: Verify that only company employees can access orders
         # In a real application, you would check authentication tokens
         # For now, we rely on the company_id being passed from authenticated session
@@ -1224,53 +1518,30 @@ def get_company_orders(company_id):
         
         if mongo_client:
             try:
-                # Get all QR codes created by this company
                 db = mongo_client.get_database("tracksmart")
-                locations_collection = db.get_collection("locations")
-                
-                # Find all QR codes for this company
-                company_qrs = locations_collection.find({'company_id': company_id})
                 
-                orders = []
-                for qr_doc in company_qrs:
-                    qr_id = qr_doc.get('qr_id')
-                    if qr_id:
-                        # Get QR-specific collection data
-                        qr_collection = db.get_collection(str(qr_id))
-                        
-                        # Get destination info
-                        destination_info = qr_collection.find_one({'type': 'destination_info'})
-                        if not destination_info:
-                            destination_info = qr_collection.find_one({'type': 'qr_info'})
-                        
-                        # Get latest delivery info
-                        delivery_info = qr_collection.find_one(
-                            {'type': 'delivery_location'}, 
-                            sort=[('timestamp', -1)]
-                        )
-                        
-                        # Determine status
-                        if not delivery_info:
-                            status = 'Pending'
-                        elif delivery_info.get('location_type') == 'role_only':
-                            status = 'Boarded and Arriving'
-                        else:
-                            status = 'In Progress'
-                        
-                        order_data = {
-                            'order_id': f"ORD-{qr_id}",
-                            'qr_id': qr_id,
-                            'destination': destination_info.get('location_name', 'Unknown') if destination_info else 'Unknown',
-                            'delivery_partner': delivery_info.get('delivery_partner_name', 'Not assigned') if delivery_info else 'Not assigned',
-                            'status': status,
-                            'created_at': qr_doc.get('timestamp', qr_doc.get('created_at'))
-                        }
-                        orders.append(order_data)
+                # No order, assignment, fix or delivery since the client's copy - skip the aggregation
+                etag = current_etag(db, company_scope(company_id), company_orders_scope(company_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
+                # Destination, latest delivery location and completion for every
+                # company QR code come back from one aggregation (see shipment_store)
+                orders, next_cursor = get_company_orders_page(
+                    db,
+                    company_id,
+                    status=status,
+                    cursor=cursor,
+                    limit=limit
+                )
                 
-                return jsonify({
+                return tag_response(jsonify({
                     'orders': orders,
-                    'total': len(orders)
-                })
+                    'total': len(orders),
+                    'next_cursor': next_cursor,
+                    'has_more': next_cursor is not None
+                }), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving company orders: {str(db_error)}")
@@ -1282,6 +1553,66 @@ def get_company_orders(company_id):
         app.logger.error(f"Error retrieving company orders: {str(e)}")
         return jsonify({'message': 'Failed to retrieve orders'}), 500
 
+@app.route('/api/company/<int:company_id>/stream')
+def stream_company_orders(company_id):
+    """Push location and delivered events for a company's orders as Server-Sent Events"""
+    subscription = tracking_hub.subscribe(company_id=company_id)
+    return Response(
+        stream_with_context(subscription_stream(subscription)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/company/<int:company_id>/partners/nearby')
+def get_nearby_partners(company_id):
+    """Company's delivery partners with a recent fix within radius meters of a point, nearest first"""
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lng'])
+        radius = float(request.args.get('radius', DEFAULT_RADIUS_METERS))
+        max_age = float(request.args.get('max_age', DEFAULT_MAX_AGE_SECONDS))
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except (KeyError, ValueError):
+        return jsonify({'message': 'lat and lng are required; radius, max_age and limit must be numbers'}), 400
+    
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'message': 'Coordinates out of range'}), 400
+    if not (0 < radius <= MAX_RADIUS_METERS) or max_age <= 0 or not (0 < limit <= MAX_NEARBY_LIMIT):
+        return jsonify({'message': f'radius must be up to {MAX_RADIUS_METERS} m and limit up to {MAX_NEARBY_LIMIT}'}), 400
+    
+    try:
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if mongo_client:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                partners = find_nearby_partners(db, company_id, latitude, longitude, radius, max_age, limit)
+                
+                now = datetime.utcnow()
+                for partner in partners:
+                    partner['age_seconds'] = round((now - partner['timestamp']).total_seconds())
+                    partner['timestamp'] = partner['timestamp'].isoformat()
+                
+                return jsonify({
+                    'company_id': company_id,
+                    'radius': radius,
+                    'max_age': max_age,
+                    'partners': partners
+                })
+                
+            except Exception as db_error:
+                app.logger.error(f"Database error finding nearby partners: {str(db_error)}")
+                return jsonify({'message': 'Database error'}), 500
+        else:
+            app.logger.error("MongoDB not connected - cannot find nearby partners")
+            return jsonify({'message': 'Database connection failed'}), 500
+    
+    except Exception as e:
+        app.logger.error(f"Error finding nearby partners: {str(e)}")
+        return jsonify({'message': 'Failed to find nearby partners'}), 500
+
 @app.route('/api/company/<int:company_id>/employees')
 def get_company_employees(company_id):
     """Get employees and reviews for a specific company"""
@@ -1294,6 +1625,12 @@ def get_company_employees(company_id):
             try:
                 db = mongo_client.get_database("tracksmart")
                 
+                # No registration, assignment or delivery since the client's copy - skip the queries
+                etag = current_etag(db, company_scope(company_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
                 # Get only delivery partners who have selected this company
                 partners_collection = db.get_collection("delivery_partners")
                 partners = list(partners_collection.find({
@@ -1301,35 +1638,16 @@ def get_company_employees(company_id):
                     'companies': company_id  # Filter by company ID in the companies array
                 }))
                 
+                # Active/completed/rating counts for every partner in one grouped query
+                partner_metrics = get_partner_metrics(db, company_id)
+                
                 employees = []
                 for partner in partners:
-                    # Count active orders for this partner
-                    active_orders = 0
-                    completed_orders = 0
-                    total_ratings = 0
-                    rating_count = 0
-                    
-                    locations_collection = db.get_collection("locations")
-                    company_qrs = locations_collection.find({'company_id': company_id})
-                    
-                    for qr_doc in company_qrs:
-                        qr_id = qr_doc.get('qr_id')
-                        if qr_id:
-                            qr_collection = db.get_collection(str(qr_id))
-                            delivery_info = qr_collection.find_one({
-                                'type': 'delivery_location',
-                                'delivery_partner_name': partner['name']
-                            })
-                            if delivery_info:
-                                active_orders += 1
-                                # Simulate completed orders and ratings
-                                if random.randint(1, 100) > 70:  # 30% chance of being completed
-                                    completed_orders += 1
-                                    rating = random.randint(3, 5)  # Random rating 3-5
-                                    total_ratings += rating
-                                    rating_count += 1
-                    
-                    avg_rating = total_ratings / rating_count if rating_count > 0 else 0
+                    partner_row = partner_metrics.get(partner.get('email'), {})
+                    active_orders = partner_row.get('active_orders', 0)
+                    completed_orders = partner_row.get('completed_orders', 0)
+                    rating_count = partner_row.get('rating_count', 0)
+                    avg_rating = partner_row.get('rating_total', 0) / rating_count if rating_count > 0 else 0
                     
                     employee_data = {
                         'name': partner['name'],
@@ -1362,10 +1680,10 @@ def get_company_employees(company_id):
                     }
                 ]
                 
-                return jsonify({
+                return tag_response(jsonify({
                     'employees': employees,
                     'reviews': reviews
-                })
+                }), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving company employees: {str(db_error)}")
@@ -1400,76 +1718,42 @@ def get_employee_analytics(company_id, employee_name):
                 if not employee:
                     return jsonify({'message': 'Employee not found'}), 404
                 
-                # Get all company employees for comparison
-                all_employees = list(partners_collection.find({
-                    'companies': company_id,
-                    'active': True
-                }))
-                
-                # Calculate performance metrics
-                locations_collection = db.get_collection("locations")
-                company_qrs = locations_collection.find({'company_id': company_id})
+                # Precomputed daily rollups - O(days) reads instead of a scan over every company QR
+                employee_email = employee.get('email', '')
+                partner_totals = get_partner_summary(db, company_id, employee_email)
+                employee_rates = compute_rates(partner_totals)
                 
                 # Employee metrics
                 employee_metrics = {
-                    'total_orders': 0,
-                    'completed_orders': 0,
-                    'avg_rating': 0,
-                    'on_time_deliveries': 0,
-                    'performance_score': 0
+                    'total_orders': partner_totals.get('orders', 0),
+                    'completed_orders': partner_totals.get('completions', 0),
+                    'avg_rating': employee_rates['avg_rating'],
+                    'on_time_deliveries': partner_totals.get('on_time', 0),
+                    'avg_delivery_minutes': employee_rates['avg_delivery_minutes'],
+                    'performance_score': employee_rates['performance_score']
                 }
+                completion_rate = employee_rates['completion_rate']
+                on_time_rate = employee_rates['on_time_rate']
                 
-                # Calculate metrics for this employee
-                for qr_doc in company_qrs:
-                    qr_id = qr_doc.get('qr_id')
-                    if qr_id:
-                        qr_collection = db.get_collection(str(qr_id))
-                        delivery_info = qr_collection.find_one({
-                            'type': 'delivery_location',
-                            'delivery_partner_name': employee_name
-                        })
-                        if delivery_info:
-                            employee_metrics['total_orders'] += 1
-                            # Simulate performance data
-                            if random.randint(1, 100) > 25:  # 75% completion rate
-                                employee_metrics['completed_orders'] += 1
-                            if random.randint(1, 100) > 20:  # 80% on-time rate
-                                employee_metrics['on_time_deliveries'] += 1
-                
-                # Calculate average rating
-                employee_metrics['avg_rating'] = round(random.uniform(3.5, 5.0), 1)
-                
-                # Calculate performance score
-                completion_rate = (employee_metrics['completed_orders'] / employee_metrics['total_orders']) * 100 if employee_metrics['total_orders'] > 0 else 0
-                on_time_rate = (employee_metrics['on_time_deliveries'] / employee_metrics['total_orders']) * 100 if employee_metrics['total_orders'] > 0 else 0
-                employee_metrics['performance_score'] = round((completion_rate + on_time_rate + (employee_metrics['avg_rating'] * 20)) / 3, 1)
-                
-                # Calculate company average for comparison
+                # Company average for comparison, from the company-wide rollup
+                company_rates = compute_rates(get_company_summary(db, company_id))
                 company_avg = {
-                    'avg_rating': 4.2,
-                    'completion_rate': 85.0,
-                    'on_time_rate': 78.0,
-                    'performance_score': 82.5
+                    'avg_rating': company_rates['avg_rating'],
+                    'completion_rate': company_rates['completion_rate'],
+                    'on_time_rate': company_rates['on_time_rate'],
+                    'performance_score': company_rates['performance_score']
                 }
                 
                 # Performance comparison
                 comparison = {
-                    'rating_vs_avg': employee_metrics['avg_rating'] - company_avg['avg_rating'],
-                    'completion_vs_avg': completion_rate - company_avg['completion_rate'],
-                    'on_time_vs_avg': on_time_rate - company_avg['on_time_rate'],
-                    'performance_vs_avg': employee_metrics['performance_score'] - company_avg['performance_score']
+                    'rating_vs_avg': round(employee_metrics['avg_rating'] - company_avg['avg_rating'], 1),
+                    'completion_vs_avg': round(completion_rate - company_avg['completion_rate'], 1),
+                    'on_time_vs_avg': round(on_time_rate - company_avg['on_time_rate'], 1),
+                    'performance_vs_avg': round(employee_metrics['performance_score'] - company_avg['performance_score'], 1)
                 }
                 
-                # Recent performance data for charts
-                recent_performance = []
-                for i in range(7):  # Last 7 days
-                    date = datetime.utcnow() - timedelta(days=i)
-                    recent_performance.append({
-                        'date': date.strftime('%Y-%m-%d'),
-                        'orders': random.randint(2, 8),
-                        'rating': round(random.uniform(3.0, 5.0), 1),
-                        'on_time': random.randint(1, 8)
-                    })
+                # Recent performance data for charts (last 7 days)
+                recent_performance = get_partner_daily(db, company_id, employee_email, days=7)
                 
                 return jsonify({
                     'employee': {
@@ -1499,8 +1783,8 @@ def get_employee_analytics(company_id, employee_name):
 def get_qr_tracking_data(qr_id):
     """Get QR tracking data including delivery location if assigned"""
     try:
-        if not qr_id or len(qr_id) != 4 or not qr_id.isdigit():
-            return jsonify({'message': 'Invalid QR ID format. Must be 4 digits.'}), 400
+        if not is_valid_qr_id(qr_id):
+            return jsonify({'message': 'Invalid QR ID format'}), 400
         
         # Try to initialize MongoDB if not connected
         if not mongo_connected:
@@ -1508,8 +1792,16 @@ def get_qr_tracking_data(qr_id):
         
         if mongo_client:
             try:
+                db = mongo_client.get_database("tracksmart")
+                
+                # Nothing written for this QR since the client's copy - skip the queries
+                etag = current_etag(db, qr_scope(qr_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
                 # Get QR-specific collection data
-                qr_collection = mongo_client.get_database("tracksmart").get_collection(qr_id)
+                qr_collection = get_qr_collection(db, qr_id)
                 
                 # Get destination data (coordinate A) - check both possible types
                 destination_data = qr_collection.find_one({'type': 'destination_info'})
@@ -1525,7 +1817,7 @@ def get_qr_tracking_data(qr_id):
                 
                 if delivery_completion:
                     # Order is delivered - return completion data
-                    return jsonify({
+                    return tag_response(jsonify({
                         'qr_id': qr_id,
                         'status': 'delivered',
                         'delivery_status': 'delivered',
@@ -1541,7 +1833,7 @@ def get_qr_tracking_data(qr_id):
                         'delivered_at': delivery_completion.get('delivered_at', '').isoformat() if delivery_completion.get('delivered_at') else None,
                         'delivery_partner_name': delivery_completion.get('delivery_partner_name', 'Unknown'),
                         'last_updated': delivery_completion.get('timestamp', '').isoformat() if delivery_completion.get('timestamp') else None
-                    })
+                    }), etag)
                 
                 # Get latest delivery location if exists (coordinate B)
                 delivery_location = qr_collection.find_one(
@@ -1551,7 +1843,7 @@ def get_qr_tracking_data(qr_id):
                 
                 # Case 1: Only destination exists (no delivery partner)
                 if not delivery_location:
-                    return jsonify({'message': 'No delivery boy assigned'}), 200
+                    return tag_response(jsonify({'message': 'No delivery boy assigned'}), etag), 200
                 
                 # Check if this is a role-only entry (Captain, Pilot, TC)
                 location_type = delivery_location.get('location_type', 'coordinates')
@@ -1559,13 +1851,13 @@ def get_qr_tracking_data(qr_id):
                 
                 if location_type == 'role_only' or partner_role in ['captain', 'pilot', 'tc']:
                     # Return special "boarded and arriving" message for aviation roles
-                    return jsonify({
+                    return tag_response(jsonify({
                         'message': 'boarded_and_arriving',
                         'qr_id': qr_id,
                         'delivery_partner_name': delivery_location.get('delivery_partner_name', 'Unknown'),
                         'role': partner_role,
                         'status': 'boarded_and_arriving'
-                    }), 200
+                    }), etag), 200
                 
                 # Case 2: Both coordinates exist - return map data
                 response_data = {
@@ -1594,7 +1886,7 @@ def get_qr_tracking_data(qr_id):
                 
                 app.logger.info(f"QR tracking data retrieved for ID: {qr_id}")
                 
-                return jsonify(response_data)
+                return tag_response(jsonify(response_data), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving QR tracking {qr_id}: {str(db_error)}")
@@ -1607,6 +1899,79 @@ def get_qr_tracking_data(qr_id):
         app.logger.error(f"Error retrieving QR tracking data: {str(e)}")
         return jsonify({'message': 'Failed to retrieve QR tracking data'}), 500
 
+@app.route('/api/qr-tracking/<qr_id>/stream')
+def stream_qr_tracking(qr_id):
+    """Push coordinate B updates and the delivered transition as Server-Sent Events"""
+    if not is_valid_qr_id(qr_id):
+        return jsonify({'message': 'Invalid QR ID format'}), 400
+    
+    # Feed the event bus from the change stream (TRACKING_EVENT_SOURCE=change_stream)
+    tracking_hub.start()
+    
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    
+    if last_event_id is not None and tracking_bus.can_resume(qr_id, last_event_id):
+        # Resume: replay only the events the client missed
+        cursor = last_event_id
+        snapshot = None
+    else:
+        # New connection (or the gap is no longer in memory) - start from the current state
+        cursor = tracking_bus.latest_id(qr_id)
+        result = get_qr_tracking_data(qr_id)
+        response, status = result if isinstance(result, tuple) else (result, 200)
+        if status >= 400:
+            return result
+        snapshot = response.get_json()
+    
+    return Response(
+        stream_with_context(event_stream(qr_id, cursor, snapshot)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/qr-tracking/<qr_id>/trail')
+def get_qr_trail(qr_id):
+    """Get the recorded path of a QR delivery (?start=&end= ISO 8601, ?interval= seconds to downsample)"""
+    try:
+        if not is_valid_qr_id(qr_id):
+            return jsonify({'message': 'Invalid QR ID format'}), 400
+        
+        try:
+            start = parse_time(request.args.get('start'))
+            end = parse_time(request.args.get('end'))
+            interval = request.args.get('interval', type=int)
+            limit = request.args.get('limit', MAX_TRAIL_POINTS, type=int)
+        except ValueError:
+            return jsonify({'message': 'Invalid start or end time'}), 400
+        
+        if interval is not None and interval < 1:
+            return jsonify({'message': 'interval must be a positive number of seconds'}), 400
+        
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if not mongo_client:
+            return jsonify({'message': 'Database connection failed'}), 500
+        
+        points = get_trail(
+            mongo_client.get_database("tracksmart"), qr_id,
+            start=start, end=end, interval_seconds=interval,
+            user_email=request.args.get('user_email'), limit=max(limit, 1)
+        )
+        
+        return jsonify({
+            'qr_id': qr_id,
+            'points': points,
+            'count': len(points),
+            'interval': interval,
+            'trail_enabled': trail_enabled()
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error retrieving trail for QR {qr_id}: {str(e)}")
+        return jsonify({'message': 'Failed to retrieve location trail'}), 500
+
 @app.route('/api/mark-delivered', methods=['POST'])
 def mark_delivered():
     """Mark an order as delivered"""
@@ -1626,7 +1991,7 @@ def mark_delivered():
             db = mongo_client['tracksmart']
             
             # Check if delivery is already marked as complete
-            qr_collection = db[qr_id]
+            qr_collection = get_completion_collection(db, qr_id)
             existing_completion = qr_collection.find_one({'type': 'delivery_complete'})
             
             if existing_completion:
@@ -1637,16 +2002,23 @@ def mark_delivered():
                 'type': 'delivery_complete',
                 'status': 'delivered',
                 'delivery_partner_name': delivery_partner_name,
+                'user_email': data.get('user_email'),  # Partner email keys the employee metrics
                 'delivered_at': datetime.now(),
                 'timestamp': datetime.now()
             }
             
-            # Insert delivery completion record
-            qr_collection.insert_one(delivery_completion_data)
+            # Insert delivery completion record (unique per QR - a concurrent completion may have won)
+            from pymongo.errors import DuplicateKeyError
+            try:
+                qr_collection.insert_one(delivery_completion_data)
+            except DuplicateKeyError:
+                return jsonify({'message': 'Order already marked as delivered'}), 400
+            bump_qr_versions(db, [qr_id])
+            publish_delivered(qr_id, delivery_partner_name, delivery_completion_data['delivered_at'])
             
             # Update locations collection with delivery status
             locations_collection = db['locations']
-            locations_collection.update_one(
+            qr_location = locations_collection.find_one_and_update(
                 {'qr_id': qr_id},
                 {'$set': {
                     'delivery_status': 'delivered',
@@ -1655,6 +2027,18 @@ def mark_delivered():
                 }}
             )
             
+            # Update daily completion / time-to-deliver rollups
+            if qr_location:
+                record_delivery_completed(
+                    db,
+                    qr_location.get('company_id'),
+                    data.get('user_email'),
+                    delivery_partner_name,
+                    started_at=qr_location.get('activated_at') or qr_location.get('timestamp'),
+                    delivered_at=datetime.utcnow(),
+                    rating=data.get('rating')
+                )
+            
             app.logger.info(f"Order {qr_id} marked as delivered by {delivery_partner_name}")
             
             return jsonify({
@@ -1672,50 +2056,31 @@ def mark_delivered():
 
 # Initialize MongoDB connection after app is created
 def initialize_mongodb():
-    """Initialize MongoDB connection"""
+    """Attach to the process-wide pooled MongoDB client (see mongo_pool)"""
     global mongo_client, mongo_connected
     
     try:
-        # Import pymongo using a clean environment to avoid conflicts
-        import sys
-        import importlib
-        
-        # Remove any existing bson modules that cause conflicts
-        modules_to_remove = []
-        for module_name in list(sys.modules.keys()):
-            if module_name == 'bson' or module_name.startswith('bson.'):
-                if 'pymongo' not in module_name:
-                    modules_to_remove.append(module_name)
-        
-        for module_name in modules_to_remove:
-            del sys.modules[module_name]
+        # Fail fast (no server selection wait) while the circuit breaker is open
+        if not mongo_pool.allow_request():
+            mongo_client = None
+            mongo_connected = False
+            return False
         
-        # Force reimport of pymongo
-        if 'pymongo' in sys.modules:
-            del sys.modules['pymongo']
+        # One client per worker process - no reconnect or ping on the request path
+        mongo_client = mongo_pool.get_client()
+        mongo_connected = mongo_pool.is_available()
         
-        # Import pymongo fresh
-        import pymongo
-        MongoClient = pymongo.MongoClient
-        
-        # Get MongoDB URI from environment variable with fallback to known working URI
-        mongodb_uri = os.environ.get('MONGODB_URI', 'mongodb+srv://in:in@in.hfxejxb.mongodb.net/?retryWrites=true&w=majority&appName=in')
-        
-        # Create connection
-        mongo_client = MongoClient(mongodb_uri)
+        if mongo_connected:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                ensure_indexes_once(db)
+            except Exception as index_error:
+                app.logger.error(f"Failed to ensure indexes: {index_error}")
         
-        # Test connection
-        mongo_client.admin.command('ping')
-        app.logger.info("MongoDB connected successfully - package conflicts resolved")
-        mongo_connected = True
-        return True
+        return mongo_connected
         
     except ImportError as import_error:
         app.logger.error(f"MongoDB import failed: {import_error}")
-        # Log more details about the import issue
-        import sys
-        app.logger.error(f"Python path: {sys.path}")
-        app.logger.error(f"Available modules starting with 'bson': {[m for m in sys.modules.keys() if m.startswith('bson')]}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
         mongo_client = None
@@ -1727,5 +2092,37 @@ def initialize_mongodb():
         mongo_client = None
         return False
 
-# Initialize MongoDB on startup
-initialize_mongodb()
\ No newline at end of file
+def reset_mongodb_after_fork():
+    """Forget the parent process's client after a fork (e.g. gunicorn --preload)"""
+    global mongo_client, mongo_connected
+    mongo_client = None
+    mongo_connected = False
+
+mongo_pool.register_fork_callback(reset_mongodb_after_fork)
+
+def on_breaker_state_change(old_state, new_state):
+    """Make the next request re-check the breaker instead of using the cached client"""
+    global mongo_client, mongo_connected
+    if new_state != 'closed':
+        mongo_client = None
+        mongo_connected = False
+
+mongo_pool.breaker.add_listener(on_breaker_state_change)
+
+@app.route('/api/health')
+def health_check():
+    """Report MongoDB connection health from driver heartbeats (no ping per request)"""
+    health = mongo_pool.health_state()
+    status_code = 200 if health['state'] != 'down' else 503
+    return jsonify({'status': 'ok' if status_code == 200 else 'degraded', 'mongodb': health}), status_code
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Expose in-process metrics (JSON, or Prometheus text with ?format=prometheus)"""
+    if request.args.get('format') == 'prometheus':
+        return metrics.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    return jsonify(metrics.snapshot())
+
+# Initialize MongoDB on startup - one ping, then driver heartbeats track health
+mongo_pool.connect()
+initialize_mongodb()
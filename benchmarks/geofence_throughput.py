@@ -0,0 +1,110 @@
+"""
+Geofence evaluation throughput at 100k active shipments.
+
+Fills a GeofenceEngine (no MongoDB) with shipments whose destinations are
+spread over ~20 km of Bengaluru and whose partners start 0-3 km away. Each
+tick moves a share of the partners towards their destination, then times:
+
+- loop: what checking every shipment per tick takes in plain Python - one
+  math.haversine per row
+- numpy: GeofenceEngine.evaluate over the whole array
+
+Reports shipments evaluated per second and checks that both agree on which
+partners are inside the arriving radius. Needs numpy.
+
+    python benchmarks/geofence_throughput.py [--shipments 100000] [--ticks 20] [--moving 0.2]
+"""
+import os
+import sys
+import math
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geofence import GeofenceEngine, EARTH_RADIUS_METERS
+
+CENTER = (12.9716, 77.5946)
+SPREAD_DEGREES = 0.09  # ~10 km each way
+START_DEGREES = 0.027  # partners start up to ~3 km from their destination
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(h))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(label, shipments, timings):
+    p50 = percentile(timings, 0.5)
+    print(f"{label:<6} p50 {p50 * 1000:8.2f} ms  p95 {percentile(timings, 0.95) * 1000:8.2f} ms  "
+          f"{shipments / p50:14,.0f} shipments/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geofence evaluation throughput benchmark')
+    parser.add_argument('--shipments', type=int, default=100000)
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--moving', type=float, default=0.2, help='share of partners with a new fix per tick')
+    args = parser.parse_args()
+
+    now = [time.time()]
+    engine = GeofenceEngine(get_database=None, dwell=0, max_age=10 ** 9, clock=lambda: now[0])
+
+    print(f"Filling {args.shipments} shipments...")
+    rows = []
+    for index in range(args.shipments):
+        qr_id = str(100000 + index)
+        destination = (CENTER[0] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+                       CENTER[1] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+        position = [destination[0] + random.uniform(-START_DEGREES, START_DEGREES),
+                    destination[1] + random.uniform(-START_DEGREES, START_DEGREES)]
+        engine.set_destination(qr_id, *destination)
+        engine.update(qr_id, f"partner{index}@example.com", *position)
+        rows.append((qr_id, f"partner{index}@example.com", destination, position))
+    engine._unresolved.clear()  # destinations are already set
+
+    print(f"{args.ticks} ticks, {args.moving:.0%} of partners moving per tick\n")
+    loop_timings, numpy_timings, update_timings = [], [], []
+    mismatches = events = 0
+    for _ in range(args.ticks):
+        moving = random.sample(rows, int(len(rows) * args.moving))
+        started = time.perf_counter()
+        for qr_id, email, destination, position in moving:
+            # Close a tenth of the remaining distance
+            position[0] += (destination[0] - position[0]) * 0.1
+            position[1] += (destination[1] - position[1]) * 0.1
+            engine.update(qr_id, email, *position)
+        update_timings.append(time.perf_counter() - started)
+        now[0] += 2
+
+        started = time.perf_counter()
+        near = {
+            qr_id for qr_id, _, destination, position in rows
+            if haversine_meters(position[0], position[1], destination[0], destination[1]) <= engine.arriving
+        }
+        loop_timings.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        transitions = engine.evaluate()
+        numpy_timings.append(time.perf_counter() - started)
+        events += len(transitions)
+
+        # Every partner inside the arriving radius is in the arriving (or arrived) state
+        inside = {engine._keys[row][0] for row in range(engine._high) if engine._state[row] != 0}
+        mismatches += len(near ^ inside)
+
+    report('loop', args.shipments, loop_timings)
+    report('numpy', args.shipments, numpy_timings)
+    print(f"\nfix updates {sum(update_timings) / sum(len(rows) * args.moving for _ in update_timings) * 1e6:.2f} us each, "
+          f"{events} transitions, state mismatches {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Location payload benchmark: JSON vs the binary format in location_codec.
+
+Builds a realistic track (one fix every 3 seconds, a few meters apart) and
+reports bytes on the wire and server-side parse CPU - decoding plus
+live_location.validate_fix, which every fix goes through either way - for
+one fix per request and for batches.
+
+    python benchmarks/location_payload_format.py [--fixes 20000] [--batch 50]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from location_codec import encode_fixes, decode_fixes, issue_token
+from live_location import validate_fix
+
+PARTNER_ID = '65a1b2c3d4e5f60718293a4b'
+PARTNER = {'email': 'partner.name@example.com', 'name': 'Partner Name', 'role': 'Boy'}
+
+
+def make_track(count):
+    latitude, longitude = 12.971599, 77.594566
+    started = int(time.time() * 1000)
+    fixes = []
+    for index in range(count):
+        latitude += random.uniform(-0.00005, 0.00005)
+        longitude += random.uniform(-0.00005, 0.00005)
+        fixes.append({
+            'qr_id': '4821',
+            'latitude': round(latitude, 6),
+            'longitude': round(longitude, 6),
+            'timestamp': started + index * 3000,
+            'role_only': False
+        })
+    return fixes
+
+
+def json_body(fix):
+    """The body the scanner posts today"""
+    return json.dumps(dict(fix, user_email=PARTNER['email'], is_qr_tracking=True)).encode()
+
+
+def parse_json(body):
+    data = json.loads(body)
+    fixes = data['fixes'] if isinstance(data, dict) and 'fixes' in data else [data]
+    return [validate_fix(fix) for fix in fixes]
+
+
+def parse_binary(body):
+    return [validate_fix(fix) for fix in decode_fixes(body, lambda partner_id: PARTNER)]
+
+
+def measure(label, bodies, parse, fix_count):
+    started = time.perf_counter()
+    for body in bodies:
+        parse(body)
+    elapsed = time.perf_counter() - started
+    total = sum(len(body) for body in bodies)
+    print(f"{label:<22} {total / fix_count:7.1f} bytes/fix {elapsed * 1e6 / fix_count:8.2f} us/fix")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Location payload format benchmark')
+    parser.add_argument('--fixes', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    token = issue_token(PARTNER_ID)
+    fixes = make_track(args.fixes)
+    batches = [fixes[start:start + args.batch] for start in range(0, len(fixes), args.batch)]
+
+    # Round trip check: the binary path must yield the same validated fixes as JSON
+    decoded = parse_binary(encode_fixes(token, batches[0]))
+    expected = parse_json(json.dumps({'fixes': [dict(fix, user_email=PARTNER['email']) for fix in batches[0]]}))
+    assert [fix for fix, _ in decoded] == [dict(fix, delivery_partner_name=PARTNER['name'], role=PARTNER['role'])
+                                          for fix, _ in expected]
+
+    print(f"{args.fixes} fixes, batches of {args.batch}\n")
+    json_single = measure('JSON, 1 per request', [json_body(fix) for fix in fixes], parse_json, args.fixes)
+    binary_single = measure('binary, 1 per request', [encode_fixes(token, [fix]) for fix in fixes], parse_binary, args.fixes)
+    json_batch = measure('JSON batch', [
+        json.dumps({'fixes': [dict(fix, user_email=PARTNER['email']) for fix in batch]}).encode() for batch in batches
+    ], parse_json, args.fixes)
+    binary_batch = measure('binary batch', [encode_fixes(token, batch) for batch in batches], parse_binary, args.fixes)
+
+    print(f"\nbinary/JSON bytes: single {binary_single / json_single:.0%}, batch {binary_batch / json_batch:.0%}")
+
+
+if __name__ == '__main__':
+    main()
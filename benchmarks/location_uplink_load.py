@@ -0,0 +1,121 @@
+"""
+Location uplink load test: per-fix POST vs the /ws/location WebSocket.
+
+Opens --connections simulated delivery partners against a running
+delivery_app and sends fixes as fast as each connection allows for
+--duration seconds. POST mode reuses one keep-alive HTTP connection per
+partner; WebSocket mode sends a hello frame and then location frames, and
+counts fixes as done when their batched ack arrives. Pass --workers (the
+gunicorn worker count of the target) to get fixes/sec per worker.
+
+    python benchmarks/location_uplink_load.py --url http://localhost:5000 --mode ws --connections 200 --workers 2
+
+WebSocket mode needs simple-websocket (installed with flask-sock).
+"""
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlparse
+
+
+def _fix(partner, seq):
+    return {
+        'seq': seq,
+        'qr_id': str(1000 + partner % 9000),
+        'latitude': 12.9 + random.random() / 10,
+        'longitude': 77.5 + random.random() / 10,
+        'timestamp': int(time.time() * 1000)
+    }
+
+
+def _email(partner):
+    return f"load-{partner}@example.com"
+
+
+def run_post(url, partner, deadline, counts):
+    """One partner posting to /api/store-live-location over a keep-alive connection"""
+    target = urlparse(url)
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(target.netloc, timeout=30)
+    seq = 0
+    try:
+        while time.monotonic() < deadline:
+            seq += 1
+            body = dict(_fix(partner, seq), user_email=_email(partner), is_qr_tracking=True)
+            connection.request('POST', '/api/store-live-location', json.dumps(body), {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            counts['ok' if response.status == 200 else 'errors'] += 1
+    except Exception:
+        counts['errors'] += 1
+    finally:
+        connection.close()
+
+
+def run_ws(url, partner, deadline, counts):
+    """One partner streaming frames to /ws/location"""
+    from simple_websocket import Client
+
+    ws = Client(url.replace('http', 'ws', 1).rstrip('/') + '/ws/location')
+    seq = 0
+    try:
+        ws.send(json.dumps({'type': 'hello', 'user_email': _email(partner), 'delivery_partner_name': f"Load {partner}"}))
+        ws.receive()  # welcome
+        while time.monotonic() < deadline:
+            seq += 1
+            ws.send(json.dumps(_fix(partner, seq)))
+            reply = ws.receive(timeout=0)
+            while reply:
+                ack = json.loads(reply)
+                if ack.get('type') == 'ack':
+                    counts['ok'] += ack['count']
+                    counts['errors'] += len(ack['rejected']) + len(ack['failed'])
+                reply = ws.receive(timeout=0)
+        # Collect the ack for the last partial batch
+        reply = ws.receive(timeout=5)
+        if reply:
+            ack = json.loads(reply)
+            counts['ok'] += ack.get('count', 0)
+    except Exception:
+        counts['errors'] += 1
+    finally:
+        ws.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Location uplink load test')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--mode', choices=['post', 'ws'], default='post')
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers serving the target')
+    args = parser.parse_args()
+
+    run = run_ws if args.mode == 'ws' else run_post
+    deadline = time.monotonic() + args.duration
+    results = [{'ok': 0, 'errors': 0} for _ in range(args.connections)]
+    threads = [
+        threading.Thread(target=run, args=(args.url, partner, deadline, results[partner]), daemon=True)
+        for partner in range(args.connections)
+    ]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ok = sum(result['ok'] for result in results)
+    errors = sum(result['errors'] for result in results)
+    print(f"{args.mode}: {args.connections} connections, {elapsed:.1f}s")
+    print(f"fixes stored {ok}, errors {errors}")
+    print(f"{ok / elapsed:.0f} fixes/sec, {ok / elapsed / args.workers:.0f} fixes/sec per worker, "
+          f"{args.connections / args.workers:.0f} connections per worker")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Nearby partner query benchmark at 10k active partners.
+
+Seeds a scratch partner_positions collection (default database
+tracksmart_bench, dropped afterwards) with partners spread over ~20 km of
+Bengaluru, split across companies, some with stale fixes. Then compares:
+
+- scan: what answering "partners within R of this point" took before -
+  read every partner's latest latitude/longitude and filter by company,
+  age and haversine distance in Python
+- $geoNear: partner_positions.find_nearby_partners on the 2dsphere index
+
+Both must return the same partners. Needs a reachable MongoDB (MONGODB_URI).
+
+    python benchmarks/nearby_partners.py [--partners 10000] [--companies 20] [--queries 200] [--radius 3000]
+"""
+import os
+import sys
+import math
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pymongo import MongoClient, InsertOne
+
+from partner_positions import POSITIONS_COLLECTION, POSITION_INDEXES, find_nearby_partners
+
+CENTER = (12.9716, 77.5946)
+SPREAD_DEGREES = 0.09  # ~10 km each way
+MAX_AGE_SECONDS = 300
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6378100 * math.asin(math.sqrt(h))  # MongoDB's spherical earth radius, so edges agree
+
+
+def seed(collection, partners, companies):
+    now = datetime.utcnow()
+    collection.drop()
+    for keys, options in POSITION_INDEXES:
+        collection.create_index(keys, **options)
+
+    operations = []
+    for index in range(partners):
+        latitude = CENTER[0] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES)
+        longitude = CENTER[1] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES)
+        # One in five partners last reported 10-60 minutes ago
+        age = random.uniform(600, 3600) if random.random() < 0.2 else random.uniform(0, 240)
+        operations.append(InsertOne({
+            '_id': f"partner{index}@example.com",
+            'location': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'companies': random.sample(range(1, companies + 1), random.choice((1, 1, 2))),
+            'name': f"Partner {index}",
+            'role': 'boy',
+            'qr_id': str(1000 + index % 9000),
+            'timestamp': now - timedelta(seconds=age),
+            'updated_at': now
+        }))
+    collection.bulk_write(operations, ordered=False)
+
+
+def scan_nearby(collection, company_id, latitude, longitude, radius):
+    """Old approach: fetch every latest position, filter in Python"""
+    cutoff = datetime.utcnow() - timedelta(seconds=MAX_AGE_SECONDS)
+    found = []
+    for doc in collection.find({}, {'location': 1, 'companies': 1, 'timestamp': 1}):
+        if company_id not in doc['companies'] or doc['timestamp'] < cutoff:
+            continue
+        lng, lat = doc['location']['coordinates']
+        distance = haversine_meters(latitude, longitude, lat, lng)
+        if distance <= radius:
+            found.append((distance, doc['_id']))
+    return [email for _, email in sorted(found)]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(label, queries, run):
+    timings = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(run(*query))
+        timings.append(time.perf_counter() - started)
+    print(f"{label:<9} p50 {percentile(timings, 0.5) * 1000:7.2f} ms  p95 {percentile(timings, 0.95) * 1000:7.2f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nearby partner query benchmark')
+    parser.add_argument('--partners', type=int, default=10000)
+    parser.add_argument('--companies', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--radius', type=float, default=3000)
+    parser.add_argument('--database', default='tracksmart_bench')
+    args = parser.parse_args()
+
+    client = MongoClient(os.environ.get('MONGODB_URI', 'mongodb://localhost:27017'))
+    db = client.get_database(args.database)
+    collection = db.get_collection(POSITIONS_COLLECTION)
+
+    print(f"Seeding {args.partners} partners across {args.companies} companies...")
+    seed(collection, args.partners, args.companies)
+
+    queries = [
+        (random.randint(1, args.companies),
+         CENTER[0] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+         CENTER[1] + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+        for _ in range(args.queries)
+    ]
+    print(f"{args.queries} queries, radius {args.radius:.0f} m, fixes newer than {MAX_AGE_SECONDS} s\n")
+
+    try:
+        scanned = measure('scan', queries, lambda company_id, lat, lng: scan_nearby(collection, company_id, lat, lng, args.radius))
+        indexed = measure('$geoNear', queries, lambda company_id, lat, lng: [
+            partner['email'] for partner in find_nearby_partners(db, company_id, lat, lng, args.radius, MAX_AGE_SECONDS, args.partners)
+        ])
+
+        mismatches = sum(set(a) != set(b) for a, b in zip(scanned, indexed))
+        average = sum(len(result) for result in indexed) / len(indexed)
+        print(f"\naverage matches {average:.1f}, result mismatches {mismatches}")
+
+        # How much of the collection one $geoNear touches
+        company_id, lat, lng = queries[0]
+        pipeline = [{'$geoNear': {
+            'near': {'type': 'Point', 'coordinates': [lng, lat]}, 'key': 'location', 'distanceField': 'distance_m',
+            'maxDistance': args.radius, 'spherical': True, 'query': {'companies': company_id}
+        }}]
+        stats = db.command('explain', {'aggregate': POSITIONS_COLLECTION, 'pipeline': pipeline, 'cursor': {}},
+                           verbosity='executionStats')
+        execution = stats.get('executionStats') or stats.get('stages', [{}])[0].get('$cursor', {}).get('executionStats', {})
+        print(f"$geoNear documents examined: {execution.get('totalDocsExamined', 'n/a')} of {args.partners}")
+    finally:
+        collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+QR ID allocation benchmark at high space occupancy.
+
+Compares the old approach (random 4-digit candidate + existence check, up
+to 10 attempts) with the permutation allocator in qr_ids, with 90% of the
+legacy space already in use. Existence checks are simulated with a Python
+set, so the "lookups" column is the number of database round trips the old
+approach would have made.
+
+    python benchmarks/qr_id_allocation.py [--occupancy 0.9] [--allocations 500]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qr_ids import FeistelPermutation, format_qr_id, is_valid_qr_id, LEGACY_SPACE, EXTENDED_FORMAT
+
+
+def random_with_checks(used, allocations, max_attempts=10):
+    """Old store_location behaviour: returns (issued, failures, lookups)"""
+    issued = failures = lookups = 0
+    for _ in range(allocations):
+        qr_id = str(random.randint(1000, 9999))
+        attempts = 0
+        lookups += 1
+        while qr_id in used and attempts < max_attempts:
+            qr_id = str(random.randint(1000, 9999))
+            attempts += 1
+            lookups += 1
+        if qr_id in used:
+            failures += 1  # old code went on and reused the taken ID
+        else:
+            used.add(qr_id)
+            issued += 1
+    return issued, failures, lookups
+
+
+def permutation_allocator(permutation, start_index, allocations):
+    """New allocator: index n -> permute(n); returns (issued, failures, lookups)"""
+    issued = set()
+    for index in range(start_index, start_index + allocations):
+        issued.add(format_qr_id(permutation.permute(index), 'legacy'))
+    return len(issued), allocations - len(issued), 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='QR ID allocation benchmark')
+    parser.add_argument('--occupancy', type=float, default=0.9)
+    parser.add_argument('--allocations', type=int, default=500)
+    args = parser.parse_args()
+
+    occupied = int(LEGACY_SPACE * args.occupancy)
+    allocations = min(args.allocations, LEGACY_SPACE - occupied)
+    print(f"Legacy space {LEGACY_SPACE}, {occupied} in use ({args.occupancy:.0%}), {allocations} allocations\n")
+
+    used = {str(1000 + value) for value in random.sample(range(LEGACY_SPACE), occupied)}
+    started = time.perf_counter()
+    issued, failures, lookups = random_with_checks(used, allocations)
+    elapsed = time.perf_counter() - started
+    print(f"random + checks : issued {issued}, collisions {failures}, lookups {lookups} "
+          f"({lookups / allocations:.1f} per ID), {elapsed * 1e6 / allocations:.1f} us/ID")
+
+    permutation = FeistelPermutation(LEGACY_SPACE, b'benchmark')
+    started = time.perf_counter()
+    issued, failures, lookups = permutation_allocator(permutation, occupied, allocations)
+    elapsed = time.perf_counter() - started
+    print(f"permutation     : issued {issued}, collisions {failures}, lookups {lookups} "
+          f"(0.0 per ID), {elapsed * 1e6 / allocations:.1f} us/ID")
+
+    # The permutation must cover the whole legacy space exactly once
+    full = {permutation.permute(index) for index in range(LEGACY_SPACE)}
+    print(f"\nlegacy permutation is a bijection: {len(full) == LEGACY_SPACE}")
+
+    extended = FeistelPermutation(10 ** 8, b'benchmark')
+    sample = [format_qr_id(extended.permute(index), EXTENDED_FORMAT, 8) for index in range(100000)]
+    print(f"extended: 100000 IDs unique: {len(set(sample)) == len(sample)}, "
+          f"all check digits valid: {all(is_valid_qr_id(qr_id) for qr_id in sample)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+Cross-service fan-out for tracking events.
+
+tracking_events publishes in-process, so a fix stored by delivery_app never
+reached a viewer connected to user_app. With
+TRACKING_EVENT_SOURCE=change_stream each worker instead opens ONE MongoDB
+change stream over shipment writes (the shipments collection, or the numeric
+per-QR collections in per_qr mode) and turns every delivery_location /
+delivery_complete write into the same location / delivered events, whichever
+service made it. The watcher starts with the first viewer and resumes from
+its last resume token after a dropped connection.
+
+Every event (from either source) is also demultiplexed to subscriber queues
+by qr_id and company_id. A queue holds at most
+TRACKING_SUBSCRIBER_QUEUE_SIZE events; when a viewer falls behind, the
+oldest events are dropped (tracking_hub_dropped_events_total) so a slow
+client never blocks writers or other viewers.
+
+Change streams need a replica set (every Atlas cluster is one; locally
+`mongod --replSet rs0` plus rs.initiate()). ChangeHub takes the stream
+opener as a parameter, and handle_change() accepts plain change documents,
+so a list of dicts can stand in for MongoDB.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+import mongo_pool
+from shipment_store import shipments_enabled, get_shipments_collection
+from tracking_events import (
+    bus, event_source, publish_location, publish_delivered, format_event,
+    HEARTBEAT_SECONDS, MAX_STREAM_SECONDS, RETRY_MILLISECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('TRACKING_SUBSCRIBER_QUEUE_SIZE', '100'))
+
+# qr_id -> company_id lookups kept per worker
+MAX_CACHED_COMPANIES = 10000
+
+RECONNECT_SECONDS = 1
+MAX_RECONNECT_SECONDS = 30
+
+# MongoDB error code for a resume token that has left the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+CHANGE_PIPELINE = [
+    {'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}},
+    {'$project': {'updateDescription': 0}}
+]
+
+
+class Subscription:
+    """Bounded event queue for one viewer; the oldest events are dropped when it is full"""
+
+    def __init__(self, qr_id=None, company_id=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.qr_id = str(qr_id) if qr_id is not None else None
+        self.company_id = str(company_id) if company_id is not None else None
+        self.dropped = 0
+        self._events = deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        with self._condition:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+                metrics.inc('tracking_hub_dropped_events_total')
+            self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout):
+        """Wait up to timeout seconds for events; returns (and removes) everything queued"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._events, timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+def _open_mongo_stream(resume_token):
+    """Change stream over shipment writes, with the current document for updates"""
+    db = mongo_pool.get_database()
+    options = {'full_document': 'updateLookup', 'resume_after': resume_token}
+    if shipments_enabled():
+        return get_shipments_collection(db).watch(CHANGE_PIPELINE, **options)
+    # per_qr mode: every numeric collection is a QR code
+    return db.watch([{'$match': {'ns.coll': {'$regex': r'^\d+$'}}}] + CHANGE_PIPELINE, **options)
+
+
+def _company_for_qr(qr_id):
+    location = mongo_pool.get_database().get_collection('locations').find_one({'qr_id': qr_id}, {'company_id': 1})
+    return location.get('company_id') if location else None
+
+
+class ChangeHub:
+    """One change stream watcher per process, fanned out to per-QR and per-company subscribers"""
+
+    def __init__(self, open_stream=_open_mongo_stream, resolve_company=_company_for_qr):
+        self.open_stream = open_stream
+        self.resolve_company = resolve_company
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._by_qr = {}  # qr_id -> set of Subscription
+        self._by_company = {}  # company_id -> set of Subscription
+        self._companies = OrderedDict()  # qr_id -> company_id, least recently used first
+        self._thread = None
+        self._pid = None
+        self.resume_token = None
+
+    def subscribe(self, qr_id=None, company_id=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        """Register a queue for one QR code and/or one company's orders"""
+        subscription = Subscription(qr_id, company_id, maxsize)
+        with self._lock:
+            if subscription.qr_id is not None:
+                self._by_qr.setdefault(subscription.qr_id, set()).add(subscription)
+            if subscription.company_id is not None:
+                self._by_company.setdefault(subscription.company_id, set()).add(subscription)
+            count = self._subscriber_count()
+        metrics.set_gauge('tracking_hub_subscribers', count)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for index, key in ((self._by_qr, subscription.qr_id), (self._by_company, subscription.company_id)):
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del index[key]
+            count = self._subscriber_count()
+        metrics.set_gauge('tracking_hub_subscribers', count)
+
+    def _subscriber_count(self):
+        return len({s for subscribers in list(self._by_qr.values()) + list(self._by_company.values()) for s in subscribers})
+
+    def dispatch(self, qr_id, event):
+        """Route one (event_id, event_type, data) to the QR's and its company's subscribers"""
+        qr_id = str(qr_id)
+        try:
+            with self._lock:
+                targets = set(self._by_qr.get(qr_id, ()))
+                by_company = bool(self._by_company)
+            if by_company:
+                company_id = self._company_id(qr_id)
+                if company_id is not None:
+                    with self._lock:
+                        targets.update(self._by_company.get(str(company_id), ()))
+            for subscription in targets:
+                subscription.put(event)
+        except Exception as e:
+            # Never fail the write that published the event
+            logger.error(f"Failed to dispatch tracking event for QR {qr_id}: {str(e)}")
+
+    def _company_id(self, qr_id):
+        with self._lock:
+            if qr_id in self._companies:
+                self._companies.move_to_end(qr_id)
+                return self._companies[qr_id]
+        company_id = self.resolve_company(qr_id)
+        with self._lock:
+            self._companies[qr_id] = company_id
+            if len(self._companies) > MAX_CACHED_COMPANIES:
+                self._companies.popitem(last=False)
+        return company_id
+
+    def start(self):
+        """Start this process's change stream watcher (change_stream mode only)"""
+        if event_source() != 'change_stream':
+            return
+        with self._lock:
+            # Started lazily so a preloaded master never owns the watcher thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='tracking-change-stream', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        delay = RECONNECT_SECONDS
+        while True:
+            stream = None
+            try:
+                stream = self.open_stream(self.resume_token)
+                metrics.inc('tracking_hub_streams_opened_total')
+                delay = RECONNECT_SECONDS
+                for change in stream:
+                    self.resume_token = change.get('_id')
+                    self.handle_change(change)
+            except Exception as e:
+                logger.error(f"Tracking change stream failed: {str(e)}")
+                if getattr(e, 'code', None) == CHANGE_STREAM_HISTORY_LOST:
+                    # Events older than the oplog are gone; viewers pick up from the next write
+                    self.resume_token = None
+            finally:
+                if stream is not None and hasattr(stream, 'close'):
+                    stream.close()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_SECONDS)
+
+    def handle_change(self, change):
+        """Publish the tracking event for one change document"""
+        doc = change.get('fullDocument')
+        if not doc:
+            return
+        metrics.inc('tracking_hub_changes_total')
+        qr_id = str(doc.get('qr_id') or change.get('ns', {}).get('coll'))
+
+        if doc.get('type') == 'delivery_location':
+            publish_location(dict(doc, qr_id=qr_id), source='change_stream')
+        elif doc.get('type') == 'delivery_complete' and change.get('operationType') == 'insert':
+            publish_delivered(
+                qr_id, doc.get('delivery_partner_name', 'Unknown'), doc.get('delivered_at'), source='change_stream'
+            )
+
+
+hub = ChangeHub()
+bus.add_listener(hub.dispatch)
+
+
+def _reset_after_fork():
+    """A child starts its own watcher; subscribers belong to the parent"""
+    hub._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
+
+
+def subscription_stream(subscription, heartbeat=HEARTBEAT_SECONDS, max_duration=MAX_STREAM_SECONDS):
+    """
+    Generate SSE frames for a hub subscription. There is no replay on
+    reconnect; an overflow event tells the client to reload when events
+    were dropped.
+    """
+    metrics.inc('tracking_streams_opened_total')
+    started = time.monotonic()
+    reported = 0
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        while time.monotonic() - started < max_duration:
+            events = subscription.get(heartbeat)
+            if subscription.dropped > reported:
+                yield f"event: overflow\ndata: {json.dumps({'dropped': subscription.dropped - reported})}\n\n"
+                reported = subscription.dropped
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+            for event_id, event_type, data in events:
+                yield format_event(event_id, event_type, data)
+    finally:
+        hub.unsubscribe(subscription)
+        metrics.inc('tracking_streams_closed_total')
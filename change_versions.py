@@ -0,0 +1,131 @@
+"""
+Change counters and ETags for polled read APIs.
+
+Dashboards poll /api/qr-tracking/<qr_id>, /api/company/<id>/orders,
+/api/company/<id>/employees and /api/users, and nearly every response is the
+same as the last one. Writes now bump a counter for what they changed - one
+document per scope in the `change_versions` collection:
+- qr:<qr_id> - delivery locations, delivery completion
+- orders:<company_id> - the same writes for any of the company's QR codes
+  (its order list shows each partner's latest position)
+- company:<company_id> - orders created, partners assigned, deliveries (via
+  metric_rollups) and partner registrations
+- users - user registration
+
+Read routes derive a weak ETag from the counters (a single _id lookup) and
+answer If-None-Match with 304 before running their real queries.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_COLLECTION = 'change_versions'
+
+# qr_id -> company_id lookups kept per worker (a QR code never changes company)
+MAX_CACHED_QR_COMPANIES = 10000
+
+USERS_SCOPE = 'users'
+
+
+def qr_scope(qr_id):
+    return f"qr:{qr_id}"
+
+
+def company_scope(company_id):
+    return f"company:{company_id}"
+
+
+def company_orders_scope(company_id):
+    return f"orders:{company_id}"
+
+
+_qr_companies = OrderedDict()
+_qr_companies_lock = threading.Lock()
+
+
+def _companies_for(db, qr_ids):
+    """company_id per QR ID, from the per-worker cache plus one locations query for the rest"""
+    companies = {}
+    with _qr_companies_lock:
+        for qr_id in qr_ids:
+            if qr_id in _qr_companies:
+                _qr_companies.move_to_end(qr_id)
+                companies[qr_id] = _qr_companies[qr_id]
+
+    missing = [qr_id for qr_id in qr_ids if qr_id not in companies]
+    if missing:
+        found = {
+            location['qr_id']: location.get('company_id')
+            for location in db.get_collection('locations').find({'qr_id': {'$in': missing}}, {'qr_id': 1, 'company_id': 1})
+        }
+        with _qr_companies_lock:
+            for qr_id, company_id in found.items():
+                _qr_companies[qr_id] = company_id
+                if len(_qr_companies) > MAX_CACHED_QR_COMPANIES:
+                    _qr_companies.popitem(last=False)
+        companies.update(found)
+    return companies
+
+
+def bump_versions(db, scopes):
+    """Increment the counters of every scope a write touched (never raises)"""
+    from pymongo import UpdateOne
+
+    scopes = list(dict.fromkeys(scopes))
+    if not scopes:
+        return
+    try:
+        db.get_collection(VERSIONS_COLLECTION).bulk_write(
+            [UpdateOne({'_id': scope}, {'$inc': {'v': 1}}, upsert=True) for scope in scopes],
+            ordered=False
+        )
+    except Exception as e:
+        logger.error(f"Failed to bump change versions {scopes}: {str(e)}")
+
+
+def bump_qr_versions(db, qr_ids):
+    """Bump the versions of QR codes and of their companies' order lists (never raises)"""
+    qr_ids = list(dict.fromkeys(str(qr_id) for qr_id in qr_ids))
+    if not qr_ids:
+        return
+    scopes = [qr_scope(qr_id) for qr_id in qr_ids]
+    try:
+        scopes += [company_orders_scope(company_id) for company_id in _companies_for(db, qr_ids).values() if company_id is not None]
+    except Exception as e:
+        logger.error(f"Failed to look up companies for QR versions: {str(e)}")
+    bump_versions(db, scopes)
+
+
+def current_etag(db, *scopes):
+    """ETag value for the current counters of the scopes (None if they cannot be read)"""
+    try:
+        versions = {
+            doc['_id']: doc.get('v', 0)
+            for doc in db.get_collection(VERSIONS_COLLECTION).find({'_id': {'$in': list(scopes)}})
+        }
+    except Exception as e:
+        logger.error(f"Failed to read change versions {scopes}: {str(e)}")
+        return None
+    return ';'.join(f"{scope}.{versions.get(scope, 0)}" for scope in scopes)
+
+
+def not_modified(etag):
+    """304 response if the request's If-None-Match already has this ETag, else None"""
+    from flask import request, Response
+
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    return tag_response(response, etag)
+
+
+def tag_response(response, etag, max_age=0):
+    """Attach the ETag and revalidation hints to a 200 response"""
+    if etag is None:
+        return response
+    response.set_etag(etag, weak=True)
+    # Browsers may reuse the body for max_age seconds, then must revalidate (cheap 304s)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}, must-revalidate' if max_age else 'private, no-cache'
+    return response
@@ -0,0 +1,171 @@
+"""
+Circuit breaker for the data layer.
+
+When MongoDB is unreachable, letting every request block on server selection
+exhausts the gunicorn workers within seconds. The breaker counts consecutive
+failures and, once the threshold is reached, opens so callers fail
+immediately. After a backoff delay it goes half-open and lets a single probe
+request through: success closes the breaker, failure reopens it with the
+backoff doubled (up to a maximum).
+
+States: closed -> open -> half_open -> closed (or back to open).
+"""
+import os
+import time
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Gauge values for the breaker state metric
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker with exponential backoff between probes"""
+
+    def __init__(self, name, failure_threshold=3, base_backoff=1.0, max_backoff=60.0, probe_timeout=10.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.clock = clock
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.backoff = base_backoff
+        self.opened_at = None
+        self.next_probe_at = None
+        self.probe_started_at = None
+
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._changes = []  # (old, new) transitions made under the lock, not yet sent to listeners
+        self._publish_state()
+
+    def add_listener(self, callback):
+        """
+        Call callback(old_state, new_state) on every state change.
+
+        Callbacks run after the breaker's lock is released, so they may call
+        back into the breaker.
+        """
+        self._listeners.append(callback)
+
+    def _publish_state(self):
+        metrics.set_gauge('db_circuit_breaker_state', STATE_VALUES[self.state], breaker=self.name)
+
+    def _transition(self, new_state):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        self._publish_state()
+        metrics.inc('db_circuit_breaker_transitions_total', breaker=self.name, to=new_state)
+        logger.warning(f"Circuit breaker '{self.name}' {old_state} -> {new_state}")
+        self._changes.append((old_state, new_state))
+
+    def _take_changes(self):
+        """Transitions recorded so far (call with the lock held)"""
+        changes, self._changes = self._changes, []
+        return changes
+
+    def _notify(self, changes):
+        """Send transitions to the listeners (call without the lock held)"""
+        for old_state, new_state in changes:
+            for callback in self._listeners:
+                try:
+                    callback(old_state, new_state)
+                except Exception as e:
+                    logger.error(f"Circuit breaker listener failed: {str(e)}")
+
+    def _open(self, now):
+        self.opened_at = now
+        self.next_probe_at = now + self.backoff
+        self.probe_started_at = None
+        self._transition(OPEN)
+
+    def allow_request(self):
+        """Return True if the caller may use the data layer right now"""
+        with self._lock:
+            allowed = self._allow(self.clock())
+            changes = self._take_changes()
+        self._notify(changes)
+        return allowed
+
+    def _allow(self, now):
+        if self.state == CLOSED:
+            return True
+
+        if self.state == HALF_OPEN:
+            # A probe is already in flight; if it never reported back, count it as failed
+            if now - self.probe_started_at < self.probe_timeout:
+                metrics.inc('db_circuit_breaker_rejections_total', breaker=self.name)
+                return False
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self._open(now)
+
+        if now >= self.next_probe_at:
+            # Let exactly one probe through
+            self.probe_started_at = now
+            self._transition(HALF_OPEN)
+            return True
+
+        metrics.inc('db_circuit_breaker_rejections_total', breaker=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self.backoff = self.base_backoff
+                self.opened_at = None
+                self.next_probe_at = None
+                self.probe_started_at = None
+                self._transition(CLOSED)
+            changes = self._take_changes()
+        self._notify(changes)
+
+    def record_failure(self):
+        with self._lock:
+            now = self.clock()
+            self.consecutive_failures += 1
+            metrics.inc('db_circuit_breaker_failures_total', breaker=self.name)
+
+            if self.state == HALF_OPEN:
+                # Probe failed - back off further before the next one
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self._open(now)
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._open(now)
+            changes = self._take_changes()
+        self._notify(changes)
+
+    def snapshot(self):
+        """Current breaker state for health endpoints"""
+        with self._lock:
+            now = self.clock()
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'backoff_seconds': self.backoff,
+                'next_probe_in_seconds': round(max(self.next_probe_at - now, 0), 3) if self.next_probe_at else None
+            }
+
+
+def breaker_from_env(name):
+    """Build a breaker configured from DB_BREAKER_* environment variables"""
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get('DB_BREAKER_FAILURE_THRESHOLD', '3')),
+        base_backoff=float(os.environ.get('DB_BREAKER_BASE_BACKOFF_SECONDS', '1')),
+        max_backoff=float(os.environ.get('DB_BREAKER_MAX_BACKOFF_SECONDS', '60')),
+        probe_timeout=float(os.environ.get('DB_BREAKER_PROBE_TIMEOUT_SECONDS', '10'))
+    )
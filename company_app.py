@@ -1,11 +1,35 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
-from datetime import datetime, timedelta
+from datetime import datetime
 import sys
 import time
-import random
+import mongo_pool
+import metrics
+from db_indexes import ensure_indexes_once
+from sequences import next_id
+from qr_ids import insert_location, QRIDSpaceExhausted
+from tracking_events import event_source
+from change_hub import hub as tracking_hub, subscription_stream
+from live_grid import grid as live_grid, parse_bbox, DEFAULT_QUERY_LIMIT, MAX_QUERY_LIMIT
+from change_versions import current_etag, not_modified, tag_response, company_scope, company_orders_scope
+from response_cache import response_cache, COMPANIES, COMPANIES_FULL
+from here_client import HereClient, HereUnavailable, shared_key_budget, parse_point
+from geocode_cache import build_geocode_cache, SEARCH_KINDS, MAX_QUERY_LENGTH, MAX_LIMIT
+from partner_positions import (
+    find_nearby_partners, DEFAULT_RADIUS_METERS, DEFAULT_MAX_AGE_SECONDS, DEFAULT_LIMIT, MAX_RADIUS_METERS,
+    MAX_NEARBY_LIMIT
+)
+from metric_rollups import (
+    record_order_created,
+    get_partner_summary, get_company_summary, get_partner_daily, compute_rates
+)
+from shipment_store import (
+    get_qr_collection,
+    get_company_orders_page, normalize_order_status, is_valid_order_cursor, get_partner_metrics,
+    ORDERS_PAGE_SIZE, MAX_ORDERS_PAGE_SIZE
+)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -34,6 +58,58 @@ def get_here_keys():
     """Get HERE Maps API keys for frontend use"""
     return jsonify({'keys': HERE_API_KEYS})
 
+# HERE lookups go through the server so results are cached and key quota is budgeted
+here = HereClient(HERE_API_KEYS, shared_budget=shared_key_budget(mongo_pool.get_database, mongo_pool.is_available))
+geocode_cache = build_geocode_cache(here)
+
+@app.route('/api/geocode')
+def geocode():
+    """Geocode or autosuggest a search query through the shared geocode cache"""
+    query = (request.args.get('q') or '').strip()
+    mode = request.args.get('mode', 'geocode')
+    if not query or len(query) > MAX_QUERY_LENGTH:
+        return jsonify({'message': f'q is required (at most {MAX_QUERY_LENGTH} characters)'}), 400
+    if mode not in SEARCH_KINDS:
+        return jsonify({'message': f'mode must be one of {", ".join(SEARCH_KINDS)}'}), 400
+    
+    try:
+        at = parse_point(request.args['at']) if request.args.get('at') else None
+        limit = min(max(int(request.args.get('limit', 5)), 1), MAX_LIMIT)
+    except ValueError:
+        return jsonify({'message': 'at must be lat,lng and limit a number'}), 400
+    
+    try:
+        result, source = geocode_cache.search(mode, query, at, request.args.get('countryCode'), limit)
+        response = jsonify(result)
+        response.headers['X-Geocode-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Geocoding unavailable: {str(e)}")
+        return jsonify({'message': 'Geocoding temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error geocoding query: {str(e)}")
+        return jsonify({'message': 'Failed to geocode query'}), 500
+
+@app.route('/api/reverse-geocode')
+def reverse_geocode():
+    """Address at a point through the shared geocode cache"""
+    try:
+        lat, lng = parse_point(request.args.get('at'))
+    except ValueError:
+        return jsonify({'message': 'at must be given as lat,lng'}), 400
+    
+    try:
+        result, source = geocode_cache.reverse(lat, lng)
+        response = jsonify(result)
+        response.headers['X-Geocode-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Reverse geocoding unavailable: {str(e)}")
+        return jsonify({'message': 'Reverse geocoding temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error reverse geocoding point: {str(e)}")
+        return jsonify({'message': 'Failed to reverse geocode location'}), 500
+
 # Routes
 @app.route('/')
 def index():
@@ -78,34 +154,12 @@ def store_location():
         
         if mongo_client:
             try:
-                # Generate unique 4-digit QR ID
-                qr_id = None
-                attempts = 0
-                max_attempts = 100
-                
-                locations_collection = mongo_client.get_database("tracksmart").get_collection("locations")
-                
-                while attempts < max_attempts:
-                    potential_id = str(random.randint(1000, 9999))
-                    
-                    # Check if ID already exists
-                    existing = locations_collection.find_one({'qr_id': potential_id})
-                    if not existing:
-                        qr_id = potential_id
-                        break
-                    
-                    attempts += 1
-                
-                if not qr_id:
-                    return jsonify({'message': 'Failed to generate unique QR ID'}), 500
-                
                 # Get company ID and assigned user from request
                 company_id = data.get('company_id')
                 assigned_user_id = data.get('assigned_user_id')
                 
                 # Create location document
                 location_doc = {
-                    'qr_id': qr_id,
                     'name': data['name'],
                     'address': data['address'],
                     'latitude': data['latitude'],
@@ -118,11 +172,15 @@ def store_location():
                     'assigned_user_id': assigned_user_id
                 }
                 
-                # Store in locations collection
-                result = locations_collection.insert_one(location_doc)
+                # Allocate a unique QR ID and store in locations collection
+                try:
+                    qr_id = insert_location(mongo_client.get_database("tracksmart"), location_doc)
+                except QRIDSpaceExhausted as e:
+                    app.logger.error(f"QR ID allocation failed: {str(e)}")
+                    return jsonify({'message': 'Failed to generate unique QR ID'}), 500
                 
                 # Create QR-specific collection
-                qr_collection = mongo_client.get_database("tracksmart").get_collection(qr_id)
+                qr_collection = get_qr_collection(mongo_client.get_database("tracksmart"), qr_id)
                 
                 # Store QR info in its own collection
                 qr_info_doc = {
@@ -140,6 +198,9 @@ def store_location():
                 
                 qr_collection.insert_one(qr_info_doc)
                 
+                # QR codes are active as soon as they are generated here - count the order
+                record_order_created(mongo_client.get_database("tracksmart"), company_id)
+                
                 # Send email notification if user is assigned
                 if assigned_user_id:
                     try:
@@ -168,7 +229,7 @@ def store_location():
                 return jsonify({
                     'message': 'Location stored successfully',
                     'qr_id': qr_id,
-                    'location_id': str(result.inserted_id),
+                    'location_id': str(location_doc['_id']),
                     'company_id': company_id,
                     'assigned_user_id': assigned_user_id
                 })
@@ -273,16 +334,8 @@ def company_register():
                 if existing_company:
                     return jsonify({'message': 'Email already registered'}), 400
                 
-                # Generate unique company ID starting from 1
-                highest_id_company = companies_collection.find_one(
-                    {},
-                    sort=[('company_id', -1)]
-                )
-                
-                if highest_id_company and 'company_id' in highest_id_company:
-                    company_id = highest_id_company['company_id'] + 1
-                else:
-                    company_id = 1
+                # Allocate the next company ID atomically from the counters collection
+                company_id = next_id(mongo_client.get_database("tracksmart"), 'company_id')
                 
                 # Create company document
                 company = {
@@ -299,6 +352,7 @@ def company_register():
                 
                 # Store in companies collection
                 result = companies_collection.insert_one(company)
+                response_cache.invalidate(COMPANIES, COMPANIES_FULL)
                 
                 app.logger.info(f"Company registered: {data['name']} ({email})")
                 
@@ -385,59 +439,52 @@ def company_login():
 def get_company_orders(company_id):
     """Get orders for a specific company - only accessible by company employees"""
     try:
+        # Cursor-based pagination and optional status filter
+        cursor = request.args.get('cursor')
+        status = None
+        if request.args.get('status'):
+            status = normalize_order_status(request.args.get('status'))
+            if not status:
+                return jsonify({'message': f"Invalid status filter: {request.args.get('status')}"}), 400
+        
+        try:
+            limit = min(max(int(request.args.get('limit', ORDERS_PAGE_SIZE)), 1), MAX_ORDERS_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        
+        if cursor and not is_valid_order_cursor(cursor):
+            return jsonify({'message': 'Invalid cursor'}), 400
+        
         # Try to initialize MongoDB if not connected
         if not mongo_connected:
             initialize_mongodb()
         
         if mongo_client:
             try:
-                # Get all QR codes created by this company
                 db = mongo_client.get_database("tracksmart")
-                locations_collection = db.get_collection("locations")
-                
-                # Find all QR codes for this company
-                company_qrs = locations_collection.find({'company_id': company_id})
                 
-                orders = []
-                for qr_doc in company_qrs:
-                    qr_id = qr_doc.get('qr_id')
-                    if qr_id:
-                        # Get QR-specific collection data
-                        qr_collection = db.get_collection(str(qr_id))
-                        
-                        # Get destination info
-                        destination_info = qr_collection.find_one({'type': 'destination_info'})
-                        if not destination_info:
-                            destination_info = qr_collection.find_one({'type': 'qr_info'})
-                        
-                        # Get latest delivery info
-                        delivery_info = qr_collection.find_one(
-                            {'type': 'delivery_location'}, 
-                            sort=[('timestamp', -1)]
-                        )
-                        
-                        # Determine status
-                        if not delivery_info:
-                            status = 'Pending'
-                        elif delivery_info.get('location_type') == 'role_only':
-                            status = 'Boarded and Arriving'
-                        else:
-                            status = 'In Progress'
-                        
-                        order_data = {
-                            'order_id': f"ORD-{qr_id}",
-                            'qr_id': qr_id,
-                            'destination': destination_info.get('location_name', 'Unknown') if destination_info else 'Unknown',
-                            'delivery_partner': delivery_info.get('delivery_partner_name', 'Not assigned') if delivery_info else 'Not assigned',
-                            'status': status,
-                            'created_at': qr_doc.get('timestamp', qr_doc.get('created_at'))
-                        }
-                        orders.append(order_data)
+                # No order, assignment, fix or delivery since the client's copy - skip the aggregation
+                etag = current_etag(db, company_scope(company_id), company_orders_scope(company_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
+                # Destination, latest delivery location and completion for every
+                # company QR code come back from one aggregation (see shipment_store)
+                orders, next_cursor = get_company_orders_page(
+                    db,
+                    company_id,
+                    status=status,
+                    cursor=cursor,
+                    limit=limit
+                )
                 
-                return jsonify({
+                return tag_response(jsonify({
                     'orders': orders,
-                    'total': len(orders)
-                })
+                    'total': len(orders),
+                    'next_cursor': next_cursor,
+                    'has_more': next_cursor is not None
+                }), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving company orders: {str(db_error)}")
@@ -449,6 +496,101 @@ def get_company_orders(company_id):
         app.logger.error(f"Error retrieving company orders: {str(e)}")
         return jsonify({'message': 'Failed to retrieve orders'}), 500
 
+@app.route('/api/company/<int:company_id>/stream')
+def stream_company_orders(company_id):
+    """Push location and delivered events for a company's orders as Server-Sent Events"""
+    if event_source() != 'change_stream':
+        # Writes happen in delivery_app - only the change stream carries them here
+        return jsonify({'message': 'Live updates need TRACKING_EVENT_SOURCE=change_stream'}), 503
+    
+    subscription = tracking_hub.subscribe(company_id=company_id)
+    return Response(
+        stream_with_context(subscription_stream(subscription)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/live-locations')
+def get_live_locations():
+    """Live partner positions inside an optional bbox=south,west,north,east, served from the in-memory grid"""
+    if event_source() != 'change_stream':
+        # Fixes are stored by delivery_app - only the change stream carries them here
+        return jsonify({'message': 'Live locations need TRACKING_EVENT_SOURCE=change_stream'}), 503
+    
+    try:
+        bbox = parse_bbox(request.args['bbox']) if request.args.get('bbox') else (-90.0, -180.0, 90.0, 180.0)
+        company_id = int(request.args['company_id']) if request.args.get('company_id') else None
+        limit = int(request.args.get('limit', DEFAULT_QUERY_LIMIT))
+    except ValueError:
+        return jsonify({'message': 'bbox must be south,west,north,east; company_id and limit must be numbers'}), 400
+    if not 0 < limit <= MAX_QUERY_LIMIT:
+        return jsonify({'message': f'limit must be between 1 and {MAX_QUERY_LIMIT}'}), 400
+    
+    try:
+        tracking_hub.start()
+        
+        # Recent positions from before this worker started
+        if not mongo_connected:
+            initialize_mongodb()
+        if mongo_client:
+            live_grid.ensure_loaded(mongo_client.get_database("tracksmart"))
+        
+        return jsonify(live_grid.query(*bbox, company_id=company_id, limit=limit))
+        
+    except Exception as e:
+        app.logger.error(f"Error fetching live locations: {str(e)}")
+        return jsonify({'message': 'Failed to fetch live locations'}), 500
+
+@app.route('/api/company/<int:company_id>/partners/nearby')
+def get_nearby_partners(company_id):
+    """Company's delivery partners with a recent fix within radius meters of a point, nearest first"""
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lng'])
+        radius = float(request.args.get('radius', DEFAULT_RADIUS_METERS))
+        max_age = float(request.args.get('max_age', DEFAULT_MAX_AGE_SECONDS))
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except (KeyError, ValueError):
+        return jsonify({'message': 'lat and lng are required; radius, max_age and limit must be numbers'}), 400
+    
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'message': 'Coordinates out of range'}), 400
+    if not (0 < radius <= MAX_RADIUS_METERS) or max_age <= 0 or not (0 < limit <= MAX_NEARBY_LIMIT):
+        return jsonify({'message': f'radius must be up to {MAX_RADIUS_METERS} m and limit up to {MAX_NEARBY_LIMIT}'}), 400
+    
+    try:
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if mongo_client:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                partners = find_nearby_partners(db, company_id, latitude, longitude, radius, max_age, limit)
+                
+                now = datetime.utcnow()
+                for partner in partners:
+                    partner['age_seconds'] = round((now - partner['timestamp']).total_seconds())
+                    partner['timestamp'] = partner['timestamp'].isoformat()
+                
+                return jsonify({
+                    'company_id': company_id,
+                    'radius': radius,
+                    'max_age': max_age,
+                    'partners': partners
+                })
+                
+            except Exception as db_error:
+                app.logger.error(f"Database error finding nearby partners: {str(db_error)}")
+                return jsonify({'message': 'Database error'}), 500
+        else:
+            app.logger.error("MongoDB not connected - cannot find nearby partners")
+            return jsonify({'message': 'Database connection failed'}), 500
+    
+    except Exception as e:
+        app.logger.error(f"Error finding nearby partners: {str(e)}")
+        return jsonify({'message': 'Failed to find nearby partners'}), 500
+
 @app.route('/api/company/<int:company_id>/employees')
 def get_company_employees(company_id):
     """Get employees and reviews for a specific company"""
@@ -461,6 +603,12 @@ def get_company_employees(company_id):
             try:
                 db = mongo_client.get_database("tracksmart")
                 
+                # No registration, assignment or delivery since the client's copy - skip the queries
+                etag = current_etag(db, company_scope(company_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
                 # Get only delivery partners who have selected this company
                 partners_collection = db.get_collection("delivery_partners")
                 partners = list(partners_collection.find({
@@ -468,35 +616,16 @@ def get_company_employees(company_id):
                     'companies': company_id  # Filter by company ID in the companies array
                 }))
                 
+                # Active/completed/rating counts for every partner in one grouped query
+                partner_metrics = get_partner_metrics(db, company_id)
+                
                 employees = []
                 for partner in partners:
-                    # Count active orders for this partner
-                    active_orders = 0
-                    completed_orders = 0
-                    total_ratings = 0
-                    rating_count = 0
-                    
-                    locations_collection = db.get_collection("locations")
-                    company_qrs = locations_collection.find({'company_id': company_id})
-                    
-                    for qr_doc in company_qrs:
-                        qr_id = qr_doc.get('qr_id')
-                        if qr_id:
-                            qr_collection = db.get_collection(str(qr_id))
-                            delivery_info = qr_collection.find_one({
-                                'type': 'delivery_location',
-                                'delivery_partner_name': partner['name']
-                            })
-                            if delivery_info:
-                                active_orders += 1
-                                # Simulate completed orders and ratings
-                                if random.randint(1, 100) > 70:  # 30% chance of being completed
-                                    completed_orders += 1
-                                    rating = random.randint(3, 5)  # Random rating 3-5
-                                    total_ratings += rating
-                                    rating_count += 1
-                    
-                    avg_rating = total_ratings / rating_count if rating_count > 0 else 0
+                    partner_row = partner_metrics.get(partner.get('email'), {})
+                    active_orders = partner_row.get('active_orders', 0)
+                    completed_orders = partner_row.get('completed_orders', 0)
+                    rating_count = partner_row.get('rating_count', 0)
+                    avg_rating = partner_row.get('rating_total', 0) / rating_count if rating_count > 0 else 0
                     
                     employee_data = {
                         'name': partner['name'],
@@ -510,10 +639,10 @@ def get_company_employees(company_id):
                     }
                     employees.append(employee_data)
                 
-                return jsonify({
+                return tag_response(jsonify({
                     'employees': employees,
                     'total': len(employees)
-                })
+                }), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving company employees: {str(db_error)}")
@@ -548,70 +677,42 @@ def get_employee_analytics(company_id, employee_name):
                 if not employee:
                     return jsonify({'message': 'Employee not found'}), 404
                 
-                # Calculate performance metrics
-                locations_collection = db.get_collection("locations")
-                company_qrs = locations_collection.find({'company_id': company_id})
+                # Precomputed daily rollups - O(days) reads instead of a scan over every company QR
+                employee_email = employee.get('email', '')
+                partner_totals = get_partner_summary(db, company_id, employee_email)
+                employee_rates = compute_rates(partner_totals)
                 
                 # Employee metrics
                 employee_metrics = {
-                    'total_orders': 0,
-                    'completed_orders': 0,
-                    'avg_rating': 0,
-                    'on_time_deliveries': 0,
-                    'performance_score': 0
+                    'total_orders': partner_totals.get('orders', 0),
+                    'completed_orders': partner_totals.get('completions', 0),
+                    'avg_rating': employee_rates['avg_rating'],
+                    'on_time_deliveries': partner_totals.get('on_time', 0),
+                    'avg_delivery_minutes': employee_rates['avg_delivery_minutes'],
+                    'performance_score': employee_rates['performance_score']
                 }
+                completion_rate = employee_rates['completion_rate']
+                on_time_rate = employee_rates['on_time_rate']
                 
-                # Calculate metrics for this employee
-                for qr_doc in company_qrs:
-                    qr_id = qr_doc.get('qr_id')
-                    if qr_id:
-                        qr_collection = db.get_collection(str(qr_id))
-                        delivery_info = qr_collection.find_one({
-                            'type': 'delivery_location',
-                            'delivery_partner_name': employee_name
-                        })
-                        if delivery_info:
-                            employee_metrics['total_orders'] += 1
-                            # Simulate performance data
-                            if random.randint(1, 100) > 25:  # 75% completion rate
-                                employee_metrics['completed_orders'] += 1
-                            if random.randint(1, 100) > 20:  # 80% on-time rate
-                                employee_metrics['on_time_deliveries'] += 1
-                
-                # Calculate average rating
-                employee_metrics['avg_rating'] = round(random.uniform(3.5, 5.0), 1)
-                
-                # Calculate performance score
-                completion_rate = (employee_metrics['completed_orders'] / employee_metrics['total_orders']) * 100 if employee_metrics['total_orders'] > 0 else 0
-                on_time_rate = (employee_metrics['on_time_deliveries'] / employee_metrics['total_orders']) * 100 if employee_metrics['total_orders'] > 0 else 0
-                employee_metrics['performance_score'] = round((completion_rate + on_time_rate + (employee_metrics['avg_rating'] * 20)) / 3, 1)
-                
-                # Calculate company average for comparison
+                # Company average for comparison, from the company-wide rollup
+                company_rates = compute_rates(get_company_summary(db, company_id))
                 company_avg = {
-                    'avg_rating': 4.2,
-                    'completion_rate': 85.0,
-                    'on_time_rate': 78.0,
-                    'performance_score': 82.5
+                    'avg_rating': company_rates['avg_rating'],
+                    'completion_rate': company_rates['completion_rate'],
+                    'on_time_rate': company_rates['on_time_rate'],
+                    'performance_score': company_rates['performance_score']
                 }
                 
                 # Performance comparison
                 comparison = {
-                    'rating_vs_avg': employee_metrics['avg_rating'] - company_avg['avg_rating'],
-                    'completion_vs_avg': completion_rate - company_avg['completion_rate'],
-                    'on_time_vs_avg': on_time_rate - company_avg['on_time_rate'],
-                    'performance_vs_avg': employee_metrics['performance_score'] - company_avg['performance_score']
+                    'rating_vs_avg': round(employee_metrics['avg_rating'] - company_avg['avg_rating'], 1),
+                    'completion_vs_avg': round(completion_rate - company_avg['completion_rate'], 1),
+                    'on_time_vs_avg': round(on_time_rate - company_avg['on_time_rate'], 1),
+                    'performance_vs_avg': round(employee_metrics['performance_score'] - company_avg['performance_score'], 1)
                 }
                 
-                # Recent performance data for charts
-                recent_performance = []
-                for i in range(7):  # Last 7 days
-                    date = datetime.utcnow() - timedelta(days=i)
-                    recent_performance.append({
-                        'date': date.strftime('%Y-%m-%d'),
-                        'orders': random.randint(2, 8),
-                        'rating': round(random.uniform(3.0, 5.0), 1),
-                        'on_time': random.randint(1, 8)
-                    })
+                # Recent performance data for charts (last 7 days)
+                recent_performance = get_partner_daily(db, company_id, employee_email, days=7)
                 
                 return jsonify({
                     'employee': {
@@ -694,37 +795,75 @@ def send_simple_notification(user_email, user_name, qr_id, company_name, locatio
         return False
 
 def initialize_mongodb():
-    """Initialize MongoDB connection"""
+    """Attach to the process-wide pooled MongoDB client (see mongo_pool)"""
     global mongo_client, mongo_connected
     
     try:
-        # Direct pymongo import
-        from pymongo import MongoClient
+        # Fail fast (no server selection wait) while the circuit breaker is open
+        if not mongo_pool.allow_request():
+            mongo_client = None
+            mongo_connected = False
+            return False
         
-        # Get MongoDB URI from environment variable
-        mongodb_uri = os.environ.get('MONGODB_URI', 'mongodb+srv://in:in@in.hfxejxb.mongodb.net/?retryWrites=true&w=majority&appName=in')
+        # One client per worker process - no reconnect or ping on the request path
+        mongo_client = mongo_pool.get_client()
+        mongo_connected = mongo_pool.is_available()
         
-        # Create connection
-        mongo_client = MongoClient(mongodb_uri)
+        if mongo_connected:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                ensure_indexes_once(db)
+            except Exception as index_error:
+                app.logger.error(f"Failed to ensure indexes: {index_error}")
         
-        # Test connection
-        mongo_client.admin.command('ping')
-        app.logger.info("MongoDB connected successfully")
-        mongo_connected = True
-        return True
+        return mongo_connected
         
     except ImportError as import_error:
         app.logger.error(f"MongoDB import failed: {import_error}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
     except Exception as e:
         app.logger.error(f"MongoDB connection failed: {e}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
 
-# Initialize MongoDB on startup
+def reset_mongodb_after_fork():
+    """Forget the parent process's client after a fork (e.g. gunicorn --preload)"""
+    global mongo_client, mongo_connected
+    mongo_client = None
+    mongo_connected = False
+
+mongo_pool.register_fork_callback(reset_mongodb_after_fork)
+
+def on_breaker_state_change(old_state, new_state):
+    """Make the next request re-check the breaker instead of using the cached client"""
+    global mongo_client, mongo_connected
+    if new_state != 'closed':
+        mongo_client = None
+        mongo_connected = False
+
+mongo_pool.breaker.add_listener(on_breaker_state_change)
+
+@app.route('/api/health')
+def health_check():
+    """Report MongoDB connection health from driver heartbeats (no ping per request)"""
+    health = mongo_pool.health_state()
+    status_code = 200 if health['state'] != 'down' else 503
+    return jsonify({'status': 'ok' if status_code == 200 else 'degraded', 'mongodb': health}), status_code
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Expose in-process metrics (JSON, or Prometheus text with ?format=prometheus)"""
+    if request.args.get('format') == 'prometheus':
+        return metrics.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    return jsonify(metrics.snapshot())
+
+# Initialize MongoDB on startup - one ping, then driver heartbeats track health
+mongo_pool.connect()
 initialize_mongodb()
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+"""
+Index management for the tracksmart database.
+
+Every index the services rely on is declared in INDEX_SPECS, and every query
+shape on a hot path is listed in QUERY_SHAPES. The services call
+ensure_indexes_once() at startup (create_index is idempotent), and the same
+checks are available from the command line:
+
+    python db_indexes.py ensure            # create missing indexes
+    python db_indexes.py report            # missing / unused indexes ($indexStats)
+    python db_indexes.py check             # static: every query shape has a supporting index
+    python db_indexes.py check --explain   # live: explain() every query shape, fail on COLLSCAN
+
+QUERY_SHAPES is maintained by hand: add a shape next to any new lookup on a
+request path. The static check only proves that each listed shape has a
+declared index (tests/test_db_indexes.py runs it, so dropping an index that
+a shape needs fails the suite). `check --explain` against a database with
+the indexes ensured is the gate for a changed query - it shows which plan
+the server really picks. Both exit non-zero on failure.
+"""
+import os
+import sys
+import logging
+import argparse
+
+from shipment_store import SHIPMENTS_COLLECTION, SHIPMENT_INDEXES
+from metric_rollups import ROLLUP_INDEXES
+from location_trail import trail_enabled, ensure_trail_collection
+from geocode_cache import GEOCODE_CACHE_COLLECTION, GEOCODE_INDEXES
+from partner_positions import POSITIONS_COLLECTION, POSITION_INDEXES
+from change_versions import VERSIONS_COLLECTION
+from here_client import KEY_USAGE_COLLECTION, KEY_USAGE_INDEXES
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options)
+INDEX_SPECS = [
+    ('companies', [('email', 1)], {'name': 'email_unique', 'unique': True}),
+    ('companies', [('name', 1)], {'name': 'name'}),
+    ('companies', [('company_id', 1)], {'name': 'company_id_unique', 'unique': True, 'sparse': True}),
+    ('users', [('email', 1)], {'name': 'email_unique', 'unique': True}),
+    ('users', [('user_id', 1)], {'name': 'user_id_unique', 'unique': True, 'sparse': True}),
+    ('delivery_partners', [('email', 1)], {'name': 'email_unique', 'unique': True}),
+    ('delivery_partners', [('companies', 1), ('active', 1)], {'name': 'companies_active'}),
+    ('delivery_partners', [('created_at', -1)], {'name': 'created_at'}),
+    ('locations', [('qr_id', 1)], {'name': 'qr_id_unique', 'unique': True}),
+    ('locations', [('company_id', 1), ('_id', -1)], {'name': 'company_id_id'}),
+]
+INDEX_SPECS += [(SHIPMENTS_COLLECTION, keys, options) for keys, options in SHIPMENT_INDEXES]
+INDEX_SPECS += list(ROLLUP_INDEXES)
+INDEX_SPECS += [(GEOCODE_CACHE_COLLECTION, keys, options) for keys, options in GEOCODE_INDEXES]
+INDEX_SPECS += [(POSITIONS_COLLECTION, keys, options) for keys, options in POSITION_INDEXES]
+INDEX_SPECS += [(KEY_USAGE_COLLECTION, keys, options) for keys, options in KEY_USAGE_INDEXES]
+
+# (collection, filter fields, sort fields) for queries issued on request paths.
+# Filter fields are the index prefix the query needs; extra residual predicates
+# (e.g. qr_id $ne None after company_id, name after companies/active) are not listed.
+QUERY_SHAPES = [
+    ('companies', ['email'], []),
+    ('companies', ['company_id'], []),
+    ('companies', [], ['company_id']),
+    ('users', ['email'], []),
+    ('users', ['user_id'], []),
+    ('users', [], ['user_id']),
+    ('delivery_partners', ['email'], []),
+    ('delivery_partners', ['active', 'companies'], []),  # company partner list, employee analytics and detail
+    ('delivery_partners', [], ['created_at']),
+    ('locations', ['qr_id'], []),
+    ('locations', ['company_id'], ['_id']),  # company orders page
+    ('locations', ['company_id'], []),  # partner metrics (with qr_id $ne None)
+    (SHIPMENTS_COLLECTION, ['qr_id', 'type'], ['timestamp']),
+    (SHIPMENTS_COLLECTION, ['qr_id', 'type', 'user_email'], []),
+    ('partner_daily_metrics', ['company_id', 'partner_email'], []),
+    ('company_daily_metrics', ['company_id'], []),
+    (POSITIONS_COLLECTION, ['location', 'companies', 'timestamp'], []),  # $geoNear nearby partners
+    (POSITIONS_COLLECTION, ['_id'], []),  # position upserts by partner email
+    (GEOCODE_CACHE_COLLECTION, ['_id'], []),
+    (VERSIONS_COLLECTION, ['_id'], []),
+    (KEY_USAGE_COLLECTION, ['_id'], []),  # shared HERE key budget
+]
+
+# Every collection has a unique _id index without declaring it
+IMPLICIT_INDEX_KEYS = [('_id', 1)]
+
+_indexes_ready = False
+
+
+def ensure_indexes(db):
+    """Create every declared index; returns a list of (collection, index name, error) failures"""
+    failures = []
+
+    # The time-series trail collection must exist before its index is built
+    if trail_enabled():
+        try:
+            ensure_trail_collection(db)
+        except Exception as e:
+            failures.append(('location_trail', 'timeseries', str(e)))
+            logger.error(f"Failed to create location trail collection: {str(e)}")
+
+    for collection_name, keys, options in INDEX_SPECS:
+        try:
+            db.get_collection(collection_name).create_index(keys, **options)
+        except Exception as e:
+            # e.g. duplicate keys blocking a unique index - report and keep going
+            failures.append((collection_name, options.get('name'), str(e)))
+            logger.error(f"Failed to create index {options.get('name')} on {collection_name}: {str(e)}")
+    return failures
+
+
+def ensure_indexes_once(db):
+    """Ensure indexes on first successful call in this process (skip with ENSURE_INDEXES_ON_STARTUP=false)"""
+    global _indexes_ready
+
+    if _indexes_ready or os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() == 'false':
+        return
+
+    ensure_indexes(db)
+    _indexes_ready = True
+    logger.info(f"Ensured {len(INDEX_SPECS)} declared indexes")
+
+
+def report_indexes(db):
+    """
+    Compare declared indexes with the database.
+
+    Returns {'missing': [...], 'unused': [...]} where unused lists existing
+    indexes with zero recorded accesses in $indexStats (since server restart).
+    """
+    missing = []
+    unused = []
+
+    declared_by_collection = {}
+    for collection_name, keys, options in INDEX_SPECS:
+        declared_by_collection.setdefault(collection_name, []).append((keys, options))
+
+    for collection_name, declared in declared_by_collection.items():
+        collection = db.get_collection(collection_name)
+        existing_keys = [list(index['key'].items()) for index in collection.list_indexes()]
+
+        for keys, options in declared:
+            if [tuple(key) for key in keys] not in [[tuple(key) for key in existing] for existing in existing_keys]:
+                missing.append({'collection': collection_name, 'name': options.get('name'), 'keys': keys})
+
+        for stats in collection.aggregate([{'$indexStats': {}}]):
+            if stats['name'] != '_id_' and stats.get('accesses', {}).get('ops', 0) == 0:
+                unused.append({'collection': collection_name, 'name': stats['name'], 'since': stats.get('accesses', {}).get('since')})
+
+    return {'missing': missing, 'unused': unused}
+
+
+def index_supports(keys, filter_fields, sort_fields):
+    """True if an index's key prefix covers the equality filter fields followed by the sort fields"""
+    index_fields = [field for field, _ in keys]
+    needed = len(filter_fields) + len(sort_fields)
+    if needed == 0 or len(index_fields) < needed:
+        return False
+    if set(index_fields[:len(filter_fields)]) != set(filter_fields):
+        return False
+    return index_fields[len(filter_fields):needed] == list(sort_fields)
+
+
+def check_query_shapes():
+    """Static check: list query shapes with no declared supporting index"""
+    unsupported = []
+    for collection_name, filter_fields, sort_fields in QUERY_SHAPES:
+        candidates = [IMPLICIT_INDEX_KEYS] + [keys for name, keys, _ in INDEX_SPECS if name == collection_name]
+        if not any(index_supports(keys, filter_fields, sort_fields) for keys in candidates):
+            unsupported.append((collection_name, filter_fields, sort_fields))
+    return unsupported
+
+
+def _explain_filter(collection_name, filter_fields):
+    """Sample filter for a query shape; fields under a 2dsphere index get a $nearSphere"""
+    geo_fields = {
+        field for name, keys, _ in INDEX_SPECS if name == collection_name
+        for field, direction in keys if direction == '2dsphere'
+    }
+    return {
+        field: {'$nearSphere': {'$geometry': {'type': 'Point', 'coordinates': [0, 0]}}} if field in geo_fields else 0
+        for field in filter_fields
+    }
+
+
+def explain_query_shapes(db):
+    """Live check: explain each query shape and list those whose winning plan is a collection scan"""
+    collection_scans = []
+    for collection_name, filter_fields, sort_fields in QUERY_SHAPES:
+        command = {
+            'find': collection_name,
+            'filter': _explain_filter(collection_name, filter_fields),
+            'sort': {field: 1 for field in sort_fields}
+        }
+        plan = db.command('explain', command, verbosity='queryPlanner')
+        if 'COLLSCAN' in str(plan.get('queryPlanner', {}).get('winningPlan')):
+            collection_scans.append((collection_name, filter_fields, sort_fields))
+    return collection_scans
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='TrackSmart index management')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('ensure', help='Create all declared indexes')
+    subparsers.add_parser('report', help='Report missing and unused indexes')
+    check_parser = subparsers.add_parser('check', help='Fail if a query shape has no supporting index')
+    check_parser.add_argument('--explain', action='store_true', help='Also run explain() against the database')
+    args = parser.parse_args(argv)
+
+    if args.command == 'check':
+        unsupported = check_query_shapes()
+        for collection_name, filter_fields, sort_fields in unsupported:
+            print(f"NO INDEX: {collection_name} filter={filter_fields} sort={sort_fields}")
+
+        collection_scans = []
+        if args.explain:
+            import mongo_pool
+            collection_scans = explain_query_shapes(mongo_pool.get_database())
+            for collection_name, filter_fields, sort_fields in collection_scans:
+                print(f"COLLSCAN: {collection_name} filter={filter_fields} sort={sort_fields}")
+
+        if unsupported or collection_scans:
+            return 1
+        print(f"All {len(QUERY_SHAPES)} query shapes have a supporting index")
+        return 0
+
+    import mongo_pool
+    db = mongo_pool.get_database()
+
+    if args.command == 'ensure':
+        failures = ensure_indexes(db)
+        for collection_name, name, error in failures:
+            print(f"FAILED: {collection_name}.{name}: {error}")
+        print(f"Ensured {len(INDEX_SPECS) - len(failures)} of {len(INDEX_SPECS)} indexes")
+        return 1 if failures else 0
+
+    if args.command == 'report':
+        report = report_indexes(db)
+        for index in report['missing']:
+            print(f"MISSING: {index['collection']}.{index['name']} {index['keys']}")
+        for index in report['unused']:
+            print(f"UNUSED: {index['collection']}.{index['name']} (no accesses since {index['since']})")
+        return 1 if report['missing'] else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
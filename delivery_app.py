@@ -6,6 +6,31 @@ from datetime import datetime
 import sys
 import time
 import random
+import mongo_pool
+import metrics
+from db_indexes import ensure_indexes_once
+from shipment_store import get_completion_collection, get_qr_collection
+from location_trail import record_fix
+from live_location import apply_location_batch, build_qr_location_doc, MAX_BATCH_SIZE
+from location_buffer import buffer as location_buffer, write_behind_enabled
+from location_dead_band import dead_band, ACCEPT, REFRESH
+from location_codec import is_binary_payload, decode_fixes, issue_token, partner_directory, PayloadError
+from partner_cache import partner_cache
+from here_client import HereClient, HereUnavailable, shared_key_budget, build_route_cache, parse_point, TRANSPORT_MODES
+from response_cache import response_cache, json_response, COMPANIES_FULL, DELIVERY_PARTNERS, company_partners_key
+from change_versions import bump_versions, bump_qr_versions, company_scope
+from partner_positions import record_positions
+from geofence import engine as geofence_engine
+from tracking_events import publish_location, publish_delivered
+from location_uplink import UplinkSession, serve as serve_uplink
+from metric_rollups import (
+    record_order_created, record_partner_assigned, record_delivery_completed
+)
+
+try:
+    from flask_sock import Sock
+except ImportError:  # optional - /ws/location is only served when flask-sock is installed
+    Sock = None
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -34,6 +59,35 @@ def get_here_keys():
     """Get HERE Maps API keys for frontend use"""
     return jsonify({'keys': HERE_API_KEYS})
 
+# HERE calls go through the server so results are cached and key quota is budgeted
+here = HereClient(HERE_API_KEYS, shared_budget=shared_key_budget(mongo_pool.get_database, mongo_pool.is_available))
+route_cache = build_route_cache(here)
+
+@app.route('/api/route')
+def get_route():
+    """Road route between two points via the cached HERE routing proxy"""
+    try:
+        origin = parse_point(request.args.get('origin'))
+        destination = parse_point(request.args.get('destination'))
+    except ValueError:
+        return jsonify({'message': 'origin and destination must be given as lat,lng'}), 400
+    
+    transport_mode = request.args.get('transportMode', 'car')
+    if transport_mode not in TRANSPORT_MODES:
+        return jsonify({'message': f'transportMode must be one of {", ".join(TRANSPORT_MODES)}'}), 400
+    
+    try:
+        route, source = route_cache.get_route(origin, destination, transport_mode)
+        response = jsonify(route)
+        response.headers['X-Route-Source'] = source
+        return response
+    except HereUnavailable as e:
+        app.logger.warning(f"Route unavailable: {str(e)}")
+        return jsonify({'message': 'Routing temporarily unavailable'}), 503
+    except Exception as e:
+        app.logger.error(f"Error calculating route: {str(e)}")
+        return jsonify({'message': 'Failed to calculate route'}), 500
+
 # Routes
 @app.route('/')
 def index():
@@ -56,18 +110,26 @@ def get_companies():
         if mongo_client:
             try:
                 companies_collection = mongo_client.get_database("tracksmart").get_collection("companies")
-                companies = list(companies_collection.find({}, {'password': 0}))  # Exclude passwords
                 
-                # Convert ObjectId to string for JSON serialization
-                for company in companies:
-                    company['_id'] = str(company['_id'])
+                def load_companies():
+                    companies = list(companies_collection.find({}, {'password': 0}))  # Exclude passwords
+                    
+                    # Convert ObjectId to string for JSON serialization
+                    for company in companies:
+                        company['_id'] = str(company['_id'])
+                    return companies
                 
-                return jsonify(companies)
+                # Cached until the next company registration
+                return json_response(response_cache.fetch(COMPANIES_FULL, load_companies))
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching companies: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(COMPANIES_FULL)
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch companies")
             return jsonify({'message': 'Database connection failed'}), 500
     
@@ -99,7 +161,7 @@ def activate_qr(qr_id):
                     return jsonify({'message': 'QR code not found'}), 404
                 
                 # Create QR-specific collection
-                qr_collection = db.get_collection(qr_id)
+                qr_collection = get_qr_collection(db, qr_id)
                 
                 # Store destination info as Coordinate A
                 destination_doc = {
@@ -117,12 +179,16 @@ def activate_qr(qr_id):
                 }
                 
                 # Store or update destination info
-                qr_collection.update_one(
+                update_result = qr_collection.update_one(
                     {'type': 'destination_info'},
                     {'$set': destination_doc},
                     upsert=True
                 )
                 
+                # Count the order in the company's daily rollup on first activation only
+                if update_result.upserted_id is not None:
+                    record_order_created(db, qr_info.get('company_id'))
+                
                 app.logger.info(f"QR code {qr_id} activated successfully by {delivery_partner_name}")
                 
                 return jsonify({
@@ -148,11 +214,35 @@ def activate_qr(qr_id):
         app.logger.error(f"Error activating QR: {str(e)}")
         return jsonify({'message': 'Failed to activate QR'}), 500
 
+def decode_location_payload():
+    """Fixes from a binary location payload (see location_codec); raises PayloadError"""
+    # Try to initialize MongoDB if not connected
+    if not mongo_connected:
+        initialize_mongodb()
+    
+    if not mongo_client:
+        raise ConnectionError('Database connection failed')
+    
+    return decode_fixes(request.get_data(), partner_directory.resolver(mongo_client.get_database("tracksmart")))
+
 @app.route('/api/store-live-location', methods=['POST'])
 def store_live_location():
     """Store live location data - special handling for QR tracking"""
     try:
-        data = request.get_json()
+        # Arrival checks for this worker's fixes (GEOFENCE_ENABLED=true)
+        geofence_engine.start()
+        
+        if is_binary_payload(request.content_type):
+            # Compact binary payload carrying exactly one fix
+            try:
+                fixes = decode_location_payload()
+            except PayloadError as e:
+                return jsonify({'message': str(e)}), 400
+            if len(fixes) != 1:
+                return jsonify({'message': 'Send one fix per request or use /store-live-location/batch'}), 400
+            data = fixes[0]
+        else:
+            data = request.get_json()
         
         # Validate required fields
         required_fields = ['latitude', 'longitude', 'user_email']
@@ -180,40 +270,64 @@ def store_live_location():
         # Check if this is QR tracking mode
         if qr_id:
             try:
-                qr_collection = db.get_collection(qr_id)
+                qr_collection = get_qr_collection(db, qr_id)
                 
-                # For aviation roles, store role information instead of coordinates
-                if role_only and role in ['Captain', 'Pilot', 'TC']:
-                    qr_location_doc = {
-                        'type': 'delivery_location',
-                        'qr_id': qr_id,
+                qr_location_doc = build_qr_location_doc(
+                    qr_id, user_email, partner_name, role, role_only, latitude, longitude
+                )
+                
+                # Partner standing still - drop the fix or only move the stored timestamp forward
+                decision, refreshed_doc = dead_band.apply(qr_location_doc)
+                if decision != ACCEPT:
+                    if decision == REFRESH:
+                        if write_behind_enabled():
+                            location_buffer.add(refreshed_doc, partner_name)
+                        else:
+                            qr_collection.update_one(
+                                {'type': 'delivery_location', 'user_email': user_email},
+                                {'$max': {'timestamp': refreshed_doc['timestamp']}}
+                            )
+                            bump_qr_versions(db, [qr_id])
+                            record_positions(db, [refreshed_doc])
+                    
+                    return jsonify({
+                        'message': 'QR tracking location unchanged',
+                        'timestamp': datetime.utcnow().isoformat(),
                         'user_email': user_email,
                         'delivery_partner_name': partner_name,
-                        'role': role,
-                        'location_type': 'role_only',
-                        'status': 'BOARDED AND ARRIVING',
-                        'timestamp': datetime.utcnow()
-                    }
-                else:
-                    # Regular delivery partner with coordinates
-                    qr_location_doc = {
-                        'type': 'delivery_location',
                         'qr_id': qr_id,
-                        'user_email': user_email,
-                        'delivery_partner_name': partner_name,
-                        'role': role,
-                        'latitude': latitude,
-                        'longitude': longitude,
-                        'location_type': 'coordinates',
-                        'timestamp': datetime.utcnow()
-                    }
-                
-                # Store in QR collection (upsert based on user_email to keep only latest location)
-                qr_collection.update_one(
-                    {'type': 'delivery_location', 'user_email': user_email},
-                    {'$set': qr_location_doc},
-                    upsert=True
-                )
+                        'suppressed': decision,
+                        'tracking_mode': 'qr_only'
+                    })
+                
+                if write_behind_enabled():
+                    # Coalesced with the partner's next fixes and written by the background flusher
+                    trail_point = None
+                    if qr_location_doc['location_type'] == 'coordinates':
+                        trail_point = (qr_id, user_email, latitude, longitude, qr_location_doc['timestamp'])
+                    location_buffer.add(qr_location_doc, partner_name, trail_point)
+                else:
+                    # Store in QR collection (upsert based on user_email to keep only latest location)
+                    update_result = qr_collection.update_one(
+                        {'type': 'delivery_location', 'user_email': user_email},
+                        {'$set': qr_location_doc},
+                        upsert=True
+                    )
+                    bump_qr_versions(db, [qr_id])
+                    record_positions(db, [qr_location_doc])
+                    
+                    # First fix from this partner for this QR - count it as one of their orders
+                    if update_result.upserted_id is not None:
+                        qr_location = db.get_collection("locations").find_one({'qr_id': qr_id}, {'company_id': 1})
+                        if qr_location:
+                            record_partner_assigned(db, qr_location.get('company_id'), user_email, partner_name)
+                    
+                    # Append coordinate fixes to the location trail (LOCATION_TRAIL=true)
+                    if qr_location_doc['location_type'] == 'coordinates':
+                        record_fix(db, qr_id, user_email, latitude, longitude)
+                
+                # Push the new position to tracking streams
+                publish_location(qr_location_doc)
                 
                 app.logger.info(f"QR tracking location stored in collection {qr_id} for {partner_name} ({user_email})")
                 
@@ -251,6 +365,7 @@ def store_live_location():
                 {'$set': location_doc},
                 upsert=True
             )
+            record_positions(db, [dict(location_doc, location_type='coordinates')])
             
             app.logger.info(f"Normal location stored for user {user_email}")
             
@@ -265,6 +380,65 @@ def store_live_location():
         app.logger.error(f"Error storing live location: {str(e)}")
         return jsonify({'message': 'Failed to store live location'}), 500
 
+@app.route('/store-live-location/batch', methods=['POST'])
+def store_live_location_batch():
+    """Store many timestamped QR tracking fixes (one or many partners) in one request"""
+    try:
+        # Arrival checks for this worker's fixes (GEOFENCE_ENABLED=true)
+        geofence_engine.start()
+        
+        if is_binary_payload(request.content_type):
+            try:
+                fixes = decode_location_payload()
+            except PayloadError as e:
+                return jsonify({'message': str(e)}), 400
+        else:
+            data = request.get_json(silent=True) or {}
+            fixes = data.get('fixes') if isinstance(data, dict) else None
+        
+        if not isinstance(fixes, list) or not fixes:
+            return jsonify({'message': 'fixes must be a non-empty array'}), 400
+        
+        if len(fixes) > MAX_BATCH_SIZE:
+            return jsonify({'message': f'At most {MAX_BATCH_SIZE} fixes per batch'}), 413
+        
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if not mongo_client:
+            return jsonify({'message': 'Database connection failed'}), 500
+        
+        results, summary = apply_location_batch(mongo_client.get_database("tracksmart"), fixes)
+        
+        app.logger.info(f"Location batch of {len(fixes)} fixes applied: {summary}")
+        
+        return jsonify({
+            'message': 'Location batch processed',
+            'timestamp': datetime.utcnow().isoformat(),
+            'results': results,
+            'summary': summary
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error storing location batch: {str(e)}")
+        return jsonify({'message': 'Failed to store location batch'}), 500
+
+def uplink_location_doc(fix):
+    """build_qr_location_doc for a validated uplink frame"""
+    return build_qr_location_doc(
+        fix['qr_id'], fix['user_email'], fix['delivery_partner_name'] or 'Unknown', fix['role'] or 'Boy',
+        fix['role_only'], fix['latitude'], fix['longitude'], fix['timestamp']
+    )
+
+if Sock is not None:
+    sock = Sock(app)
+    
+    @sock.route('/ws/location')
+    def location_uplink(ws):
+        """Persistent location uplink - JSON location frames in, batched acks out (see location_uplink)"""
+        serve_uplink(ws, UplinkSession(mongo_pool.get_database, uplink_location_doc))
+
 @app.route('/stop-qr-tracking', methods=['POST'])
 def stop_qr_tracking():
     """Stop QR tracking when Done button pressed or someone else scans QR"""
@@ -285,7 +459,7 @@ def stop_qr_tracking():
             return jsonify({'message': 'Database connection failed'}), 500
         
         db = mongo_client.get_database("tracksmart")
-        qr_collection = db.get_collection(qr_id)
+        qr_collection = get_qr_collection(db, qr_id)
         
         # Update tracking status
         qr_collection.update_one(
@@ -364,6 +538,9 @@ def delivery_register():
                 
                 # Store in delivery partners collection
                 result = partners_collection.insert_one(partner)
+                partner_cache.invalidate(email)  # cached as unknown (and as the newest partner) until now
+                bump_versions(mongo_client.get_database("tracksmart"), [company_scope(company_id) for company_id in partner['companies']])
+                response_cache.invalidate(DELIVERY_PARTNERS, *[company_partners_key(company_id) for company_id in partner['companies']])
                 
                 # Create individual collection for this delivery partner
                 collection_name = f"delivery_{email.replace('@', '_at_').replace('.', '_dot_')}"
@@ -441,7 +618,8 @@ def delivery_login():
                     'vehicle_type': partner['vehicle_type'],
                     'license': partner['license'],
                     'role': partner.get('role', 'Boy'),
-                    'active': partner['active']
+                    'active': partner['active'],
+                    'uplink_token': issue_token(partner['_id'])  # replaces the email in binary location payloads
                 }
                 
                 collection_name = f"delivery_{email.replace('@', '_').replace('.', '_')}"
@@ -481,9 +659,31 @@ def mark_delivered():
             initialize_mongodb()
         
         if mongo_client:
+            db = mongo_client.get_database("tracksmart")
+            
+            # Completion record next to the QR's documents - in change_stream mode its insert
+            # is what tells every service's viewers the order was delivered
+            from pymongo.errors import DuplicateKeyError
+            try:
+                completion = get_completion_collection(db, qr_id).update_one(
+                    {'type': 'delivery_complete'},
+                    {'$setOnInsert': {
+                        'status': 'delivered',
+                        'delivery_partner_name': delivery_partner_name,
+                        'user_email': data.get('user_email'),
+                        'delivered_at': datetime.now(),
+                        'timestamp': datetime.now()
+                    }},
+                    upsert=True
+                )
+                if completion.upserted_id is not None:
+                    bump_qr_versions(db, [qr_id])
+            except DuplicateKeyError:
+                pass  # a concurrent completion inserted it first
+            
             # Update the QR location in the main locations collection
-            locations_collection = mongo_client.get_database("tracksmart").get_collection("locations")
-            locations_collection.update_one(
+            locations_collection = db.get_collection("locations")
+            qr_location = locations_collection.find_one_and_update(
                 {'qr_id': qr_id},
                 {'$set': {
                     'delivery_status': 'delivered',
@@ -492,6 +692,19 @@ def mark_delivered():
                 }}
             )
             
+            # Update daily completion / time-to-deliver rollups (once per order)
+            if qr_location and qr_location.get('delivery_status') != 'delivered':
+                publish_delivered(qr_id, delivery_partner_name, datetime.utcnow())
+                record_delivery_completed(
+                    db,
+                    qr_location.get('company_id'),
+                    data.get('user_email'),
+                    delivery_partner_name,
+                    started_at=qr_location.get('activated_at') or qr_location.get('timestamp'),
+                    delivered_at=datetime.utcnow(),
+                    rating=data.get('rating')
+                )
+            
             app.logger.info(f"Order {qr_id} marked as delivered by {delivery_partner_name}")
             
             return jsonify({
@@ -508,37 +721,75 @@ def mark_delivered():
         return jsonify({'message': 'Failed to mark order as delivered'}), 500
 
 def initialize_mongodb():
-    """Initialize MongoDB connection"""
+    """Attach to the process-wide pooled MongoDB client (see mongo_pool)"""
     global mongo_client, mongo_connected
     
     try:
-        # Direct pymongo import
-        from pymongo import MongoClient
+        # Fail fast (no server selection wait) while the circuit breaker is open
+        if not mongo_pool.allow_request():
+            mongo_client = None
+            mongo_connected = False
+            return False
         
-        # Get MongoDB URI from environment variable
-        mongodb_uri = os.environ.get('MONGODB_URI', 'mongodb+srv://in:in@in.hfxejxb.mongodb.net/?retryWrites=true&w=majority&appName=in')
+        # One client per worker process - no reconnect or ping on the request path
+        mongo_client = mongo_pool.get_client()
+        mongo_connected = mongo_pool.is_available()
         
-        # Create connection
-        mongo_client = MongoClient(mongodb_uri)
+        if mongo_connected:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                ensure_indexes_once(db)
+            except Exception as index_error:
+                app.logger.error(f"Failed to ensure indexes: {index_error}")
         
-        # Test connection
-        mongo_client.admin.command('ping')
-        app.logger.info("MongoDB connected successfully")
-        mongo_connected = True
-        return True
+        return mongo_connected
         
     except ImportError as import_error:
         app.logger.error(f"MongoDB import failed: {import_error}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
     except Exception as e:
         app.logger.error(f"MongoDB connection failed: {e}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
 
-# Initialize MongoDB on startup
+def reset_mongodb_after_fork():
+    """Forget the parent process's client after a fork (e.g. gunicorn --preload)"""
+    global mongo_client, mongo_connected
+    mongo_client = None
+    mongo_connected = False
+
+mongo_pool.register_fork_callback(reset_mongodb_after_fork)
+
+def on_breaker_state_change(old_state, new_state):
+    """Make the next request re-check the breaker instead of using the cached client"""
+    global mongo_client, mongo_connected
+    if new_state != 'closed':
+        mongo_client = None
+        mongo_connected = False
+
+mongo_pool.breaker.add_listener(on_breaker_state_change)
+
+@app.route('/api/health')
+def health_check():
+    """Report MongoDB connection health from driver heartbeats (no ping per request)"""
+    health = mongo_pool.health_state()
+    status_code = 200 if health['state'] != 'down' else 503
+    return jsonify({'status': 'ok' if status_code == 200 else 'degraded', 'mongodb': health}), status_code
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Expose in-process metrics (JSON, or Prometheus text with ?format=prometheus)"""
+    if request.args.get('format') == 'prometheus':
+        return metrics.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    return jsonify(metrics.snapshot())
+
+# Initialize MongoDB on startup - one ping, then driver heartbeats track health
+mongo_pool.connect()
 initialize_mongodb()
 
 if __name__ == '__main__':
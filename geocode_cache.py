@@ -0,0 +1,169 @@
+"""
+Geocode, autosuggest and reverse-geocode cache for the QR generator page.
+
+qr.js looked up addresses on every map click and search keystroke, and
+companies creating QRs for the same warehouses and streets repeated the same
+lookups. /api/geocode and /api/reverse-geocode answer from two tiers:
+
+- a per-worker LRU (GEOCODE_CACHE_MAX_ENTRIES, default 5000)
+- the `geocode_cache` collection shared by every worker and service, whose
+  TTL index removes documents once expires_at passes
+
+Only a miss in both goes to HERE (through here_client's key budgets).
+
+Keys:
+- reverse lookups - coordinates rounded to GEOCODE_COORD_DECIMALS (default
+  4, about 11 m), and HERE is asked about the rounded point so every
+  request for a key gets the same answer
+- searches - casefolded, whitespace-collapsed query, plus the country, the
+  result limit and the `at` bias rounded to 2 decimals
+
+Entries live for GEOCODE_CACHE_TTL_SECONDS (default 30 days), autosuggest
+results for GEOCODE_SUGGEST_TTL_SECONDS (default 7 days).
+
+Metrics: geocode_cache_requests_total (labelled by kind and source: memory,
+mongo or here) and geocode_cache_hit_ratio.
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+import metrics
+import mongo_pool
+
+logger = logging.getLogger(__name__)
+
+GEOCODE_CACHE_COLLECTION = 'geocode_cache'
+GEOCODE_INDEXES = [
+    ([('expires_at', 1)], {'name': 'expires_at_ttl', 'expireAfterSeconds': 0}),
+]
+
+TTL_SECONDS = float(os.environ.get('GEOCODE_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+SUGGEST_TTL_SECONDS = float(os.environ.get('GEOCODE_SUGGEST_TTL_SECONDS', str(7 * 24 * 3600)))
+MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', '5000'))
+COORD_DECIMALS = int(os.environ.get('GEOCODE_COORD_DECIMALS', '4'))
+
+SEARCH_KINDS = ('geocode', 'autosuggest')
+MAX_QUERY_LENGTH = 200
+MAX_LIMIT = 20
+
+
+def normalize_query(query):
+    """Cache form of a search query: NFKC, casefolded, single spaces, no edge punctuation"""
+    query = unicodedata.normalize('NFKC', query or '').casefold()
+    return re.sub(r'\s+', ' ', query).strip(' ,.;')
+
+
+def reverse_key(lat, lng):
+    """(cache key, rounded lat, rounded lng) for a reverse lookup"""
+    lat, lng = round(lat, COORD_DECIMALS), round(lng, COORD_DECIMALS)
+    return f"revgeocode:{lat:.{COORD_DECIMALS}f},{lng:.{COORD_DECIMALS}f}", lat, lng
+
+
+def search_key(kind, query, at=None, country=None, limit=5):
+    """Cache key for a geocode or autosuggest search"""
+    at_key = f"{round(at[0], 2):.2f},{round(at[1], 2):.2f}" if at else ''
+    return f"{kind}:{country or ''}:{at_key}:{limit}:{normalize_query(query)}"
+
+
+class GeocodeCache:
+    """Memory LRU in front of a Mongo collection in front of HERE search"""
+
+    def __init__(self, upstream, get_database=mongo_pool.get_database, max_entries=MAX_ENTRIES):
+        self.upstream = upstream
+        self.get_database = get_database
+        self.max_entries = max_entries
+        self.hits = 0
+        self.lookups = 0
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at epoch seconds, response)
+
+    def _count(self, kind, source):
+        with self._lock:
+            self.lookups += 1
+            self.hits += source != 'here'
+            ratio = self.hits / self.lookups
+        metrics.inc('geocode_cache_requests_total', kind=kind, source=source)
+        metrics.set_gauge('geocode_cache_hit_ratio', round(ratio, 3))
+
+    def _remember(self, key, expires_at, response):
+        with self._lock:
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, kind, key, params, ttl):
+        """(response, source) for a key, asking HERE only if neither tier has it"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+        if entry is not None and entry[0] > now:
+            self._count(kind, 'memory')
+            return entry[1], 'memory'
+
+        doc_id = hashlib.sha1(key.encode()).hexdigest()
+        collection = None
+        try:
+            collection = self.get_database().get_collection(GEOCODE_CACHE_COLLECTION)
+            doc = collection.find_one({'_id': doc_id})
+            # The TTL monitor runs once a minute, so an expired document may still be there
+            if doc and doc['expires_at'] > datetime.utcnow():
+                expires_at = now + (doc['expires_at'] - datetime.utcnow()).total_seconds()
+                self._remember(key, expires_at, doc['response'])
+                self._count(kind, 'mongo')
+                return doc['response'], 'mongo'
+        except Exception as e:
+            logger.error(f"Geocode cache read failed for {key}: {str(e)}")
+
+        response = self.upstream.search(kind, params)
+        response = {'items': response.get('items', [])}
+        self._remember(key, now + ttl, response)
+        self._count(kind, 'here')
+        if collection is not None:
+            try:
+                collection.replace_one({'_id': doc_id}, {
+                    'key': key,
+                    'kind': kind,
+                    'response': response,
+                    'created_at': datetime.utcnow(),
+                    'expires_at': datetime.utcnow() + timedelta(seconds=ttl)
+                }, upsert=True)
+            except Exception as e:
+                logger.error(f"Geocode cache write failed for {key}: {str(e)}")
+        return response, 'here'
+
+    def reverse(self, lat, lng):
+        """({'items': [...]}, source) for the address at a point"""
+        key, lat, lng = reverse_key(lat, lng)
+        return self._lookup('revgeocode', key, {'at': f"{lat},{lng}", 'limit': 1}, TTL_SECONDS)
+
+    def search(self, kind, query, at=None, country=None, limit=5):
+        """({'items': [...]}, source) for a geocode or autosuggest query"""
+        params = {'q': ' '.join((query or '').split()), 'limit': limit}
+        if at:
+            params['at'] = f"{round(at[0], 2)},{round(at[1], 2)}"
+        if country:
+            params['in'] = f"countryCode:{country}"
+        ttl = SUGGEST_TTL_SECONDS if kind == 'autosuggest' else TTL_SECONDS
+        return self._lookup(kind, search_key(kind, query, at, country, limit), params, ttl)
+
+
+def build_geocode_cache(client):
+    """GeocodeCache over HERE search through a here_client.HereClient"""
+    from here_client import HereGeocoder
+
+    cache = GeocodeCache(HereGeocoder(client))
+    mongo_pool.register_fork_callback(cache._reset)
+    return cache
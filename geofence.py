@@ -0,0 +1,452 @@
+"""
+Geofence arrival detection for active shipments.
+
+Completion used to depend on the partner pressing Done. With
+GEOFENCE_ENABLED=true every worker that sees location fixes also keeps one
+row per (qr_id, partner) in parallel NumPy arrays - destination (coordinate
+A), latest fix (coordinate B), radius and state - and a background thread
+evaluates all rows at once every GEOFENCE_INTERVAL_SECONDS (default 2, the
+write-behind flush interval) with a haversine over the arrays:
+
+- arriving: the partner is within GEOFENCE_ARRIVING_METERS (default 300);
+  it is cleared again once they are 25% beyond it, so a partner driving
+  past does not stay "arriving"
+- arrived: the partner has stayed within the destination radius for
+  GEOFENCE_DWELL_SECONDS (default 20); the radius is the destination's
+  geofence_radius_meters or GEOFENCE_RADIUS_METERS (default 75)
+
+Both are published on the tracking event bus as 'arriving' / 'arrived'
+events. With GEOFENCE_AUTO_DELIVER=true an arrival also marks the order
+delivered (delivery_complete with delivery_method 'geofence'); the insert is
+an upsert behind a unique index (created lazily on per-QR collections in
+per_qr storage), so workers that saw the same fix deliver it once.
+
+Fixes reach the engine through the tracking bus, so with the default
+TRACKING_EVENT_SOURCE=local only the worker that stored a fix evaluates it;
+in change_stream mode every worker sees (and evaluates) every fix.
+Destinations are loaded in one query per tick for QR codes seen since the
+last one. Rows without a fix for GEOFENCE_MAX_AGE_SECONDS (default 3600)
+and delivered QR codes are dropped.
+
+Metrics: geofence_tracked, geofence_evaluate_seconds, geofence_events_total,
+geofence_auto_delivered_total, geofence_tick_failures_total.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+import metrics
+import mongo_pool
+from change_hub import hub as tracking_hub
+from change_versions import bump_qr_versions
+from metric_rollups import record_delivery_completed
+from shipment_store import get_completion_collection, get_qr_collection, get_shipments_collection, shipments_enabled
+from tracking_events import bus as tracking_bus, publish_delivered
+
+logger = logging.getLogger(__name__)
+
+GEOFENCE_ENABLED = os.environ.get('GEOFENCE_ENABLED', 'false').lower() == 'true'
+AUTO_DELIVER = os.environ.get('GEOFENCE_AUTO_DELIVER', 'false').lower() == 'true'
+INTERVAL_SECONDS = float(os.environ.get('GEOFENCE_INTERVAL_SECONDS', '2'))
+RADIUS_METERS = float(os.environ.get('GEOFENCE_RADIUS_METERS', '75'))
+ARRIVING_METERS = float(os.environ.get('GEOFENCE_ARRIVING_METERS', '300'))
+DWELL_SECONDS = float(os.environ.get('GEOFENCE_DWELL_SECONDS', '20'))
+MAX_AGE_SECONDS = float(os.environ.get('GEOFENCE_MAX_AGE_SECONDS', '3600'))
+
+EARTH_RADIUS_METERS = 6371008.8
+EXIT_FACTOR = 1.25
+MAX_DELIVERED_QRS = 10000
+INITIAL_CAPACITY = 1024
+
+# Row states
+NONE = 0
+ARRIVING = 1
+ARRIVED = 2
+
+DESTINATION_TYPES = ('destination_info', 'qr_info', 'delivery_complete')
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters between arrays of points given in radians"""
+    import numpy as np
+
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_destinations(db, qr_ids):
+    """
+    {qr_id: (latitude, longitude, radius or None)} for QR codes with a
+    destination, and {qr_id: None} for QR codes already delivered.
+    QR codes with neither are left out.
+    """
+    fields = {'qr_id': 1, 'type': 1, 'latitude': 1, 'longitude': 1, 'geofence_radius_meters': 1}
+    if shipments_enabled():
+        docs = get_shipments_collection(db).find(
+            {'qr_id': {'$in': list(qr_ids)}, 'type': {'$in': list(DESTINATION_TYPES)}}, fields
+        )
+    else:
+        docs = [
+            dict(doc, qr_id=qr_id)
+            for qr_id in qr_ids
+            for doc in get_qr_collection(db, qr_id).find({'type': {'$in': list(DESTINATION_TYPES)}}, fields)
+        ]
+
+    destinations = {}
+    delivered = set()
+    for doc in docs:
+        qr_id = str(doc['qr_id'])
+        if doc['type'] == 'delivery_complete':
+            delivered.add(qr_id)
+            continue
+        latitude, longitude = _coordinate(doc.get('latitude')), _coordinate(doc.get('longitude'))
+        if latitude is None or longitude is None:
+            continue
+        # destination_info wins over the legacy qr_info
+        if qr_id not in destinations or doc['type'] == 'destination_info':
+            destinations[qr_id] = (latitude, longitude, _coordinate(doc.get('geofence_radius_meters')))
+    destinations.update((qr_id, None) for qr_id in delivered)
+    return destinations
+
+
+def auto_deliver(db, qr_id, user_email, partner_name):
+    """
+    Mark an order delivered after a geofence arrival, as /api/mark-delivered
+    would. Returns False when it was already delivered.
+    """
+    from pymongo.errors import DuplicateKeyError
+
+    now = datetime.now()
+    try:
+        result = get_completion_collection(db, qr_id).update_one(
+            {'type': 'delivery_complete'},
+            {'$setOnInsert': {
+                'status': 'delivered',
+                'delivery_partner_name': partner_name,
+                'user_email': user_email,
+                'delivery_method': 'geofence',
+                'delivered_at': now,
+                'timestamp': now
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False  # another worker's upsert won (unique delivery_complete index)
+    if result.upserted_id is None:
+        return False
+
+    bump_qr_versions(db, [qr_id])
+    publish_delivered(qr_id, partner_name, now)
+
+    qr_location = db.get_collection('locations').find_one_and_update(
+        {'qr_id': qr_id},
+        {'$set': {
+            'delivery_status': 'delivered',
+            'delivered_at': now,
+            'delivery_partner': partner_name
+        }}
+    )
+    if qr_location:
+        record_delivery_completed(
+            db,
+            qr_location.get('company_id'),
+            user_email,
+            partner_name,
+            started_at=qr_location.get('activated_at') or qr_location.get('timestamp'),
+            delivered_at=datetime.utcnow()
+        )
+    logger.info(f"Order {qr_id} auto-delivered on geofence arrival of {partner_name} ({user_email})")
+    return True
+
+
+class GeofenceEngine:
+    """Latest fix per (qr_id, partner) in columnar arrays, evaluated against destinations in one pass"""
+
+    def __init__(self, get_database, interval=INTERVAL_SECONDS, radius=RADIUS_METERS, arriving=ARRIVING_METERS,
+                 dwell=DWELL_SECONDS, max_age=MAX_AGE_SECONDS, auto_deliver=AUTO_DELIVER, clock=time.time):
+        self.get_database = get_database
+        self.interval = interval
+        self.radius = radius
+        self.arriving = arriving
+        self.dwell = dwell
+        self.max_age = max_age
+        self.auto_deliver = auto_deliver
+        self.clock = clock
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._tick_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._capacity = 0
+        self._high = 0  # rows [0, _high) have been used
+        self._slots = {}  # (qr_id, email) -> row
+        self._keys = []  # row -> (qr_id, email) or None
+        self._names = []  # row -> partner name
+        self._free = []
+        self._qr_rows = {}  # qr_id -> set of rows
+        self._destinations = {}  # qr_id -> (latitude, longitude, radius or None)
+        self._unresolved = set()  # qr_ids waiting for their destination
+        self._delivered = OrderedDict()  # qr_ids known to be delivered, oldest first
+
+    def _grow(self):
+        import numpy as np
+
+        capacity = max(INITIAL_CAPACITY, self._capacity * 2)
+        columns = {
+            '_dest_lat': np.nan, '_dest_lng': np.nan, '_radius': np.nan, '_lat': np.nan, '_lng': np.nan,
+            '_seen': 0.0, '_inside_since': np.nan
+        }
+        for name, fill in columns.items():
+            column = np.full(capacity, fill, dtype=np.float64)
+            if self._capacity:
+                column[:self._capacity] = getattr(self, name)
+            setattr(self, name, column)
+        for name, dtype in (('_state', np.int8), ('_active', np.bool_)):
+            column = np.zeros(capacity, dtype=dtype)
+            if self._capacity:
+                column[:self._capacity] = getattr(self, name)
+            setattr(self, name, column)
+        self._keys.extend([None] * (capacity - self._capacity))
+        self._names.extend([None] * (capacity - self._capacity))
+        self._capacity = capacity
+
+    def _set_row_destination(self, row, destination):
+        import numpy as np
+
+        if destination is None:
+            self._dest_lat[row] = self._dest_lng[row] = np.nan
+        else:
+            latitude, longitude, radius = destination
+            self._dest_lat[row] = np.radians(latitude)
+            self._dest_lng[row] = np.radians(longitude)
+            self._radius[row] = radius or self.radius
+
+    def _release(self, row):
+        qr_id, email = self._keys[row]
+        del self._slots[(qr_id, email)]
+        rows = self._qr_rows.get(qr_id)
+        if rows is not None:
+            rows.discard(row)
+            if not rows:
+                del self._qr_rows[qr_id]
+                self._destinations.pop(qr_id, None)
+                self._unresolved.discard(qr_id)
+        self._keys[row] = self._names[row] = None
+        self._active[row] = False
+        self._free.append(row)
+
+    def set_destination(self, qr_id, latitude, longitude, radius=None):
+        """Set (or move) a QR code's destination"""
+        qr_id = str(qr_id)
+        with self._lock:
+            self._unresolved.discard(qr_id)
+            self._destinations[qr_id] = (float(latitude), float(longitude), radius)
+            for row in self._qr_rows.get(qr_id, ()):
+                self._set_row_destination(row, self._destinations[qr_id])
+
+    def update(self, qr_id, email, latitude, longitude, name=None):
+        """Record a partner's latest fix for a QR code"""
+        import numpy as np
+
+        qr_id = str(qr_id)
+        key = (qr_id, email)
+        with self._lock:
+            if qr_id in self._delivered:
+                return
+            row = self._slots.get(key)
+            if row is None:
+                if not self._free:
+                    if self._high == self._capacity:
+                        self._grow()
+                    self._free.append(self._high)
+                    self._high += 1
+                row = self._free.pop()
+                self._slots[key] = row
+                self._keys[row] = key
+                self._state[row] = NONE
+                self._inside_since[row] = np.nan
+                self._active[row] = True
+                self._qr_rows.setdefault(qr_id, set()).add(row)
+                if qr_id in self._destinations:
+                    self._set_row_destination(row, self._destinations[qr_id])
+                else:
+                    self._set_row_destination(row, None)
+                    self._unresolved.add(qr_id)
+            self._lat[row] = np.radians(latitude)
+            self._lng[row] = np.radians(longitude)
+            self._seen[row] = self.clock()
+            self._names[row] = name or self._names[row]
+
+    def delivered(self, qr_id):
+        """Stop tracking a delivered QR code (and ignore its later fixes)"""
+        qr_id = str(qr_id)
+        with self._lock:
+            self._delivered[qr_id] = True
+            self._delivered.move_to_end(qr_id)
+            if len(self._delivered) > MAX_DELIVERED_QRS:
+                self._delivered.popitem(last=False)
+            for row in list(self._qr_rows.get(qr_id, ())):
+                self._release(row)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def evaluate(self):
+        """
+        Check every row against its destination and advance states.
+        Returns (event_type, qr_id, email, partner name, distance in meters) per transition.
+        """
+        import numpy as np
+
+        with self._lock:
+            n = self._high
+            if not n:
+                return []
+            now = self.clock()
+            active = self._active[:n]
+            state = self._state[:n]
+            inside_since = self._inside_since[:n]
+
+            distance = haversine_meters(self._lat[:n], self._lng[:n], self._dest_lat[:n], self._dest_lng[:n])
+            with np.errstate(invalid='ignore'):
+                # NaN (no destination yet) compares False everywhere
+                inside = active & (distance <= self._radius[:n])
+                near = active & (distance <= self.arriving)
+                gone = active & (distance > self.arriving * EXIT_FACTOR)
+
+            inside_since[~inside] = np.nan
+            inside_since[inside & np.isnan(inside_since)] = now
+
+            arriving = near & (state == NONE)
+            left = gone & (state == ARRIVING)
+            arrived = inside & (state != ARRIVED) & (now - inside_since >= self.dwell)
+            stale = active & (now - self._seen[:n] > self.max_age)
+
+            state[left] = NONE
+            state[arriving] = ARRIVING
+            state[arrived] = ARRIVED
+
+            events = []
+            for event_type, mask in (('arriving', arriving), ('arrived', arrived)):
+                for row in np.flatnonzero(mask):
+                    qr_id, email = self._keys[row]
+                    events.append((event_type, qr_id, email, self._names[row], float(distance[row])))
+            for row in np.flatnonzero(stale):
+                self._release(row)
+        return events
+
+    def _resolve(self, db):
+        with self._lock:
+            pending, self._unresolved = self._unresolved, set()
+        if not pending:
+            return
+        try:
+            destinations = load_destinations(db, pending)
+        except Exception:
+            with self._lock:
+                self._unresolved |= pending
+            raise
+        for qr_id, destination in destinations.items():
+            if destination is None:
+                self.delivered(qr_id)
+            else:
+                self.set_destination(qr_id, *destination)
+        # QR codes without a destination yet are looked up again on their next fix
+        with self._lock:
+            for qr_id in pending - set(destinations):
+                for row in list(self._qr_rows.get(qr_id, ())):
+                    self._release(row)
+
+    def tick(self):
+        """Load new destinations, evaluate all rows and publish transitions; returns the events"""
+        with self._tick_lock:
+            started = time.perf_counter()
+            db = self.get_database()
+            self._resolve(db)
+            events = self.evaluate()
+            metrics.observe('geofence_evaluate_seconds', time.perf_counter() - started)
+            metrics.set_gauge('geofence_tracked', len(self))
+
+            for event_type, qr_id, email, name, distance in events:
+                tracking_bus.publish(qr_id, event_type, {
+                    'qr_id': qr_id,
+                    'status': event_type,
+                    'delivery_status': event_type,
+                    'user_email': email,
+                    'delivery_partner_name': name or 'Unknown',
+                    'distance_m': round(distance, 1),
+                    'timestamp': datetime.utcnow().isoformat()
+                })
+                metrics.inc('geofence_events_total', type=event_type)
+                if event_type == 'arrived' and self.auto_deliver:
+                    try:
+                        if auto_deliver(db, qr_id, email, name or 'Unknown'):
+                            metrics.inc('geofence_auto_delivered_total')
+                        self.delivered(qr_id)
+                    except Exception as e:
+                        logger.error(f"Geofence auto-delivery failed for QR {qr_id}: {str(e)}")
+            return events
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                metrics.inc('geofence_tick_failures_total')
+                logger.error(f"Geofence evaluation failed: {str(e)}")
+
+    def start(self):
+        """Start this worker's evaluation thread (and, in change_stream mode, its change stream watcher)"""
+        if not GEOFENCE_ENABLED:
+            return
+        with self._lock:
+            # Started lazily so a preloaded master never owns the thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='geofence', daemon=True)
+                self._thread.start()
+        # Fixes reach the bus through the change stream in change_stream mode
+        tracking_hub.start()
+
+    def on_event(self, qr_id, event):
+        """Tracking bus listener - feeds fixes in and stops tracking delivered QR codes"""
+        if not GEOFENCE_ENABLED:
+            return
+        _, event_type, data = event
+        if event_type == 'delivered':
+            self.delivered(qr_id)
+            return
+        position = data.get('coordinate_B') if event_type == 'location' else None
+        if not position or position.get('latitude') is None or position.get('longitude') is None:
+            return
+        if position.get('user_email'):
+            self.update(
+                qr_id, position['user_email'], float(position['latitude']), float(position['longitude']),
+                name=position.get('delivery_partner_name')
+            )
+            self.start()
+
+
+engine = GeofenceEngine(mongo_pool.get_database)
+tracking_bus.add_listener(engine.on_event)
+
+
+def _reset_after_fork():
+    """A child tracks only the fixes it sees itself"""
+    engine._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
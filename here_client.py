@@ -0,0 +1,519 @@
+"""
+Server-side HERE client: routing proxy with a route cache, plus the search
+upstream used by geocode_cache.
+
+The scanner page used to call router.hereapi.com from the browser on every
+location update. It rotated through the HERE API keys on 429s, which burned
+quota and hit rate limits. /api/route now goes through RouteCache:
+
+- origin and destination are snapped to a ROUTE_GRID_METERS grid (default 50),
+  and routes are cached per (transport mode, origin cell, destination cell)
+  for ROUTE_CACHE_TTL_SECONDS (default 300)
+- while the partner stays within ROUTE_REUSE_METERS (default 50) of a cached
+  route to the same destination cell, the rest of that route is served
+  instead of asking HERE again (0 turns reuse off)
+- concurrent misses for one cell pair share a single upstream request
+- each HERE API key gets HERE_KEY_BUDGET_PER_MINUTE requests (default 100)
+  across routing and search, and a key that answers 429 rests for its
+  Retry-After (default 60 s). The budget is counted in MongoDB (one
+  here_key_usage document per key and minute), so it holds across every
+  worker and service; HERE_KEY_BUDGET_SCOPE=worker counts per worker
+  process instead, and a worker falls back to its own count while MongoDB
+  is unavailable
+
+ROUTE_UPSTREAM=stub swaps HERE for StubRouter (straight lines, no network)
+and HERE_ROUTER_URL points the client at another HERE-compatible server.
+
+Routes are returned in HERE's shape ({'routes': [{'sections': [{'polyline',
+'summary'}]}]}), so the page renders them as before.
+"""
+import os
+import json
+import math
+import time
+import hashlib
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUTER_URL = os.environ.get('HERE_ROUTER_URL', 'https://router.hereapi.com/v8/routes')
+GEOCODE_URL = os.environ.get('HERE_GEOCODE_URL', 'https://geocode.search.hereapi.com/v1/geocode')
+AUTOSUGGEST_URL = os.environ.get('HERE_AUTOSUGGEST_URL', 'https://autosuggest.search.hereapi.com/v1/autosuggest')
+REVGEOCODE_URL = os.environ.get('HERE_REVGEOCODE_URL', 'https://revgeocode.search.hereapi.com/v1/revgeocode')
+ROUTE_UPSTREAM = os.environ.get('ROUTE_UPSTREAM', 'here')
+GRID_METERS = float(os.environ.get('ROUTE_GRID_METERS', '50'))
+REUSE_METERS = float(os.environ.get('ROUTE_REUSE_METERS', '50'))
+TTL_SECONDS = float(os.environ.get('ROUTE_CACHE_TTL_SECONDS', '300'))
+MAX_ENTRIES = int(os.environ.get('ROUTE_CACHE_MAX_ENTRIES', '2000'))
+KEY_BUDGET_PER_MINUTE = int(os.environ.get('HERE_KEY_BUDGET_PER_MINUTE', '100'))
+KEY_COOLDOWN_SECONDS = float(os.environ.get('HERE_KEY_COOLDOWN_SECONDS', '60'))
+KEY_BUDGET_SCOPE = os.environ.get('HERE_KEY_BUDGET_SCOPE', 'shared').lower()  # 'shared' or 'worker'
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('HERE_REQUEST_TIMEOUT_SECONDS', '10'))
+
+TRANSPORT_MODES = ('car', 'truck', 'scooter', 'bicycle', 'pedestrian')
+
+# Cached routes remembered per destination cell for polyline reuse
+MAX_ROUTES_PER_DESTINATION = 8
+
+EARTH_RADIUS_METERS = 6371000.0
+METERS_PER_DEGREE = 111320.0
+
+
+class HereUnavailable(Exception):
+    """HERE could not be reached (all keys rate limited or over budget, or HERE failing)"""
+
+
+# --- Flexible polyline (HERE's encoding) ---
+
+ENCODING_TABLE = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+DECODING_TABLE = {char: index for index, char in enumerate(ENCODING_TABLE)}
+FORMAT_VERSION = 1
+
+
+def _decode_unsigned(encoded):
+    result = shift = 0
+    for char in encoded:
+        value = DECODING_TABLE[char]
+        result |= (value & 0x1F) << shift
+        if not value & 0x20:
+            yield result
+            result = shift = 0
+        else:
+            shift += 5
+    if shift:
+        raise ValueError('Truncated flexible polyline')
+
+
+def decode_polyline(encoded):
+    """(precision, [(lat, lng), ...]) for a flexible polyline; a third dimension is dropped"""
+    values = _decode_unsigned(encoded)
+    if next(values) != FORMAT_VERSION:
+        raise ValueError('Unsupported flexible polyline version')
+    header = next(values)
+    precision = header & 0x0F
+    third_dim = (header >> 4) & 0x07
+    multiplier = 10 ** precision
+
+    points = []
+    lat = lng = 0
+    step = 3 if third_dim else 2
+    pending = []
+    for value in values:
+        pending.append(-((value + 1) >> 1) if value & 1 else value >> 1)
+        if len(pending) == step:
+            lat += pending[0]
+            lng += pending[1]
+            points.append((lat / multiplier, lng / multiplier))
+            pending = []
+    if pending:
+        raise ValueError('Truncated flexible polyline')
+    return precision, points
+
+
+def _encode_unsigned(value, out):
+    while value > 0x1F:
+        out.append(ENCODING_TABLE[(value & 0x1F) | 0x20])
+        value >>= 5
+    out.append(ENCODING_TABLE[value])
+
+
+def encode_polyline(points, precision=5):
+    """Flexible polyline for [(lat, lng), ...] (two dimensions)"""
+    out = []
+    _encode_unsigned(FORMAT_VERSION, out)
+    _encode_unsigned(precision, out)
+    multiplier = 10 ** precision
+    last_lat = last_lng = 0
+    for lat, lng in points:
+        scaled_lat = int(math.floor(abs(lat) * multiplier + 0.5)) * (1 if lat >= 0 else -1)
+        scaled_lng = int(math.floor(abs(lng) * multiplier + 0.5)) * (1 if lng >= 0 else -1)
+        for delta in (scaled_lat - last_lat, scaled_lng - last_lng):
+            _encode_unsigned(~(delta << 1) if delta < 0 else delta << 1, out)
+        last_lat, last_lng = scaled_lat, scaled_lng
+    return ''.join(out)
+
+
+# --- Geometry ---
+
+def distance_meters(a, b):
+    """Great-circle distance between two (lat, lng) points"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def grid_cell(point, grid_meters=GRID_METERS):
+    """Integer cell of a (lat, lng) point on a grid of roughly grid_meters squares"""
+    lat_step = grid_meters / METERS_PER_DEGREE
+    row = math.floor(point[0] / lat_step)
+    row_latitude = math.radians((row + 0.5) * lat_step)
+    lng_step = grid_meters / (METERS_PER_DEGREE * max(math.cos(row_latitude), 0.01))
+    return row, math.floor(point[1] / lng_step)
+
+
+def _nearest_segment(point, points):
+    """(index, distance in meters) of the polyline segment points[index] -> points[index + 1] nearest to point"""
+    # Local equirectangular projection around the point - accurate at these distances
+    scale = math.cos(math.radians(point[0]))
+
+    def project(p):
+        return ((p[1] - point[1]) * scale * METERS_PER_DEGREE, (p[0] - point[0]) * METERS_PER_DEGREE)
+
+    best_index, best_distance = 0, float('inf')
+    projected = [project(p) for p in points]
+    for index in range(len(projected) - 1):
+        (ax, ay), (bx, by) = projected[index], projected[index + 1]
+        dx, dy = bx - ax, by - ay
+        length_squared = dx * dx + dy * dy
+        t = 0.0 if length_squared == 0 else max(0.0, min(1.0, -(ax * dx + ay * dy) / length_squared))
+        distance = math.hypot(ax + t * dx, ay + t * dy)
+        if distance < best_distance:
+            best_index, best_distance = index, distance
+    return best_index, best_distance
+
+
+class Route:
+    """First section of a HERE route, decoded for reuse checks"""
+
+    def __init__(self, polyline, length, duration):
+        self.polyline = polyline
+        self.length = length
+        self.duration = duration
+        self.precision, self.points = decode_polyline(polyline) if polyline else (5, [])
+        self.stored_at = time.monotonic()
+
+    def remaining_from(self, origin, tolerance):
+        """The rest of this route from origin, or None if origin is more than tolerance meters off it"""
+        if len(self.points) < 2:
+            return None
+        index, off_route = _nearest_segment(origin, self.points)
+        if off_route > tolerance:
+            return None
+
+        rest = [origin] + self.points[index + 1:]
+        rest_length = sum(distance_meters(a, b) for a, b in zip(rest, rest[1:]))
+        geometric_length = sum(distance_meters(a, b) for a, b in zip(self.points, self.points[1:])) or 1.0
+        share = min(1.0, rest_length / geometric_length)
+        return Route(encode_polyline(rest, self.precision), round(self.length * share), round(self.duration * share))
+
+    def as_response(self):
+        if not self.polyline:
+            return {'routes': []}
+        return {'routes': [{'sections': [{
+            'polyline': self.polyline,
+            'summary': {'length': self.length, 'duration': self.duration}
+        }]}]}
+
+
+# --- Key budgets ---
+
+KEY_USAGE_COLLECTION = 'here_key_usage'
+KEY_USAGE_INDEXES = [
+    ([('expires_at', 1)], {'name': 'expires_at_ttl', 'expireAfterSeconds': 0}),
+]
+
+
+def key_fingerprint(api_key):
+    """Short stable id for an API key, so usage documents never hold the key itself"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+class SharedKeyBudget:
+    """Per-minute request counts per API key, shared by every worker and service through MongoDB"""
+
+    def __init__(self, get_database, is_available=lambda: True, clock=time.time):
+        self.get_database = get_database
+        self.is_available = is_available
+        self.clock = clock
+
+    def take(self, key_id, budget):
+        """Count one request for key_id in the current minute; False when the minute's budget is used up"""
+        from pymongo.errors import DuplicateKeyError
+
+        if not self.is_available():
+            raise HereUnavailable('MongoDB is unavailable')
+
+        minute = int(self.clock() // 60)
+        try:
+            # Matches only while the count is under budget; once it is not, the upsert collides on _id
+            self.get_database().get_collection(KEY_USAGE_COLLECTION).update_one(
+                {'_id': f"{key_id}:{minute}", 'count': {'$lt': budget}},
+                {'$inc': {'count': 1}, '$setOnInsert': {'expires_at': datetime.utcnow() + timedelta(minutes=2)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+
+def shared_key_budget(get_database, is_available):
+    """SharedKeyBudget unless HERE_KEY_BUDGET_SCOPE=worker"""
+    if KEY_BUDGET_SCOPE == 'worker':
+        return None
+    return SharedKeyBudget(get_database, is_available)
+
+
+# --- Upstreams ---
+
+class HereClient:
+    """HERE REST client rotating through API keys within per-key budgets (shared by routing and search)"""
+
+    def __init__(self, api_keys, budget_per_minute=KEY_BUDGET_PER_MINUTE, cooldown=KEY_COOLDOWN_SECONDS,
+                 timeout=REQUEST_TIMEOUT_SECONDS, clock=time.monotonic, shared_budget=None):
+        self.api_keys = list(api_keys)
+        self.budget_per_minute = budget_per_minute
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.clock = clock
+        self.shared_budget = shared_budget
+        self._key_ids = [key_fingerprint(api_key) for api_key in self.api_keys]
+        self._lock = threading.Lock()
+        self._next_key = 0
+        self._windows = {}  # key index -> (window start, requests in window)
+        self._resting_until = {}  # key index -> time a rate limited key may be used again
+
+    def _count_request(self, index, now):
+        """Count one request against a key's budget; False when the key has none left this minute"""
+        if self.shared_budget is not None:
+            try:
+                return self.shared_budget.take(self._key_ids[index], self.budget_per_minute)
+            except Exception as e:
+                metrics.inc('here_shared_budget_failures_total')
+                logger.warning(f"Shared HERE key budget unavailable, counting in this worker: {str(e)}")
+
+        with self._lock:
+            started, used = self._windows.get(index, (now, 0))
+            if now - started >= 60:
+                started, used = now, 0
+            if used >= self.budget_per_minute:
+                return False
+            self._windows[index] = (started, used + 1)
+            return True
+
+    def _take_key(self):
+        """Index of the next key with budget left (round robin), or None"""
+        now = self.clock()
+        with self._lock:
+            candidates = [
+                index for index in (
+                    (self._next_key + offset) % len(self.api_keys) for offset in range(len(self.api_keys))
+                )
+                if self._resting_until.get(index, 0) <= now
+            ]
+
+        for index in candidates:
+            if self._count_request(index, now):
+                with self._lock:
+                    self._next_key = (index + 1) % len(self.api_keys)
+                return index
+        return None
+
+    def _rest(self, index, seconds):
+        with self._lock:
+            self._resting_until[index] = self.clock() + seconds
+
+    def get_json(self, url, params, service):
+        """Parsed JSON from a HERE endpoint; raises HereUnavailable when no key can serve it"""
+        tried = set()
+        while True:
+            index = self._take_key()
+            if index is None or index in tried:
+                metrics.inc('here_budget_exhausted_total', service=service)
+                raise HereUnavailable('All HERE API keys are rate limited or over budget')
+            tried.add(index)
+
+            query = urllib.parse.urlencode(dict(params, apikey=self.api_keys[index]))
+            try:
+                with urllib.request.urlopen(f"{url}?{query}", timeout=self.timeout) as response:
+                    metrics.inc('here_requests_total', service=service, status=response.status)
+                    return json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                metrics.inc('here_requests_total', service=service, status=e.code)
+                if e.code == 429:
+                    retry_after = e.headers.get('Retry-After')
+                    self._rest(index, float(retry_after) if retry_after and retry_after.isdigit() else self.cooldown)
+                    logger.warning(f"HERE API key {index + 1} rate limited, trying next key")
+                    continue
+                if e.code in (401, 403):
+                    self._rest(index, self.cooldown)
+                    logger.error(f"HERE API key {index + 1} rejected ({e.code}), trying next key")
+                    continue
+                raise HereUnavailable(f'HERE {service} failed with status {e.code}')
+            except (urllib.error.URLError, TimeoutError) as e:
+                metrics.inc('here_requests_total', service=service, status='error')
+                raise HereUnavailable(f'HERE {service} request failed: {str(e)}')
+
+
+class HereRouter:
+    """Routing API v8 upstream for RouteCache"""
+
+    def __init__(self, client, url=ROUTER_URL):
+        self.client = client
+        self.url = url
+
+    def route(self, origin, destination, transport_mode):
+        """Route dict from HERE ({'routes': [...]})"""
+        return self.client.get_json(self.url, {
+            'origin': f"{origin[0]},{origin[1]}",
+            'destination': f"{destination[0]},{destination[1]}",
+            'transportMode': transport_mode,
+            'routingMode': 'fast',
+            'return': 'polyline,summary'
+        }, 'routing')
+
+
+class HereGeocoder:
+    """Geocoding & Search API v7 upstream for geocode_cache"""
+
+    def __init__(self, client, geocode_url=GEOCODE_URL, autosuggest_url=AUTOSUGGEST_URL, revgeocode_url=REVGEOCODE_URL):
+        self.client = client
+        self.urls = {'geocode': geocode_url, 'autosuggest': autosuggest_url, 'revgeocode': revgeocode_url}
+
+    def search(self, kind, params):
+        """{'items': [...]} from the geocode, autosuggest or revgeocode endpoint"""
+        return self.client.get_json(self.urls[kind], params, kind)
+
+
+class StubRouter:
+    """Offline upstream returning a straight line at 30 km/h - for tests and local development"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def route(self, origin, destination, transport_mode):
+        self.calls += 1
+        length = distance_meters(origin, destination)
+        return {'routes': [{'sections': [{
+            'polyline': encode_polyline([origin, destination]),
+            'summary': {'length': round(length), 'duration': round(length / (30 / 3.6))}
+        }]}]}
+
+
+# --- Cache ---
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.route = None
+        self.error = None
+
+
+class RouteCache:
+    """Grid-snapped route cache with polyline reuse and single-flight upstream requests"""
+
+    def __init__(self, upstream, grid_meters=GRID_METERS, reuse_meters=REUSE_METERS,
+                 ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.upstream = upstream
+        self.grid_meters = grid_meters
+        self.reuse_meters = reuse_meters
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._routes = OrderedDict()  # cache key -> Route, least recently used first
+        self._by_destination = {}  # (mode, destination cell) -> OrderedDict of cache keys
+        self._inflight = {}
+
+    def _key(self, origin, destination, transport_mode):
+        return (transport_mode, grid_cell(origin, self.grid_meters), grid_cell(destination, self.grid_meters))
+
+    def _fresh(self, route):
+        return time.monotonic() - route.stored_at < self.ttl
+
+    def _cached(self, key, origin):
+        """(route, source) from the cache without touching HERE, or (None, None)"""
+        with self._lock:
+            route = self._routes.get(key)
+            if route is not None and self._fresh(route):
+                self._routes.move_to_end(key)
+                return route, 'hit'
+
+            if self.reuse_meters <= 0:
+                return None, None
+            candidates = [
+                self._routes[other] for other in reversed(self._by_destination.get((key[0], key[2]), ()))
+                if other in self._routes and self._fresh(self._routes[other])
+            ]
+        # Geometry outside the lock - routes are immutable once stored
+        for candidate in candidates:
+            remaining = candidate.remaining_from(origin, self.reuse_meters)
+            if remaining is not None:
+                return remaining, 'reuse'
+        return None, None
+
+    def _store(self, key, route):
+        destination = (key[0], key[2])
+        with self._lock:
+            self._routes[key] = route
+            self._routes.move_to_end(key)
+            keys = self._by_destination.setdefault(destination, OrderedDict())
+            keys[key] = True
+            keys.move_to_end(key)
+            while len(keys) > MAX_ROUTES_PER_DESTINATION:
+                keys.popitem(last=False)
+            while len(self._routes) > self.max_entries:
+                evicted, _ = self._routes.popitem(last=False)
+                siblings = self._by_destination.get((evicted[0], evicted[2]))
+                if siblings is not None:
+                    siblings.pop(evicted, None)
+                    if not siblings:
+                        del self._by_destination[(evicted[0], evicted[2])]
+            size = len(self._routes)
+        metrics.set_gauge('route_cache_size', size)
+
+    def get_route(self, origin, destination, transport_mode='car'):
+        """(HERE-shaped route dict, source) where source is 'hit', 'reuse', 'shared' or 'miss'"""
+        key = self._key(origin, destination, transport_mode)
+        route, source = self._cached(key, origin)
+        if route is None:
+            with self._lock:
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+
+            if leader:
+                try:
+                    data = self.upstream.route(origin, destination, transport_mode)
+                    sections = (data.get('routes') or [{}])[0].get('sections') or [{}]
+                    summary = sections[0].get('summary') or {}
+                    flight.route = Route(sections[0].get('polyline'), summary.get('length', 0), summary.get('duration', 0))
+                    self._store(key, flight.route)
+                except Exception as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+                    flight.done.set()
+                route, source = flight.route, 'miss'
+            else:
+                if not flight.done.wait(REQUEST_TIMEOUT_SECONDS * 2):
+                    raise HereUnavailable('Timed out waiting for a shared route request')
+                if flight.error is not None:
+                    raise flight.error
+                route, source = flight.route, 'shared'
+
+        metrics.inc('route_requests_total', source=source)
+        return route.as_response(), source
+
+
+def parse_point(value):
+    """(lat, lng) from a 'lat,lng' query parameter; raises ValueError"""
+    lat, lng = (float(part) for part in (value or '').split(','))
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('Coordinates out of range')
+    return lat, lng
+
+
+def build_route_cache(client):
+    """RouteCache over HERE through a HereClient (or StubRouter when ROUTE_UPSTREAM=stub)"""
+    upstream = StubRouter() if ROUTE_UPSTREAM == 'stub' else HereRouter(client)
+    return RouteCache(upstream)
@@ -0,0 +1,245 @@
+"""
+In-process uniform grid of live partner positions.
+
+Dispatch and map views ask "which partners are inside this bounding box" on
+every pan; /api/live-locations answers from memory instead of MongoDB.
+
+- cells are LIVE_GRID_CELL_DEGREES squares (default 0.01, about 1.1 km);
+  each cell holds the emails of the partners whose latest fix falls in it
+- every accepted location fix reaches the grid through the tracking event
+  bus (the local publish in store_live_location, or the change stream in
+  TRACKING_EVENT_SOURCE=change_stream mode, which gives every worker every
+  fix); moving a partner is a dict update plus two set operations
+- entries are kept in arrival order and evicted once older than
+  LIVE_GRID_MAX_AGE_SECONDS (default 300) - popping from the front makes
+  eviction O(1) amortized
+- a query visits the cells overlapping the box, or only the occupied cells
+  when the box covers more cells than are occupied
+- each worker loads recent positions from partner_positions on first use
+
+Company filters use the partner's companies from partner_cache, looked up
+when the partner's fix arrives.
+"""
+import os
+import math
+import time
+import logging
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+import mongo_pool
+from partner_cache import partner_cache
+from partner_positions import POSITIONS_COLLECTION
+from tracking_events import bus as tracking_bus
+
+logger = logging.getLogger(__name__)
+
+CELL_DEGREES = float(os.environ.get('LIVE_GRID_CELL_DEGREES', '0.01'))
+MAX_AGE_SECONDS = float(os.environ.get('LIVE_GRID_MAX_AGE_SECONDS', '300'))
+DEFAULT_QUERY_LIMIT = 500
+MAX_QUERY_LIMIT = 5000
+
+
+class LiveGrid:
+    """Latest position per partner bucketed by grid cell, evicted by age"""
+
+    def __init__(self, cell_degrees=CELL_DEGREES, max_age=MAX_AGE_SECONDS, clock=time.time):
+        self.cell_degrees = cell_degrees
+        self.max_age = max_age
+        self.clock = clock
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # email -> position dict
+        self._cells = {}  # (row, column) -> set of emails
+        self._arrivals = OrderedDict()  # email -> arrival time, oldest first
+        self._loaded_pid = None
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _remove(self, email):
+        entry = self._entries.pop(email, None)
+        if entry is not None:
+            members = self._cells.get(entry['cell'])
+            if members is not None:
+                members.discard(email)
+                if not members:
+                    del self._cells[entry['cell']]
+        self._arrivals.pop(email, None)
+
+    def _evict(self, now):
+        cutoff = now - self.max_age
+        while self._arrivals:
+            email, arrived = next(iter(self._arrivals.items()))
+            if arrived >= cutoff:
+                break
+            self._remove(email)
+
+    def update(self, email, latitude, longitude, timestamp=None, name=None, role=None, qr_id=None,
+               companies=(), arrived=None):
+        """Insert or move a partner's position"""
+        now = self.clock()
+        arrived = now if arrived is None else arrived
+        cell = self._cell(latitude, longitude)
+        with self._lock:
+            previous = self._entries.get(email)
+            if previous is not None and previous['cell'] != cell:
+                members = self._cells.get(previous['cell'])
+                if members is not None:
+                    members.discard(email)
+                    if not members:
+                        del self._cells[previous['cell']]
+            self._entries[email] = {
+                'cell': cell,
+                'email': email,
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': timestamp,
+                'name': name,
+                'role': role,
+                'qr_id': qr_id,
+                'companies': frozenset(companies or ()),
+                'arrived': arrived
+            }
+            self._cells.setdefault(cell, set()).add(email)
+            self._arrivals[email] = arrived
+            self._arrivals.move_to_end(email)
+            self._evict(now)
+
+    def query(self, south=-90.0, west=-180.0, north=90.0, east=180.0, company_id=None, limit=DEFAULT_QUERY_LIMIT):
+        """Positions inside the box (west > east crosses the antimeridian), optionally for one company"""
+        if limit <= 0:
+            return []
+        if west > east:
+            first = self.query(south, west, north, 180.0, company_id, limit)
+            return first + self.query(south, -180.0, north, east, company_id, limit - len(first))
+
+        now = self.clock()
+        results = []
+        with self._lock:
+            self._evict(now)
+            low_row, low_column = self._cell(south, west)
+            high_row, high_column = self._cell(north, east)
+            box_cells = (high_row - low_row + 1) * (high_column - low_column + 1)
+            if box_cells <= len(self._cells):
+                cells = (
+                    self._cells.get((row, column), ())
+                    for row in range(low_row, high_row + 1)
+                    for column in range(low_column, high_column + 1)
+                )
+            else:
+                cells = (
+                    members for (row, column), members in self._cells.items()
+                    if low_row <= row <= high_row and low_column <= column <= high_column
+                )
+
+            for members in cells:
+                for email in members:
+                    entry = self._entries[email]
+                    if not (south <= entry['latitude'] <= north and west <= entry['longitude'] <= east):
+                        continue
+                    if company_id is not None and company_id not in entry['companies']:
+                        continue
+                    if now - entry['arrived'] > self.max_age:
+                        continue  # loaded out of arrival order, not evicted yet
+                    results.append({
+                        'email': email,
+                        'name': entry['name'],
+                        'role': entry['role'],
+                        'qr_id': entry['qr_id'],
+                        'latitude': entry['latitude'],
+                        'longitude': entry['longitude'],
+                        'timestamp': entry['timestamp'],
+                        'age_seconds': round(now - entry['arrived'])
+                    })
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, email, latitude, longitude, timestamp=None, name=None, qr_id=None):
+        """Add a fix, taking the partner's role and companies from partner_cache"""
+        try:
+            profile = partner_cache.get(email) or {}
+        except Exception as e:
+            logger.error(f"Live grid could not load partner {email}: {str(e)}")
+            profile = {}
+        self.update(
+            email, float(latitude), float(longitude),
+            timestamp=timestamp,
+            name=name or profile.get('name'),
+            role=profile.get('role'),
+            qr_id=qr_id,
+            companies=profile.get('companies')
+        )
+
+    def on_event(self, qr_id, event):
+        """Tracking bus listener - feeds location events with coordinates into the grid"""
+        _, event_type, data = event
+        position = data.get('coordinate_B') if event_type == 'location' else None
+        if not position or position.get('latitude') is None or position.get('longitude') is None:
+            return
+        if position.get('user_email'):
+            self.record(
+                position['user_email'], position['latitude'], position['longitude'],
+                timestamp=position.get('timestamp'), name=position.get('delivery_partner_name'), qr_id=qr_id
+            )
+
+    def ensure_loaded(self, db):
+        """Load positions fresher than max_age from partner_positions, once per worker"""
+        if self._loaded_pid == os.getpid():
+            return
+        self._loaded_pid = os.getpid()
+
+        now = self.clock()
+        utcnow = datetime.utcnow()
+        cutoff = datetime.utcfromtimestamp(now - self.max_age)
+        try:
+            positions = db.get_collection(POSITIONS_COLLECTION).find(
+                {'timestamp': {'$gte': cutoff}}
+            ).sort('timestamp', 1)
+            loaded = 0
+            for position in positions:
+                longitude, latitude = position['location']['coordinates']
+                with self._lock:
+                    if position['_id'] in self._entries:
+                        continue  # a live fix arrived while loading
+                self.update(
+                    position['_id'], latitude, longitude,
+                    timestamp=position['timestamp'].isoformat(),
+                    name=position.get('name'),
+                    role=position.get('role'),
+                    qr_id=position.get('qr_id'),
+                    companies=position.get('companies'),
+                    arrived=now - (utcnow - position['timestamp']).total_seconds()
+                )
+                loaded += 1
+            logger.info(f"Live grid loaded {loaded} recent partner positions")
+        except Exception as e:
+            self._loaded_pid = None  # try again on the next request
+            logger.error(f"Live grid bootstrap failed: {str(e)}")
+
+
+grid = LiveGrid()
+tracking_bus.add_listener(grid.on_event)
+
+
+def _reset_after_fork():
+    """A child loads its own positions on first use"""
+    grid._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
+
+
+def parse_bbox(value):
+    """(south, west, north, east) from a 'south,west,north,east' query parameter; raises ValueError"""
+    south, west, north, east = (float(part) for part in value.split(','))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('Bounding box out of range')
+    return south, west, north, east
@@ -0,0 +1,285 @@
+"""
+Batch ingestion of live delivery partner locations.
+
+Scanner pages post one fix at a time to /store-live-location, and each post
+costs a delivery_partners lookup plus an upsert. /store-live-location/batch
+accepts many timestamped fixes (from one or many partners) and applies them
+with cached partner lookups (see partner_cache), one bulk_write per target
+collection and one locations query for first-fix rollups.
+
+Only the newest fix per (qr_id, partner) updates delivery_location, and an
+update never replaces a stored fix with an older one, so buffered fixes
+flushed late cannot move a partner backwards. Every valid fix still goes to
+the location trail when trail mode is on.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+import metrics
+from qr_ids import is_valid_qr_id
+from shipment_store import qr_bulk_target
+from location_trail import record_fixes, parse_time
+from metric_rollups import record_partner_assigned
+from tracking_events import publish_location
+from partner_cache import partner_cache
+from change_versions import bump_qr_versions
+from partner_positions import record_positions
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 500
+
+# How far ahead of the server clock a fix timestamp may be before it is clamped to now
+MAX_CLOCK_SKEW = timedelta(seconds=int(os.environ.get('LOCATION_MAX_CLOCK_SKEW_SECONDS', '120')))
+
+# Roles whose position is not shared - their delivery_location carries role information only
+ROLE_ONLY_ROLES = ('captain', 'pilot', 'tc')
+
+STORED = 'stored'
+SUPERSEDED = 'superseded'  # valid, but a newer fix for the same QR and partner is in the batch
+DUPLICATE = 'duplicate'
+REJECTED = 'rejected'
+
+
+def _parse_fix_time(value):
+    """
+    Fix timestamps may be ISO 8601 strings or epoch milliseconds (as sent by JavaScript).
+
+    A timestamp more than MAX_CLOCK_SKEW ahead of the server is clamped to
+    now, so a client with a bad clock cannot pin a partner's stored fix (which
+    is never replaced by an older one) in the future.
+    """
+    now = datetime.utcnow()
+    if value is None:
+        return now
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        timestamp = datetime.utcfromtimestamp(value / 1000.0)
+    else:
+        timestamp = parse_time(value) or now
+    if timestamp > now + MAX_CLOCK_SKEW:
+        metrics.inc('live_location_future_timestamps_total')
+        return now
+    return timestamp
+
+
+def validate_fix(fix):
+    """Return (normalized fix, None) or (None, error message)"""
+    if not isinstance(fix, dict):
+        return None, 'Fix must be an object'
+
+    qr_id = str(fix.get('qr_id') or '')
+    user_email = fix.get('user_email') or fix.get('email')
+    if not is_valid_qr_id(qr_id):
+        return None, 'Invalid QR ID format'
+    if not user_email:
+        return None, 'User email is required'
+
+    try:
+        timestamp = _parse_fix_time(fix.get('timestamp'))
+    except (ValueError, TypeError, AttributeError, OverflowError, OSError):
+        return None, 'Invalid timestamp'
+
+    role_only = bool(fix.get('role_only', False))
+    latitude = fix.get('latitude')
+    longitude = fix.get('longitude')
+    if not role_only:
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+        except (TypeError, ValueError):
+            return None, 'latitude and longitude are required'
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return None, 'Coordinates out of range'
+
+    return {
+        'qr_id': qr_id,
+        'user_email': user_email,
+        'latitude': latitude,
+        'longitude': longitude,
+        'timestamp': timestamp,
+        'role_only': role_only,
+        'role': fix.get('role'),
+        'delivery_partner_name': fix.get('delivery_partner_name')
+    }, None
+
+
+def _delivery_location_doc(fix, partner):
+    """delivery_location document for a fix, in the same shape store_live_location writes"""
+    partner_name = (partner or {}).get('name') or fix['delivery_partner_name'] or 'Unknown Partner'
+    partner_role = (partner or {}).get('role') or fix['role'] or 'boy'
+
+    doc = {
+        'type': 'delivery_location',
+        'timestamp': fix['timestamp'],
+        'user_email': fix['user_email'],
+        'delivery_partner_name': partner_name,
+        'role': partner_role,
+        'qr_id': fix['qr_id'],
+        'coordinate_type': 'B'
+    }
+    if fix['role_only'] or partner_role.lower() in ROLE_ONLY_ROLES:
+        doc['delivery_partner_name'] = partner_role.upper()
+        doc['location_type'] = 'role_only'
+    else:
+        doc['latitude'] = fix['latitude']
+        doc['longitude'] = fix['longitude']
+        doc['location_type'] = 'coordinates'
+    return doc
+
+
+def build_qr_location_doc(qr_id, user_email, partner_name, role, role_only, latitude, longitude, timestamp=None):
+    """
+    delivery_location document for the delivery service's QR tracking paths.
+
+    Aviation roles (captain, pilot, tc) reporting role_only store their role
+    and no coordinates; everyone else stores the fix. timestamp defaults to now.
+    """
+    doc = {
+        'type': 'delivery_location',
+        'qr_id': qr_id,
+        'user_email': user_email,
+        'delivery_partner_name': partner_name,
+        'role': role,
+        'timestamp': timestamp or datetime.utcnow()
+    }
+    if role_only and str(role).lower() in ROLE_ONLY_ROLES:
+        doc['location_type'] = 'role_only'
+        doc['status'] = 'BOARDED AND ARRIVING'
+    else:
+        doc['latitude'] = latitude
+        doc['longitude'] = longitude
+        doc['location_type'] = 'coordinates'
+    return doc
+
+
+def _newer_fix_update(doc):
+    """Update pipeline that merges doc in unless the stored fix is newer"""
+    return [{'$replaceWith': {'$cond': [
+        {'$gt': [{'$ifNull': ['$timestamp', datetime(1970, 1, 1)]}, doc['timestamp']]},
+        '$$ROOT',
+        {'$mergeObjects': ['$$ROOT', {'$literal': doc}]}
+    ]}}]
+
+
+def write_delivery_locations(db, entries):
+    """
+    Upsert delivery_location documents with one bulk_write per target collection.
+
+    entries are (delivery_location doc, partner name) pairs with distinct
+    (qr_id, user_email). A stored fix is never replaced by an older one.
+    The first fix from a partner for a QR is counted in the partner rollups.
+    Returns one True/False (written) per entry.
+    """
+    from pymongo import UpdateOne
+
+    written = [False] * len(entries)
+
+    # Group upserts by target collection (one in shipments mode, one per QR in per_qr mode)
+    batches = {}
+    for position, (doc, _) in enumerate(entries):
+        collection, scope = qr_bulk_target(db, doc['qr_id'])
+        operation = UpdateOne(
+            dict(scope, type='delivery_location', user_email=doc['user_email']),
+            _newer_fix_update(doc),
+            upsert=True
+        )
+        batch = batches.setdefault(collection.name, (collection, [], []))
+        batch[1].append(operation)
+        batch[2].append(position)
+
+    first_fixes = []
+    for collection, operations, positions in batches.values():
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            for position in positions:
+                written[position] = True
+            first_fixes += [positions[op_index] for op_index in result.upserted_ids]
+        except Exception as e:
+            logger.error(f"Bulk location write to {collection.name} failed: {str(e)}")
+
+    bump_qr_versions(db, [entries[position][0]['qr_id'] for position, ok in enumerate(written) if ok])
+    record_positions(db, [entries[position][0] for position, ok in enumerate(written) if ok])
+
+    # First fix from a partner for a QR - count it as one of their orders
+    if first_fixes:
+        qr_ids = list({entries[position][0]['qr_id'] for position in first_fixes})
+        company_ids = {
+            location['qr_id']: location.get('company_id')
+            for location in db.get_collection('locations').find({'qr_id': {'$in': qr_ids}}, {'qr_id': 1, 'company_id': 1})
+        }
+        for position in first_fixes:
+            doc, partner_name = entries[position]
+            if doc['qr_id'] in company_ids:
+                record_partner_assigned(db, company_ids[doc['qr_id']], doc['user_email'], partner_name)
+
+    return written
+
+
+def apply_location_batch(db, fixes):
+    """
+    Validate, dedupe and store a batch of fixes.
+
+    Returns (results, summary): one {'index', 'status'[, 'error']} per input
+    fix, and counts per status.
+    """
+    results = [None] * len(fixes)
+    latest = {}  # (qr_id, user_email) -> index of the newest fix
+    seen = set()
+    valid = {}
+
+    for index, raw_fix in enumerate(fixes):
+        fix, error = validate_fix(raw_fix)
+        if error:
+            results[index] = {'index': index, 'status': REJECTED, 'error': error}
+            continue
+
+        identity = (fix['qr_id'], fix['user_email'], fix['timestamp'], fix['latitude'], fix['longitude'])
+        if identity in seen:
+            results[index] = {'index': index, 'status': DUPLICATE}
+            continue
+        seen.add(identity)
+        valid[index] = fix
+
+        key = (fix['qr_id'], fix['user_email'])
+        if key not in latest or fix['timestamp'] >= valid[latest[key]]['timestamp']:
+            latest[key] = index
+
+    latest_indexes = set(latest.values())
+    for index in valid:
+        if index not in latest_indexes:
+            results[index] = {'index': index, 'status': SUPERSEDED}
+
+    if latest:
+        partners = partner_cache.get_many(fix['user_email'] for fix in valid.values())
+
+        ordered_indexes = list(latest_indexes)
+        entries = []
+        for index in ordered_indexes:
+            fix = valid[index]
+            partner = partners.get(fix['user_email']) or {}
+            entries.append((
+                _delivery_location_doc(fix, partner),
+                partner.get('name') or fix['delivery_partner_name'] or 'Unknown Partner'
+            ))
+
+        for index, (doc, _), stored in zip(ordered_indexes, entries, write_delivery_locations(db, entries)):
+            if stored:
+                results[index] = {'index': index, 'status': STORED}
+                publish_location(doc)
+            else:
+                results[index] = {'index': index, 'status': REJECTED, 'error': 'Failed to store location'}
+
+    record_fixes(db, [
+        (fix['qr_id'], fix['user_email'], fix['latitude'], fix['longitude'], fix['timestamp'])
+        for index, fix in valid.items()
+        if not fix['role_only'] and results[index]['status'] != REJECTED
+    ])
+
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    for status, count in summary.items():
+        metrics.inc('live_location_batch_fixes_total', count, status=status)
+
+    return results, summary
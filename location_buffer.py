@@ -0,0 +1,166 @@
+"""
+Write-behind buffer for live location fixes.
+
+Most delivery_location upserts are overwritten by the same partner's next
+fix a few seconds later. With LOCATION_WRITE_BEHIND=true, store_live_location
+hands its document to this buffer instead of writing it on the request
+thread. The buffer keeps only the newest fix per (qr_id, partner) and a
+background thread flushes it with write_delivery_locations (one bulk_write
+per target collection):
+- every LOCATION_FLUSH_INTERVAL_SECONDS (default 2), or
+- as soon as LOCATION_FLUSH_MAX_PENDING (default 200) fixes are pending.
+
+Trail points (see location_trail) are buffered too, but every one of them
+is kept. Pending fixes are flushed at interpreter exit, which covers a
+graceful gunicorn worker shutdown; fixes buffered when a worker is killed
+outright are lost, so readers can lag by up to one flush interval.
+
+Metrics: live_location_buffer_received_total, _written_total,
+_coalescing_ratio, _pending, _flush_seconds, _flush_failures_total.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+
+import metrics
+import mongo_pool
+from location_trail import record_fixes
+from live_location import write_delivery_locations
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.environ.get('LOCATION_WRITE_BEHIND', 'false').lower() == 'true'
+FLUSH_INTERVAL_SECONDS = float(os.environ.get('LOCATION_FLUSH_INTERVAL_SECONDS', '2'))
+FLUSH_MAX_PENDING = int(os.environ.get('LOCATION_FLUSH_MAX_PENDING', '200'))
+
+
+def write_behind_enabled():
+    """Return True when store_live_location should buffer instead of writing"""
+    return WRITE_BEHIND_ENABLED
+
+
+class LocationWriteBuffer:
+    """Coalesces delivery_location upserts per (qr_id, partner) and flushes them in bulk"""
+
+    def __init__(self, get_database, interval=FLUSH_INTERVAL_SECONDS, max_pending=FLUSH_MAX_PENDING):
+        self.get_database = get_database
+        self.interval = interval
+        self.max_pending = max_pending
+        self.received = 0
+        self.written = 0
+        self._reset()
+
+    def _reset(self):
+        self._pending = {}  # (qr_id, user_email) -> (doc, partner_name)
+        self._trail = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Started lazily so a preloaded master never owns the flusher thread
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='location-write-behind', daemon=True)
+            self._thread.start()
+
+    def add(self, doc, partner_name, trail_point=None):
+        """Queue a delivery_location doc (replacing an older pending one) and an optional trail point"""
+        key = (doc['qr_id'], doc['user_email'])
+        with self._lock:
+            self._ensure_thread()
+            self.received += 1
+            current = self._pending.get(key)
+            if current is None or current[0]['timestamp'] <= doc['timestamp']:
+                self._pending[key] = (doc, partner_name)
+            if trail_point:
+                self._trail.append(trail_point)
+            pending = len(self._pending)
+
+        metrics.inc('live_location_buffer_received_total')
+        metrics.set_gauge('live_location_buffer_pending', pending)
+        if pending >= self.max_pending:
+            self._wakeup.set()
+
+    def add_trail_point(self, trail_point):
+        """Queue a trail point without a delivery_location update"""
+        with self._lock:
+            self._ensure_thread()
+            self._trail.append(trail_point)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Location write-behind flush failed: {str(e)}")
+
+    def flush(self):
+        """Write everything pending; failed fixes are put back for the next flush"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                trail, self._trail = self._trail, []
+            if not pending and not trail:
+                return 0
+
+            started = time.perf_counter()
+            entries = list(pending.values())
+            try:
+                db = self.get_database()
+                written = write_delivery_locations(db, entries) if entries else []
+                record_fixes(db, trail)
+            except Exception as e:
+                logger.error(f"Location write-behind flush failed: {str(e)}")
+                written = [False] * len(entries)
+
+            failed = [entry for entry, ok in zip(entries, written) if not ok]
+            if failed:
+                metrics.inc('live_location_buffer_flush_failures_total')
+                with self._lock:
+                    for doc, partner_name in failed:
+                        key = (doc['qr_id'], doc['user_email'])
+                        current = self._pending.get(key)
+                        if current is None or current[0]['timestamp'] < doc['timestamp']:
+                            self._pending[key] = (doc, partner_name)
+
+            written_count = len(entries) - len(failed)
+            with self._lock:
+                self.written += written_count
+                ratio = self.received / self.written if self.written else 0
+                pending_count = len(self._pending)
+
+            metrics.inc('live_location_buffer_written_total', written_count)
+            metrics.observe('live_location_buffer_flush_seconds', time.perf_counter() - started)
+            metrics.set_gauge('live_location_buffer_coalescing_ratio', round(ratio, 2))
+            metrics.set_gauge('live_location_buffer_pending', pending_count)
+            return written_count
+
+
+buffer = LocationWriteBuffer(mongo_pool.get_database)
+
+
+def _reset_after_fork():
+    """A child starts with an empty buffer; the parent still owns (and flushes) its own"""
+    buffer._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
+
+
+def _flush_at_exit():
+    if WRITE_BEHIND_ENABLED and buffer._pid == os.getpid():
+        try:
+            flushed = buffer.flush()
+            logger.info(f"Flushed {flushed} buffered locations at shutdown")
+        except Exception as e:
+            logger.error(f"Failed to flush buffered locations at shutdown: {str(e)}")
+
+
+atexit.register(_flush_at_exit)
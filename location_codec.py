@@ -0,0 +1,202 @@
+"""
+Compact binary payload for location uploads.
+
+A JSON fix repeats user_email, qr_id, is_qr_tracking and role_only on every
+post. /store-live-location and /store-live-location/batch also accept
+Content-Type: application/vnd.tracksmart.fixes, a fixed-layout format that
+identifies the partner with the uplink_token returned at login and delta-
+encodes integer microdegree coordinates:
+
+    header   !B20sBH   version (1), uplink token, QR count, fix count
+    QR table           per QR: !B length + ASCII QR ID
+    base     !qii      epoch milliseconds, latitude and longitude in microdegrees
+    fix      !BBHhh    QR index, flags, +ms, +latitude, +longitude (vs the previous fix)
+    abs. fix !BBqii    same with FLAG_ABSOLUTE, for steps that overflow 16 bits
+
+The first fix is relative to the base. Decoded fixes are the same dicts the
+JSON endpoints receive, so they go through the same validation.
+
+The token is the partner's ObjectId plus a truncated HMAC (UPLINK_TOKEN_SECRET,
+defaulting to SESSION_SECRET), so it is checked without a database round trip;
+the partner's email, name and role are looked up once per worker and cached.
+"""
+import os
+import hmac
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+CONTENT_TYPE = 'application/vnd.tracksmart.fixes'
+VERSION = 1
+
+TOKEN_SECRET = os.environ.get(
+    'UPLINK_TOKEN_SECRET', os.environ.get('SESSION_SECRET', 'dev-secret-key-change-in-production')
+).encode()
+TOKEN_SIZE = 20  # 12-byte ObjectId + 8-byte signature
+
+FLAG_ROLE_ONLY = 0x01
+FLAG_ABSOLUTE = 0x02
+
+HEADER = struct.Struct('!B20sBH')
+BASE = struct.Struct('!qii')
+FIX = struct.Struct('!BBHhh')
+ABSOLUTE_FIX = struct.Struct('!BBqii')
+
+MICRODEGREES = 1000000
+
+# Partners whose email is cached per worker
+MAX_CACHED_PARTNERS = 10000
+
+
+class PayloadError(ValueError):
+    """Malformed binary payload or invalid uplink token"""
+
+
+def is_binary_payload(content_type):
+    """True if a request's Content-Type selects the binary format"""
+    return (content_type or '').split(';')[0].strip().lower() == CONTENT_TYPE
+
+
+def _signature(partner_id):
+    return hmac.new(TOKEN_SECRET, partner_id, hashlib.sha256).digest()[:TOKEN_SIZE - len(partner_id)]
+
+
+def issue_token(partner_id):
+    """Hex uplink token for a delivery partner's ObjectId (returned at login)"""
+    raw = bytes.fromhex(str(partner_id))
+    return (raw + _signature(raw)).hex()
+
+
+def verify_token(token):
+    """Partner ObjectId (hex) for a raw token, or None if the signature does not match"""
+    partner_id, signature = token[:12], token[12:]
+    if len(token) != TOKEN_SIZE or not hmac.compare_digest(signature, _signature(partner_id)):
+        return None
+    return partner_id.hex()
+
+
+def encode_fixes(token, fixes):
+    """
+    Encode fixes for one partner; token is the hex uplink token and fixes are
+    dicts with qr_id, latitude, longitude, timestamp (epoch ms) and role_only.
+    """
+    qr_ids = list(dict.fromkeys(str(fix['qr_id']) for fix in fixes))
+    parts = [HEADER.pack(VERSION, bytes.fromhex(token), len(qr_ids), len(fixes))]
+    for qr_id in qr_ids:
+        encoded = qr_id.encode('ascii')
+        parts.append(struct.pack('!B', len(encoded)) + encoded)
+
+    points = [
+        (int(fix['timestamp']), round((fix.get('latitude') or 0) * MICRODEGREES), round((fix.get('longitude') or 0) * MICRODEGREES))
+        for fix in fixes
+    ]
+    previous = points[0] if points else (0, 0, 0)
+    parts.append(BASE.pack(*previous))
+
+    qr_indexes = {qr_id: index for index, qr_id in enumerate(qr_ids)}
+    for fix, point in zip(fixes, points):
+        qr_index = qr_indexes[str(fix['qr_id'])]
+        flags = FLAG_ROLE_ONLY if fix.get('role_only') else 0
+        delta_ms, delta_lat, delta_lon = (point[0] - previous[0], point[1] - previous[1], point[2] - previous[2])
+        if 0 <= delta_ms <= 0xFFFF and -0x8000 <= delta_lat <= 0x7FFF and -0x8000 <= delta_lon <= 0x7FFF:
+            parts.append(FIX.pack(qr_index, flags, delta_ms, delta_lat, delta_lon))
+        else:
+            parts.append(ABSOLUTE_FIX.pack(qr_index, flags | FLAG_ABSOLUTE, *point))
+        previous = point
+
+    return b''.join(parts)
+
+
+def decode_fixes(payload, resolve_partner):
+    """
+    Decode a binary payload into JSON-shaped fix dicts.
+
+    resolve_partner(partner_id_hex) returns the partner's {'email', 'name',
+    'role'} or None. Raises PayloadError for malformed payloads and unknown
+    tokens.
+    """
+    try:
+        version, token, qr_count, fix_count = HEADER.unpack_from(payload, 0)
+        if version != VERSION:
+            raise PayloadError(f'Unsupported payload version {version}')
+
+        partner_id = verify_token(token)
+        partner = resolve_partner(partner_id) if partner_id else None
+        if not partner:
+            raise PayloadError('Invalid uplink token')
+
+        offset = HEADER.size
+        qr_ids = []
+        for _ in range(qr_count):
+            length = payload[offset]
+            qr_ids.append(payload[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+
+        timestamp, latitude, longitude = BASE.unpack_from(payload, offset)
+        offset += BASE.size
+
+        fixes = []
+        for _ in range(fix_count):
+            flags = payload[offset + 1]
+            if flags & FLAG_ABSOLUTE:
+                qr_index, flags, timestamp, latitude, longitude = ABSOLUTE_FIX.unpack_from(payload, offset)
+                offset += ABSOLUTE_FIX.size
+            else:
+                qr_index, flags, delta_ms, delta_lat, delta_lon = FIX.unpack_from(payload, offset)
+                offset += FIX.size
+                timestamp += delta_ms
+                latitude += delta_lat
+                longitude += delta_lon
+
+            role_only = bool(flags & FLAG_ROLE_ONLY)
+            fixes.append({
+                'qr_id': qr_ids[qr_index],
+                'user_email': partner['email'],
+                'delivery_partner_name': partner.get('name'),
+                'role': partner.get('role'),
+                'latitude': None if role_only else latitude / MICRODEGREES,
+                'longitude': None if role_only else longitude / MICRODEGREES,
+                'timestamp': timestamp,
+                'role_only': role_only,
+                'is_qr_tracking': True
+            })
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise PayloadError(f'Malformed location payload: {str(e)}')
+
+    if offset != len(payload):
+        raise PayloadError('Trailing bytes after location payload')
+    return fixes
+
+
+class PartnerDirectory:
+    """Per-worker LRU of partner ObjectId -> {'email', 'name', 'role'} for token lookups"""
+
+    def __init__(self, max_size=MAX_CACHED_PARTNERS):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._partners = OrderedDict()
+
+    def resolver(self, db):
+        """resolve_partner callable for decode_fixes backed by the delivery_partners collection"""
+        def resolve(partner_id):
+            with self._lock:
+                if partner_id in self._partners:
+                    self._partners.move_to_end(partner_id)
+                    return self._partners[partner_id]
+
+            from bson import ObjectId
+            partner = db.get_collection('delivery_partners').find_one(
+                {'_id': ObjectId(partner_id)}, {'_id': 0, 'email': 1, 'name': 1, 'role': 1}
+            )
+            if partner and partner.get('email'):
+                with self._lock:
+                    self._partners[partner_id] = partner
+                    if len(self._partners) > self.max_size:
+                        self._partners.popitem(last=False)
+                return partner
+            return None
+        return resolve
+
+
+partner_directory = PartnerDirectory()
@@ -0,0 +1,112 @@
+"""
+Movement dead-band for live location writes.
+
+A partner waiting at a pickup point keeps sending the same coordinates every
+few seconds, and each one used to be a delivery_location upsert, a trail
+point and a tracking event. With LOCATION_DEADBAND_METERS > 0, a coordinate
+fix that is closer than that many meters (haversine) to the partner's last
+accepted fix for the QR, and arrives within LOCATION_DEADBAND_SECONDS
+(default 30) of it, is suppressed:
+- LOCATION_DEADBAND_MODE=drop (default) - nothing is written
+- LOCATION_DEADBAND_MODE=refresh - only the stored timestamp moves forward
+
+Role-only updates and switches between role-only and coordinates always go
+through. The last accepted fix per (qr_id, partner) is kept in a per-worker
+LRU of LOCATION_DEADBAND_MAX_KEYS entries; a partner whose fixes land on
+several workers is just filtered less.
+
+Metrics: location_deadband_accepted_total, location_deadband_suppressed_total{action}.
+"""
+import os
+import math
+import threading
+from collections import OrderedDict
+
+import metrics
+import mongo_pool
+
+DEADBAND_METERS = float(os.environ.get('LOCATION_DEADBAND_METERS', '0'))
+DEADBAND_SECONDS = float(os.environ.get('LOCATION_DEADBAND_SECONDS', '30'))
+DEADBAND_MODE = os.environ.get('LOCATION_DEADBAND_MODE', 'drop').lower()
+MAX_KEYS = int(os.environ.get('LOCATION_DEADBAND_MAX_KEYS', '10000'))
+
+EARTH_RADIUS_METERS = 6371000
+
+ACCEPT = 'accept'
+REFRESH = 'refresh'
+DROP = 'drop'
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class DeadBandFilter:
+    """Last accepted fix per (qr_id, partner) and the accept / suppress decision"""
+
+    def __init__(self, meters=DEADBAND_METERS, seconds=DEADBAND_SECONDS, mode=DEADBAND_MODE, max_keys=MAX_KEYS):
+        self.meters = meters
+        self.seconds = seconds
+        self.mode = REFRESH if mode == REFRESH else DROP
+        self.max_keys = max_keys
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._last = OrderedDict()  # (qr_id, user_email) -> (latitude, longitude, timestamp), least recently used first
+
+    @property
+    def enabled(self):
+        return self.meters > 0
+
+    def apply(self, doc):
+        """
+        Decide what to do with a delivery_location doc.
+
+        Returns (ACCEPT, doc), (DROP, None) or (REFRESH, doc) where the
+        refreshed doc keeps the last accepted coordinates.
+        """
+        if not self.enabled:
+            return ACCEPT, doc
+
+        key = (doc['qr_id'], doc['user_email'])
+        with self._lock:
+            if doc.get('location_type') != 'coordinates':
+                # State change (role-only) - always written; the next coordinate fix starts a new band
+                self._last.pop(key, None)
+                return ACCEPT, doc
+
+            last = self._last.get(key)
+            if last is not None:
+                self._last.move_to_end(key)
+                latitude, longitude, accepted_at = last
+                elapsed = (doc['timestamp'] - accepted_at).total_seconds()
+                moved = haversine_meters(latitude, longitude, doc['latitude'], doc['longitude'])
+                if moved < self.meters and elapsed < self.seconds:
+                    metrics.inc('location_deadband_suppressed_total', action=self.mode)
+                    if self.mode == DROP:
+                        return DROP, None
+                    return REFRESH, dict(doc, latitude=latitude, longitude=longitude)
+
+            self._last[key] = (doc['latitude'], doc['longitude'], doc['timestamp'])
+            self._last.move_to_end(key)
+            if len(self._last) > self.max_keys:
+                self._last.popitem(last=False)
+
+        metrics.inc('location_deadband_accepted_total')
+        return ACCEPT, doc
+
+
+dead_band = DeadBandFilter()
+
+
+def _reset_after_fork():
+    dead_band._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
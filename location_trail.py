@@ -0,0 +1,140 @@
+"""
+Append-only location trail for QR tracking.
+
+store_live_location only keeps the latest delivery_location per partner.
+With LOCATION_TRAIL=true every coordinate fix is also appended to the
+`location_trail` time-series collection (MongoDB 5.0+), which buckets and
+compresses points per (qr_id, partner) and expires them after
+LOCATION_TRAIL_RETENTION_DAYS.
+
+Document shape: {'timestamp': datetime, 'meta': {'qr_id', 'user_email'},
+'latitude', 'longitude'}
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+TRAIL_COLLECTION = 'location_trail'
+
+TRAIL_ENABLED = os.environ.get('LOCATION_TRAIL', 'false').lower() == 'true'
+TRAIL_RETENTION_DAYS = float(os.environ.get('LOCATION_TRAIL_RETENTION_DAYS', '30'))
+
+# Upper bound on points returned by one trail request
+MAX_TRAIL_POINTS = 5000
+
+
+def trail_enabled():
+    """Return True when live fixes are appended to the trail collection"""
+    return TRAIL_ENABLED
+
+
+def ensure_trail_collection(db):
+    """Create the time-series collection (or update its retention) and its meta index"""
+    retention_seconds = int(TRAIL_RETENTION_DAYS * 86400)
+
+    if TRAIL_COLLECTION in db.list_collection_names(filter={'name': TRAIL_COLLECTION}):
+        db.command('collMod', TRAIL_COLLECTION, expireAfterSeconds=retention_seconds)
+    else:
+        db.create_collection(
+            TRAIL_COLLECTION,
+            timeseries={'timeField': 'timestamp', 'metaField': 'meta', 'granularity': 'seconds'},
+            expireAfterSeconds=retention_seconds
+        )
+        logger.info(f"Created time-series collection {TRAIL_COLLECTION} ({TRAIL_RETENTION_DAYS} day retention)")
+
+    db.get_collection(TRAIL_COLLECTION).create_index(
+        [('meta.qr_id', 1), ('meta.user_email', 1), ('timestamp', 1)],
+        name='qr_id_user_email_timestamp'
+    )
+
+
+def record_fix(db, qr_id, user_email, latitude, longitude, when=None):
+    """Append one coordinate fix to the trail (no-op unless trail mode is on)"""
+    if not TRAIL_ENABLED:
+        return
+    try:
+        db.get_collection(TRAIL_COLLECTION).insert_one({
+            'timestamp': when or datetime.utcnow(),
+            'meta': {'qr_id': qr_id, 'user_email': user_email},
+            'latitude': latitude,
+            'longitude': longitude
+        })
+    except Exception as e:
+        logger.error(f"Failed to append trail point for QR {qr_id}: {str(e)}")
+
+
+def record_fixes(db, fixes):
+    """Append many fixes at once; fixes are (qr_id, user_email, latitude, longitude, when) tuples"""
+    if not TRAIL_ENABLED or not fixes:
+        return
+    try:
+        db.get_collection(TRAIL_COLLECTION).insert_many([
+            {
+                'timestamp': when or datetime.utcnow(),
+                'meta': {'qr_id': qr_id, 'user_email': user_email},
+                'latitude': latitude,
+                'longitude': longitude
+            }
+            for qr_id, user_email, latitude, longitude, when in fixes
+        ], ordered=False)
+    except Exception as e:
+        logger.error(f"Failed to append {len(fixes)} trail points: {str(e)}")
+
+
+def parse_time(value):
+    """Parse an ISO 8601 query parameter (a trailing Z is accepted) into a naive UTC datetime"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+    return parsed
+
+
+def get_trail(db, qr_id, start=None, end=None, interval_seconds=None, user_email=None, limit=MAX_TRAIL_POINTS):
+    """
+    Trail points for a QR code, oldest first.
+
+    Defaults to the last 24 hours. With interval_seconds the trail is
+    downsampled server-side to the last fix of each partner per interval.
+    """
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(hours=24)
+    limit = min(limit, MAX_TRAIL_POINTS)
+
+    match = {'meta.qr_id': qr_id, 'timestamp': {'$gte': start, '$lte': end}}
+    if user_email:
+        match['meta.user_email'] = user_email
+
+    pipeline = [{'$match': match}, {'$sort': {'timestamp': 1}}]
+    if interval_seconds:
+        pipeline += [
+            {'$group': {
+                '_id': {
+                    'user_email': '$meta.user_email',
+                    'bucket': {'$dateTrunc': {'date': '$timestamp', 'unit': 'second', 'binSize': interval_seconds}}
+                },
+                'timestamp': {'$last': '$timestamp'},
+                'latitude': {'$last': '$latitude'},
+                'longitude': {'$last': '$longitude'}
+            }},
+            {'$sort': {'timestamp': 1}}
+        ]
+    pipeline += [
+        {'$limit': limit},
+        {'$project': {
+            '_id': 0,
+            'timestamp': 1,
+            'latitude': 1,
+            'longitude': 1,
+            'user_email': {'$ifNull': ['$meta.user_email', '$_id.user_email']}
+        }}
+    ]
+
+    points = []
+    for point in db.get_collection(TRAIL_COLLECTION).aggregate(pipeline):
+        point['timestamp'] = point['timestamp'].isoformat()
+        points.append(point)
+    return points
@@ -0,0 +1,198 @@
+"""
+Long-lived location uplink for delivery partner clients.
+
+Instead of one HTTP POST per GPS fix, the scanner keeps a WebSocket open
+(/ws/location in delivery_app) and sends small JSON frames:
+
+    {"type": "hello", "user_email": ..., "delivery_partner_name": ..., "role": ...}
+    {"seq": 17, "qr_id": "4821", "latitude": 12.97, "longitude": 77.59, "timestamp": 1718000000000}
+
+Identity is sent once in the hello frame and merged into every location
+frame. Fixes are acknowledged in batches - after UPLINK_ACK_BATCH frames or
+UPLINK_ACK_INTERVAL_MS, whichever comes first - with
+
+    {"type": "ack", "seq": <highest seq in the batch>, "count": n, "rejected": [...], "failed": [...]}
+
+Clients resend the seqs listed in "failed" (the write did not reach MongoDB).
+Each batch keeps only the newest fix per QR for the delivery_location
+upsert; every coordinate fix outside the movement dead band (see
+location_dead_band) still goes to the location trail.
+"""
+import os
+import json
+import time
+import logging
+
+import metrics
+from live_location import validate_fix, write_delivery_locations
+from location_trail import record_fixes
+from location_buffer import buffer as location_buffer, write_behind_enabled
+from location_dead_band import dead_band, ACCEPT, DROP
+from tracking_events import publish_location
+
+logger = logging.getLogger(__name__)
+
+ACK_BATCH_SIZE = int(os.environ.get('UPLINK_ACK_BATCH', '10'))
+ACK_INTERVAL_SECONDS = int(os.environ.get('UPLINK_ACK_INTERVAL_MS', '1000')) / 1000.0
+
+# Longest a connection may stay silent before the server closes it
+IDLE_TIMEOUT_SECONDS = float(os.environ.get('UPLINK_IDLE_TIMEOUT_SECONDS', '120'))
+
+IDENTITY_FIELDS = ('user_email', 'delivery_partner_name', 'role')
+
+
+class UplinkSession:
+    """Protocol state for one uplink connection, independent of the WebSocket library"""
+
+    def __init__(self, get_database, build_location_doc, ack_batch=ACK_BATCH_SIZE, ack_interval=ACK_INTERVAL_SECONDS):
+        self.get_database = get_database
+        self.build_location_doc = build_location_doc
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.identity = {}
+        self.pending = []  # (seq, normalized fix)
+        self.rejected = []
+        self.last_seq = None
+        self.batch_started = None
+
+    def seconds_until_ack(self):
+        """How long the connection may wait for the next frame before the pending batch is due"""
+        if self.batch_started is None:
+            return None
+        return max(self.batch_started + self.ack_interval - time.monotonic(), 0)
+
+    def receive(self, message):
+        """Handle one text frame; returns a reply frame (str) or None"""
+        metrics.inc('uplink_frames_total')
+        try:
+            frame = json.loads(message)
+        except (TypeError, ValueError):
+            return json.dumps({'type': 'error', 'error': 'Frames must be JSON'})
+        if not isinstance(frame, dict):
+            return json.dumps({'type': 'error', 'error': 'Frames must be JSON objects'})
+
+        if frame.get('type') == 'hello':
+            self.identity = {field: frame[field] for field in IDENTITY_FIELDS if frame.get(field)}
+            return json.dumps({
+                'type': 'welcome',
+                'ack_batch': self.ack_batch,
+                'ack_interval_ms': int(self.ack_interval * 1000)
+            })
+
+        seq = frame.get('seq')
+        fix, error = validate_fix(dict(self.identity, **frame))
+        if error:
+            self.rejected.append({'seq': seq, 'error': error})
+        else:
+            self.pending.append((seq, fix))
+        self.last_seq = seq
+
+        if self.batch_started is None:
+            self.batch_started = time.monotonic()
+        if len(self.pending) + len(self.rejected) >= self.ack_batch:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Store the pending batch and return its ack frame (None if nothing is pending)"""
+        if not self.pending and not self.rejected:
+            return None
+
+        pending, self.pending = self.pending, []
+        rejected, self.rejected = self.rejected, []
+        self.batch_started = None
+        failed = []
+
+        if pending:
+            failed = self._store(pending)
+
+        metrics.inc('uplink_fixes_total', len(pending) - len(failed), status='stored')
+        if rejected:
+            metrics.inc('uplink_fixes_total', len(rejected), status='rejected')
+        if failed:
+            metrics.inc('uplink_fixes_total', len(failed), status='failed')
+
+        return json.dumps({
+            'type': 'ack',
+            'seq': self.last_seq,
+            'count': len(pending) - len(failed),
+            'rejected': rejected,
+            'failed': failed
+        })
+
+    def _store(self, pending):
+        """Write a batch; returns the seqs that could not be stored"""
+        newest = {}  # (qr_id, user_email) -> (seq, fix, doc)
+        trail = []
+        for seq, fix in pending:
+            decision, doc = dead_band.apply(self.build_location_doc(fix))
+            if decision == DROP:
+                continue  # stationary - acknowledged without a write
+            key = (fix['qr_id'], fix['user_email'])
+            if key not in newest or newest[key][1]['timestamp'] <= fix['timestamp']:
+                newest[key] = (seq, fix, doc)
+            if decision == ACCEPT and doc.get('location_type') == 'coordinates':
+                trail.append((fix['qr_id'], fix['user_email'], fix['latitude'], fix['longitude'], fix['timestamp']))
+
+        entries = [(doc, fix.get('delivery_partner_name') or 'Unknown') for _, fix, doc in newest.values()]
+
+        if write_behind_enabled():
+            for doc, partner_name in entries:
+                location_buffer.add(doc, partner_name)
+            for point in trail:
+                location_buffer.add_trail_point(point)
+            written = [True] * len(entries)
+        else:
+            try:
+                db = self.get_database()
+                written = write_delivery_locations(db, entries)
+                record_fixes(db, trail)
+            except Exception as e:
+                logger.error(f"Uplink batch write failed: {str(e)}")
+                written = [False] * len(entries)
+
+        failed_keys = set()
+        for (key, (_, _, doc)), ok in zip(newest.items(), written):
+            if ok:
+                publish_location(doc)
+            else:
+                failed_keys.add(key)
+
+        # Only the newest fix per key was written, so a failed key fails every fix it replaced
+        return [seq for seq, fix in pending if (fix['qr_id'], fix['user_email']) in failed_keys]
+
+
+def serve(ws, session, idle_timeout=IDLE_TIMEOUT_SECONDS):
+    """
+    Run an uplink session over a connection with receive(timeout=...) and
+    send() (flask-sock / simple-websocket). Returns when the client goes
+    away or stays idle for idle_timeout seconds.
+    """
+    metrics.inc('uplink_connections_total')
+    last_frame_at = time.monotonic()
+    try:
+        while True:
+            wait = session.seconds_until_ack()
+            message = ws.receive(timeout=wait if wait is not None else idle_timeout)
+
+            if message is None:
+                ack = session.flush()
+                if ack:
+                    ws.send(ack)
+                elif time.monotonic() - last_frame_at >= idle_timeout:
+                    return
+                continue
+
+            last_frame_at = time.monotonic()
+            reply = session.receive(message)
+            if reply:
+                ws.send(reply)
+    except Exception as e:
+        # The client closed the socket (ConnectionClosed) or the network dropped
+        logger.info(f"Location uplink closed: {str(e) or e.__class__.__name__}")
+    finally:
+        # Store whatever arrived after the last ack; the client will not see an ack for it
+        try:
+            session.flush()
+        except Exception as e:
+            logger.error(f"Failed to store final uplink batch: {str(e)}")
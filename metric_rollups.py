@@ -0,0 +1,190 @@
+"""
+Daily metric rollups for delivery partners and companies.
+
+The write paths (activate_qr, store_live_location, mark_delivered) bump
+per-day counters as they happen, so employee analytics read a handful of
+precomputed documents instead of rescanning every company QR code. Each
+record_* call also bumps the company's change version (see change_versions),
+which invalidates the ETags of its order and employee lists.
+
+Collections:
+- partner_daily_metrics: one document per (company, partner email, day)
+- company_daily_metrics: one document per (company, day)
+
+Counters kept on both: orders, completions, deliver_seconds_total,
+on_time, rating_total, rating_count.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+from change_versions import bump_versions, company_scope
+
+logger = logging.getLogger(__name__)
+
+PARTNER_METRICS_COLLECTION = 'partner_daily_metrics'
+COMPANY_METRICS_COLLECTION = 'company_daily_metrics'
+
+# A delivery counts as on time when it completes within this many hours of QR activation
+ON_TIME_DELIVERY_HOURS = float(os.environ.get('ON_TIME_DELIVERY_HOURS', '24'))
+
+# Read indexes for the rollup collections (created at startup by db_indexes)
+ROLLUP_INDEXES = [
+    (PARTNER_METRICS_COLLECTION, [('company_id', 1), ('partner_email', 1), ('date', -1)], {'name': 'company_partner_date'}),
+    (COMPANY_METRICS_COLLECTION, [('company_id', 1), ('date', -1)], {'name': 'company_date'}),
+]
+
+
+def _day(when=None):
+    return (when or datetime.utcnow()).strftime('%Y-%m-%d')
+
+
+def _bump_company(db, company_id, counters, when=None):
+    date = _day(when)
+    db.get_collection(COMPANY_METRICS_COLLECTION).update_one(
+        {'_id': f"{company_id}:{date}"},
+        {'$inc': counters, '$setOnInsert': {'company_id': company_id, 'date': date}},
+        upsert=True
+    )
+
+
+def _bump_partner(db, company_id, partner_email, partner_name, counters, when=None):
+    date = _day(when)
+    db.get_collection(PARTNER_METRICS_COLLECTION).update_one(
+        {'_id': f"{company_id}:{partner_email}:{date}"},
+        {
+            '$inc': counters,
+            '$set': {'partner_name': partner_name},
+            '$setOnInsert': {'company_id': company_id, 'partner_email': partner_email, 'date': date}
+        },
+        upsert=True
+    )
+
+
+def record_order_created(db, company_id, when=None):
+    """Count a newly activated QR code as a company order"""
+    if company_id is None:
+        return
+    try:
+        _bump_company(db, company_id, {'orders': 1}, when)
+        bump_versions(db, [company_scope(company_id)])
+    except Exception as e:
+        logger.error(f"Failed to record order rollup for company {company_id}: {str(e)}")
+
+
+def record_partner_assigned(db, company_id, partner_email, partner_name, when=None):
+    """Count an order for a partner the first time they report a location for it"""
+    if company_id is None or not partner_email:
+        return
+    try:
+        _bump_partner(db, company_id, partner_email, partner_name, {'orders': 1}, when)
+        bump_versions(db, [company_scope(company_id)])
+    except Exception as e:
+        logger.error(f"Failed to record partner rollup for {partner_email}: {str(e)}")
+
+
+def record_delivery_completed(db, company_id, partner_email, partner_name, started_at, delivered_at, rating=None):
+    """Count a completed delivery with its time-to-deliver and on-time flag"""
+    if company_id is None:
+        return
+    try:
+        counters = {'completions': 1}
+
+        if started_at and delivered_at and delivered_at >= started_at:
+            deliver_seconds = (delivered_at - started_at).total_seconds()
+            counters['deliver_seconds_total'] = deliver_seconds
+            counters['timed_completions'] = 1
+            if deliver_seconds <= ON_TIME_DELIVERY_HOURS * 3600:
+                counters['on_time'] = 1
+
+        if isinstance(rating, (int, float)):
+            counters['rating_total'] = rating
+            counters['rating_count'] = 1
+
+        _bump_company(db, company_id, counters, delivered_at)
+        if partner_email:
+            _bump_partner(db, company_id, partner_email, partner_name, counters, delivered_at)
+        bump_versions(db, [company_scope(company_id)])
+
+    except Exception as e:
+        logger.error(f"Failed to record delivery rollup for company {company_id}: {str(e)}")
+
+
+def _summarize(collection, match):
+    """Sum every counter over the matching daily documents"""
+    rows = list(collection.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': None,
+            'orders': {'$sum': '$orders'},
+            'completions': {'$sum': '$completions'},
+            'on_time': {'$sum': '$on_time'},
+            'deliver_seconds_total': {'$sum': '$deliver_seconds_total'},
+            'timed_completions': {'$sum': '$timed_completions'},
+            'rating_total': {'$sum': '$rating_total'},
+            'rating_count': {'$sum': '$rating_count'}
+        }}
+    ]))
+    totals = rows[0] if rows else {}
+    totals.pop('_id', None)
+    return totals
+
+
+def compute_rates(totals):
+    """Turn summed counters into the rates shown on the analytics page"""
+    orders = totals.get('orders', 0)
+    completions = totals.get('completions', 0)
+    rating_count = totals.get('rating_count', 0)
+    timed_completions = totals.get('timed_completions', 0)
+
+    completion_rate = (completions / orders) * 100 if orders > 0 else 0
+    on_time_rate = (totals.get('on_time', 0) / completions) * 100 if completions > 0 else 0
+    avg_rating = totals.get('rating_total', 0) / rating_count if rating_count > 0 else 0
+    avg_delivery_minutes = (totals.get('deliver_seconds_total', 0) / timed_completions) / 60 if timed_completions > 0 else 0
+
+    return {
+        'avg_rating': round(avg_rating, 1),
+        'completion_rate': round(completion_rate, 1),
+        'on_time_rate': round(on_time_rate, 1),
+        'avg_delivery_minutes': round(avg_delivery_minutes, 1),
+        'performance_score': round((completion_rate + on_time_rate + (avg_rating * 20)) / 3, 1)
+    }
+
+
+def get_partner_summary(db, company_id, partner_email):
+    """All-time counters for one partner within a company"""
+    return _summarize(
+        db.get_collection(PARTNER_METRICS_COLLECTION),
+        {'company_id': company_id, 'partner_email': partner_email}
+    )
+
+
+def get_company_summary(db, company_id):
+    """All-time counters for a company"""
+    return _summarize(db.get_collection(COMPANY_METRICS_COLLECTION), {'company_id': company_id})
+
+
+def get_partner_daily(db, company_id, partner_email, days=7):
+    """Per-day counters for the last `days` days, newest first, with empty days filled in"""
+    today = datetime.utcnow()
+    dates = [_day(today - timedelta(days=i)) for i in range(days)]
+
+    docs = db.get_collection(PARTNER_METRICS_COLLECTION).find({
+        'company_id': company_id,
+        'partner_email': partner_email,
+        'date': {'$gte': dates[-1]}
+    })
+    by_date = {doc['date']: doc for doc in docs}
+
+    daily = []
+    for date in dates:
+        doc = by_date.get(date, {})
+        rating_count = doc.get('rating_count', 0)
+        daily.append({
+            'date': date,
+            'orders': doc.get('orders', 0),
+            'completions': doc.get('completions', 0),
+            'rating': round(doc.get('rating_total', 0) / rating_count, 1) if rating_count > 0 else 0,
+            'on_time': doc.get('on_time', 0)
+        })
+    return daily
@@ -0,0 +1,77 @@
+"""
+In-process metrics registry shared by the TrackSmart services.
+
+Counters, gauges and simple summaries (count / sum / max) are kept per
+worker process and exposed by each app at /api/metrics as JSON, or in the
+Prometheus text format with ?format=prometheus.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Increment a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to the current value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Record one observation (e.g. a latency) in a summary"""
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.setdefault(key, {'count': 0, 'sum': 0.0, 'max': 0.0})
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+
+def get_counter(name, **labels):
+    """Current value of a counter (0 if never incremented)"""
+    return _counters.get(_key(name, labels), 0)
+
+
+def _format_name(name, labels):
+    if not labels:
+        return name
+    label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{label_text}}}"
+
+
+def snapshot():
+    """All metrics as a JSON-serializable dict"""
+    with _lock:
+        return {
+            'counters': {_format_name(name, labels): value for (name, labels), value in _counters.items()},
+            'gauges': {_format_name(name, labels): value for (name, labels), value in _gauges.items()},
+            'summaries': {_format_name(name, labels): dict(summary) for (name, labels), summary in _summaries.items()}
+        }
+
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{_format_name(name, labels)} {value}")
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(f"{_format_name(name, labels)} {value}")
+        for (name, labels), summary in sorted(_summaries.items()):
+            lines.append(f"{_format_name(name + '_count', labels)} {summary['count']}")
+            lines.append(f"{_format_name(name + '_sum', labels)} {summary['sum']}")
+            lines.append(f"{_format_name(name + '_max', labels)} {summary['max']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,211 @@
+"""
+Process-wide MongoDB connection manager shared by all TrackSmart services.
+
+Each gunicorn worker process lazily creates exactly one MongoClient (with its
+own connection pool) and reuses it for every request. The client is
+recreated after a fork, so a client inherited from a parent process is
+never reused in a child.
+
+Connection health is tracked from the driver's background server heartbeats
+instead of sending a ping on the request path. Heartbeats and command
+network errors also drive the data-layer circuit breaker (see
+circuit_breaker), so requests fail fast while MongoDB is unreachable.
+
+Configuration (environment variables):
+- MONGODB_URI
+- MONGO_MAX_POOL_SIZE (default 50), MONGO_MIN_POOL_SIZE (default 0)
+- MONGO_MAX_IDLE_TIME_MS (default 60000)
+- MONGO_SERVER_SELECTION_TIMEOUT_MS (default 5000)
+- MONGO_CONNECT_TIMEOUT_MS (default 5000), MONGO_SOCKET_TIMEOUT_MS (default 20000)
+- MONGO_WAIT_QUEUE_TIMEOUT_MS (default 5000)
+- MONGO_HEARTBEAT_FREQUENCY_MS (default 10000)
+- MONGO_READ_PREFERENCE (default primaryPreferred)
+- DB_BREAKER_* (see circuit_breaker.breaker_from_env)
+"""
+import os
+import logging
+import threading
+from datetime import datetime
+
+from circuit_breaker import breaker_from_env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MONGODB_URI = 'mongodb+srv://in:in@in.hfxejxb.mongodb.net/?retryWrites=true&w=majority&appName=in'
+DATABASE_NAME = 'tracksmart'
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+# Errors reported on CommandFailedEvent that mean the server could not be reached
+NETWORK_ERROR_TYPES = ('AutoReconnect', 'ConnectionFailure', 'NetworkTimeout', 'NotPrimaryError', 'ServerSelectionTimeoutError')
+
+breaker = breaker_from_env('mongodb')
+
+_health = {
+    'state': 'unknown',  # 'unknown' until the first heartbeat, then 'up' or 'down'
+    'last_heartbeat_at': None,
+    'last_error': None,
+    'servers': {}
+}
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def client_options():
+    """MongoClient keyword arguments built from the environment"""
+    return {
+        'maxPoolSize': _env_int('MONGO_MAX_POOL_SIZE', 50),
+        'minPoolSize': _env_int('MONGO_MIN_POOL_SIZE', 0),
+        'maxIdleTimeMS': _env_int('MONGO_MAX_IDLE_TIME_MS', 60000),
+        'serverSelectionTimeoutMS': _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        'connectTimeoutMS': _env_int('MONGO_CONNECT_TIMEOUT_MS', 5000),
+        'socketTimeoutMS': _env_int('MONGO_SOCKET_TIMEOUT_MS', 20000),
+        'waitQueueTimeoutMS': _env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
+        'heartbeatFrequencyMS': _env_int('MONGO_HEARTBEAT_FREQUENCY_MS', 10000),
+        'readPreference': os.environ.get('MONGO_READ_PREFERENCE', 'primaryPreferred'),
+    }
+
+
+def _record_heartbeat(address, succeeded, error=None):
+    _health['servers'][f"{address[0]}:{address[1]}"] = succeeded
+    _health['last_heartbeat_at'] = datetime.utcnow()
+    if succeeded:
+        _health['state'] = 'up'
+        breaker.record_success()
+    else:
+        _health['last_error'] = str(error)
+        # Only report down when no known server is answering heartbeats
+        _health['state'] = 'up' if any(_health['servers'].values()) else 'down'
+        if _health['state'] == 'down':
+            breaker.record_failure()
+
+
+def _build_listeners():
+    from pymongo import monitoring
+
+    class HeartbeatListener(monitoring.ServerHeartbeatListener):
+        """Feeds driver heartbeats into the shared health state"""
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            _record_heartbeat(event.connection_id, True)
+
+        def failed(self, event):
+            _record_heartbeat(event.connection_id, False, event.reply)
+
+    class CommandListener(monitoring.CommandListener):
+        """Reports command outcomes to the circuit breaker"""
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            breaker.record_success()
+
+        def failed(self, event):
+            failure = event.failure or {}
+            if failure.get('errtype') in NETWORK_ERROR_TYPES:
+                breaker.record_failure()
+
+    return [HeartbeatListener(), CommandListener()]
+
+
+_fork_callbacks = []
+
+
+def register_fork_callback(callback):
+    """Run callback in a forked child so modules can drop references to the parent's client"""
+    _fork_callbacks.append(callback)
+
+
+def _reset_after_fork():
+    """Drop the parent's client in a forked child; the child builds its own on first use"""
+    global _client, _client_pid, _lock
+    _client = None
+    _client_pid = None
+    _lock = threading.Lock()
+    _health.update({'state': 'unknown', 'last_heartbeat_at': None, 'last_error': None, 'servers': {}})
+
+    for callback in _fork_callbacks:
+        callback()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client():
+    """Return this process's MongoClient, creating it on first use"""
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            from pymongo import MongoClient
+
+            mongodb_uri = os.environ.get('MONGODB_URI', DEFAULT_MONGODB_URI)
+            _client = MongoClient(mongodb_uri, event_listeners=_build_listeners(), **client_options())
+            _client_pid = pid
+            logger.info(f"MongoDB client created for process {pid}")
+
+    return _client
+
+
+def get_database():
+    """Return the tracksmart database on the shared client"""
+    return get_client().get_database(DATABASE_NAME)
+
+
+def connect():
+    """Create the client and confirm connectivity once (used at service startup)"""
+    try:
+        get_client().admin.command('ping')
+        _health['state'] = 'up'
+        breaker.record_success()
+        return True
+    except Exception as e:
+        _health['state'] = 'down'
+        _health['last_error'] = str(e)
+        breaker.record_failure()
+        logger.error(f"MongoDB ping failed: {e}")
+        return False
+
+
+def allow_request():
+    """False while the circuit breaker is open - callers should fail fast"""
+    return breaker.allow_request()
+
+
+def is_available():
+    """True when heartbeats are good and the breaker is closed"""
+    return is_healthy() and breaker.state == 'closed'
+
+
+def is_healthy():
+    """True when the latest heartbeat reached a server (no network call)"""
+    return _health['state'] == 'up'
+
+
+def health_state():
+    """Snapshot of the connection state for health endpoints"""
+    options = client_options()
+    return {
+        'state': _health['state'],
+        'last_heartbeat_at': _health['last_heartbeat_at'].isoformat() if _health['last_heartbeat_at'] else None,
+        'last_error': _health['last_error'],
+        'servers': dict(_health['servers']),
+        'pid': os.getpid(),
+        'client_created': _client is not None and _client_pid == os.getpid(),
+        'circuit_breaker': breaker.snapshot(),
+        'max_pool_size': options['maxPoolSize'],
+        'read_preference': options['readPreference']
+    }
@@ -0,0 +1,215 @@
+"""
+Per-worker cache of delivery partner profiles.
+
+store_live_location looked the partner up by email on every fix (and, for
+'anonymous' fixes, sorted the whole delivery_partners collection to find the
+newest partner). Profiles - email, name, role, companies - are now cached
+per worker for PARTNER_CACHE_TTL_SECONDS (default 60) in an LRU of
+PARTNER_CACHE_MAX_SIZE entries (default 10000). Unknown emails are cached
+too, so a stream of fixes from an unregistered email costs one query per TTL.
+
+delivery_register calls invalidate(email). Other workers and services hear
+about it over Redis pub/sub when REDIS_URL is set (requires the redis
+package); otherwise the invalidation stays in-process and other workers
+catch up within the TTL.
+
+Metrics: partner_cache_hits_total, partner_cache_misses_total,
+partner_cache_hit_ratio, partner_cache_size.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+import mongo_pool
+
+logger = logging.getLogger(__name__)
+
+TTL_SECONDS = float(os.environ.get('PARTNER_CACHE_TTL_SECONDS', '60'))
+MAX_SIZE = int(os.environ.get('PARTNER_CACHE_MAX_SIZE', '10000'))
+REDIS_URL = os.environ.get('REDIS_URL')
+
+INVALIDATION_CHANNEL = 'tracksmart:partner-cache'
+ALL = '*'  # invalidation message that clears every entry
+
+PROFILE_FIELDS = {'_id': 0, 'email': 1, 'name': 1, 'role': 1, 'companies': 1}
+
+# Cache key of the newest registered partner (the 'anonymous' fallback)
+MOST_RECENT = ('most_recent',)
+
+
+class LocalChannel:
+    """In-process invalidation channel - the default, and a stand-in for Redis in tests"""
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, message):
+        for callback in self._subscribers:
+            callback(message)
+
+
+class RedisChannel:
+    """Invalidation channel shared by every worker and service through Redis pub/sub"""
+
+    def __init__(self, url, channel=INVALIDATION_CHANNEL):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._subscribers = []
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _ensure_listener(self):
+        # Started lazily so every forked worker runs its own listener
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_message})
+            self._thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_message(self, message):
+        data = message['data']
+        data = data.decode() if isinstance(data, bytes) else data
+        for callback in self._subscribers:
+            callback(data)
+
+    def publish(self, message):
+        try:
+            self.client.publish(self.channel, message)
+        except Exception as e:
+            logger.error(f"Failed to publish partner cache invalidation: {str(e)}")
+
+
+class PartnerCache:
+    """TTL + LRU cache of partner profiles keyed by email"""
+
+    def __init__(self, get_database, ttl=TTL_SECONDS, max_size=MAX_SIZE, channel=None):
+        self.get_database = get_database
+        self.ttl = ttl
+        self.max_size = max_size
+        self.channel = channel or LocalChannel()
+        self.channel.subscribe(self._on_invalidation)
+        self.hits = 0
+        self.misses = 0
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, profile or None), least recently used first
+
+    def _lookup(self, key):
+        """(True, profile) for a fresh entry, (False, None) otherwise"""
+        if isinstance(self.channel, RedisChannel):
+            self.channel._ensure_listener()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                found = True
+            else:
+                self.misses += 1
+                found = False
+            hits, misses = self.hits, self.misses
+        metrics.inc('partner_cache_hits_total' if found else 'partner_cache_misses_total')
+        metrics.set_gauge('partner_cache_hit_ratio', round(hits / (hits + misses), 3))
+        return found, entry[1] if found else None
+
+    def _store(self, key, profile):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            size = len(self._entries)
+        metrics.set_gauge('partner_cache_size', size)
+
+    def get(self, email):
+        """Profile {'email', 'name', 'role', 'companies'} for an email, or None if no such partner"""
+        found, profile = self._lookup(email)
+        if found:
+            return profile
+        profile = self.get_database().get_collection('delivery_partners').find_one({'email': email}, PROFILE_FIELDS)
+        self._store(email, profile)
+        return profile
+
+    def get_many(self, emails):
+        """Profiles for many emails with one query for the cache misses; unknown emails are left out"""
+        profiles = {}
+        missing = []
+        for email in set(emails):
+            found, profile = self._lookup(email)
+            if not found:
+                missing.append(email)
+            elif profile:
+                profiles[email] = profile
+
+        if missing:
+            fetched = {
+                partner['email']: partner
+                for partner in self.get_database().get_collection('delivery_partners').find(
+                    {'email': {'$in': missing}}, PROFILE_FIELDS
+                )
+            }
+            for email in missing:
+                self._store(email, fetched.get(email))
+            profiles.update(fetched)
+        return profiles
+
+    def most_recent(self):
+        """Profile of the newest registered partner (fallback for anonymous fixes)"""
+        found, profile = self._lookup(MOST_RECENT)
+        if found:
+            return profile
+        profile = self.get_database().get_collection('delivery_partners').find_one(
+            {}, PROFILE_FIELDS, sort=[('created_at', -1)]
+        )
+        self._store(MOST_RECENT, profile)
+        return profile
+
+    def invalidate(self, email=None):
+        """Drop a partner's profile (or everything) here and in every worker listening on the channel"""
+        self._on_invalidation(email or ALL)
+        if not isinstance(self.channel, LocalChannel):
+            self.channel.publish(email or ALL)
+
+    def _on_invalidation(self, message):
+        with self._lock:
+            if message == ALL:
+                self._entries.clear()
+            else:
+                self._entries.pop(message, None)
+                # A new or changed partner may be the newest one
+                self._entries.pop(MOST_RECENT, None)
+            size = len(self._entries)
+        metrics.set_gauge('partner_cache_size', size)
+
+
+def _channel_from_env():
+    if not REDIS_URL:
+        return LocalChannel()
+    try:
+        return RedisChannel(REDIS_URL)
+    except ImportError:
+        logger.warning("REDIS_URL is set but the redis package is not installed - partner cache invalidation stays in-process")
+        return LocalChannel()
+
+
+partner_cache = PartnerCache(mongo_pool.get_database, channel=_channel_from_env())
+
+
+def _reset_after_fork():
+    partner_cache._reset()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
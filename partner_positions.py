@@ -0,0 +1,124 @@
+"""
+Latest position of every delivery partner as a GeoJSON point.
+
+Live positions live in delivery_location documents per QR code (and in
+delivery_* collections for normal tracking) with plain latitude/longitude
+fields, so nothing could ask which partners are near a point. Every stored
+coordinate fix now also upserts one `partner_positions` document per partner:
+
+    {_id: email, location: {type: 'Point', coordinates: [lng, lat]},
+     companies: [...], name, role, qr_id, timestamp, updated_at}
+
+companies is copied from the partner's profile (delivery_partners.companies,
+via partner_cache), so a compound 2dsphere index on (location, companies,
+timestamp) serves $geoNear with the company and freshness filters.
+Role-only fixes carry no coordinates and are not recorded. As with
+delivery_location, a stored position is never replaced by an older fix.
+
+Query defaults: NEARBY_RADIUS_METERS (3000), NEARBY_MAX_AGE_SECONDS (300),
+NEARBY_LIMIT (20).
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+from partner_cache import partner_cache
+
+logger = logging.getLogger(__name__)
+
+POSITIONS_COLLECTION = 'partner_positions'
+POSITION_INDEXES = [
+    ([('location', '2dsphere'), ('companies', 1), ('timestamp', -1)], {'name': 'location_2dsphere_companies_timestamp'}),
+]
+
+DEFAULT_RADIUS_METERS = float(os.environ.get('NEARBY_RADIUS_METERS', '3000'))
+DEFAULT_MAX_AGE_SECONDS = float(os.environ.get('NEARBY_MAX_AGE_SECONDS', '300'))
+DEFAULT_LIMIT = int(os.environ.get('NEARBY_LIMIT', '20'))
+MAX_RADIUS_METERS = 50000
+MAX_NEARBY_LIMIT = 100
+
+
+def _position_doc(doc, profile):
+    profile = profile or {}
+    return {
+        'location': {'type': 'Point', 'coordinates': [doc['longitude'], doc['latitude']]},
+        'companies': profile.get('companies') or [],
+        'name': profile.get('name') or doc.get('delivery_partner_name'),
+        'role': profile.get('role') or doc.get('role'),
+        'qr_id': doc.get('qr_id'),
+        'timestamp': doc['timestamp'],
+        'updated_at': datetime.utcnow()
+    }
+
+
+def _newer_position_update(position):
+    """Update pipeline that sets the position unless the stored one is newer"""
+    return [{'$replaceWith': {'$cond': [
+        {'$gt': [{'$ifNull': ['$timestamp', datetime(1970, 1, 1)]}, position['timestamp']]},
+        '$$ROOT',
+        {'$mergeObjects': ['$$ROOT', {'$literal': position}]}
+    ]}}]
+
+
+def record_positions(db, docs):
+    """
+    Upsert partner positions (never raises).
+
+    docs are delivery_location documents; those without coordinates
+    (role-only) are skipped. Normal-tracking fixes pass location_type
+    'coordinates' and no qr_id.
+    """
+    from pymongo import UpdateOne
+
+    latest = {}
+    for doc in docs:
+        if doc.get('location_type') != 'coordinates' or doc.get('latitude') is None or doc.get('longitude') is None:
+            continue
+        current = latest.get(doc['user_email'])
+        if current is None or current['timestamp'] < doc['timestamp']:
+            latest[doc['user_email']] = doc
+    if not latest:
+        return
+
+    try:
+        profiles = partner_cache.get_many(latest)
+        db.get_collection(POSITIONS_COLLECTION).bulk_write([
+            UpdateOne({'_id': email}, _newer_position_update(_position_doc(doc, profiles.get(email))), upsert=True)
+            for email, doc in latest.items()
+        ], ordered=False)
+    except Exception as e:
+        logger.error(f"Failed to record partner positions: {str(e)}")
+
+
+def nearby_pipeline(company_id, latitude, longitude, radius_meters, max_age_seconds, limit, now=None):
+    """$geoNear pipeline for a company's partners with a fix newer than max_age_seconds"""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=max_age_seconds)
+    return [
+        {'$geoNear': {
+            'near': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'key': 'location',
+            'distanceField': 'distance_m',
+            'maxDistance': radius_meters,
+            'spherical': True,
+            'query': {'companies': company_id, 'timestamp': {'$gte': cutoff}}
+        }},
+        {'$limit': limit},
+        {'$project': {
+            '_id': 0,
+            'email': '$_id',
+            'name': 1,
+            'role': 1,
+            'qr_id': 1,
+            'latitude': {'$arrayElemAt': ['$location.coordinates', 1]},
+            'longitude': {'$arrayElemAt': ['$location.coordinates', 0]},
+            'distance_m': {'$round': ['$distance_m', 1]},
+            'timestamp': 1
+        }}
+    ]
+
+
+def find_nearby_partners(db, company_id, latitude, longitude, radius_meters=DEFAULT_RADIUS_METERS,
+                         max_age_seconds=DEFAULT_MAX_AGE_SECONDS, limit=DEFAULT_LIMIT):
+    """A company's recently active partners within radius_meters of a point, nearest first"""
+    pipeline = nearby_pipeline(company_id, latitude, longitude, radius_meters, max_age_seconds, limit)
+    return list(db.get_collection(POSITIONS_COLLECTION).aggregate(pipeline))
@@ -0,0 +1,180 @@
+"""
+Collision-free QR ID allocation.
+
+QR IDs are issued by walking a keyed pseudo-random permutation of the ID
+space: the n-th QR code gets permute(n), where n comes from the atomic
+'qr_index' sequence (see sequences). Every index maps to a distinct ID, so
+allocation is O(1) with no existence checks and no catalog scans, and IDs
+still look random to someone holding one of them.
+
+The permutation is a small balanced Feistel network over the next power of
+four at or above the space size, with cycle walking to stay inside the
+space.
+
+Formats (QR_ID_FORMAT):
+- legacy (default): 4-digit IDs 1000-9999, as printed on existing QR codes
+- extended: QR_ID_DIGITS payload digits (default 8) followed by a Luhn
+  check digit, so mistyped codes are rejected before any database lookup
+
+Legacy 4-digit IDs are always accepted by is_valid_qr_id(), so codes issued
+before switching formats keep working.
+"""
+import os
+import hashlib
+import logging
+import threading
+
+import mongo_pool
+from sequences import reserve_ids
+
+logger = logging.getLogger(__name__)
+
+LEGACY_FORMAT = 'legacy'
+EXTENDED_FORMAT = 'extended'
+
+QR_ID_FORMAT = os.environ.get('QR_ID_FORMAT', LEGACY_FORMAT).lower()
+QR_ID_DIGITS = int(os.environ.get('QR_ID_DIGITS', '8'))
+QR_ID_SECRET = os.environ.get('QR_ID_SECRET', 'tracksmart-qr-ids').encode()
+
+# Indices reserved per round trip to the counters collection
+QR_ID_BLOCK_SIZE = int(os.environ.get('QR_ID_BLOCK_SIZE', '1'))
+
+# Retries when an issued ID is already taken (only possible for IDs created
+# before this allocator, e.g. legacy random IDs)
+MAX_INSERT_ATTEMPTS = 25
+
+LEGACY_MIN = 1000
+LEGACY_SPACE = 9000
+FEISTEL_ROUNDS = 4
+
+
+class QRIDSpaceExhausted(Exception):
+    """Every ID in the configured space has been issued"""
+
+
+class FeistelPermutation:
+    """Keyed bijection on range(size)"""
+
+    def __init__(self, size, key, rounds=FEISTEL_ROUNDS):
+        self.size = size
+        self.key = key
+        self.rounds = rounds
+        half_bits = 1
+        while (1 << (2 * half_bits)) < size:
+            half_bits += 1
+        self.half_bits = half_bits
+        self.half_mask = (1 << half_bits) - 1
+
+    def _round(self, value, round_number):
+        digest = hashlib.blake2b(
+            value.to_bytes(8, 'big') + bytes([round_number]), key=self.key[:64], digest_size=8
+        ).digest()
+        return int.from_bytes(digest, 'big') & self.half_mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_number in range(self.rounds):
+            left, right = right, left ^ self._round(right, round_number)
+        return (left << self.half_bits) | right
+
+    def permute(self, index):
+        """Map index in range(size) to a unique value in range(size)"""
+        if not 0 <= index < self.size:
+            raise QRIDSpaceExhausted(f"QR ID index {index} outside space of {self.size}")
+        value = self._encrypt(index)
+        # Cycle walk: the Feistel domain is at most 4x the space, so this ends quickly
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+def luhn_check_digit(digits):
+    """Luhn check digit for a string of digits"""
+    total = 0
+    for position, char in enumerate(reversed(digits)):
+        digit = int(char)
+        if position % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return str((10 - total % 10) % 10)
+
+
+def space_size(id_format=None, digits=None):
+    """Number of IDs available in a format"""
+    if (id_format or QR_ID_FORMAT) == EXTENDED_FORMAT:
+        return 10 ** (digits or QR_ID_DIGITS)
+    return LEGACY_SPACE
+
+
+def format_qr_id(value, id_format=None, digits=None):
+    """Render a position in the ID space as a QR ID string"""
+    if (id_format or QR_ID_FORMAT) == EXTENDED_FORMAT:
+        payload = str(value).zfill(digits or QR_ID_DIGITS)
+        return payload + luhn_check_digit(payload)
+    return str(LEGACY_MIN + value)
+
+
+def is_valid_qr_id(qr_id):
+    """True for a legacy 4-digit ID or a well-formed extended ID with a valid check digit"""
+    if not qr_id or not qr_id.isdigit():
+        return False
+    if len(qr_id) == 4:
+        return True
+    if len(qr_id) == QR_ID_DIGITS + 1:
+        return luhn_check_digit(qr_id[:-1]) == qr_id[-1]
+    return False
+
+
+_permutation = FeistelPermutation(space_size(), QR_ID_SECRET)
+_block = iter(())
+_block_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """Indices reserved by the parent must not be handed out again by a child"""
+    global _block, _block_lock
+    _block = iter(())
+    _block_lock = threading.Lock()
+
+
+mongo_pool.register_fork_callback(_reset_after_fork)
+
+
+def _next_index(db):
+    global _block
+    with _block_lock:
+        index = next(_block, None)
+        if index is None:
+            _block = iter(reserve_ids(db, 'qr_index', QR_ID_BLOCK_SIZE))
+            index = next(_block)
+        return index
+
+
+def allocate_qr_id(db):
+    """Issue the next QR ID (one counters round trip per QR_ID_BLOCK_SIZE IDs)"""
+    return format_qr_id(_permutation.permute(_next_index(db)))
+
+
+def insert_location(db, location_doc):
+    """
+    Allocate a QR ID, store it on location_doc and insert it into locations.
+
+    Relies on the unique locations.qr_id index: if the ID was already taken by
+    a QR created before this allocator, the next one is tried. Returns the ID;
+    the insert sets location_doc['_id'].
+    """
+    from pymongo.errors import DuplicateKeyError
+
+    locations_collection = db.get_collection('locations')
+    for _ in range(MAX_INSERT_ATTEMPTS):
+        location_doc['qr_id'] = allocate_qr_id(db)
+        location_doc.pop('_id', None)
+        try:
+            locations_collection.insert_one(location_doc)
+            return location_doc['qr_id']
+        except DuplicateKeyError:
+            logger.warning(f"QR ID {location_doc['qr_id']} already in use, allocating another")
+
+    raise QRIDSpaceExhausted(f"No free QR ID after {MAX_INSERT_ATTEMPTS} attempts")
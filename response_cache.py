@@ -0,0 +1,191 @@
+"""
+Response cache for rarely changing list endpoints.
+
+/companies, /api/users, /api/delivery-partners and
+/api/company/<id>/delivery-partners dump whole collections on every page load
+but only change when someone registers. Their serialized JSON bodies are
+cached under per-endpoint (and per-company) keys and invalidated by the
+register handlers that change them.
+
+Backends:
+- in-process LRU (default) - RESPONSE_CACHE_MAX_ENTRIES bodies per worker;
+  other workers see a registration after at most RESPONSE_CACHE_TTL_SECONDS
+- Redis (RESPONSE_CACHE_URL, falling back to REDIS_URL; needs the redis
+  package) - one copy shared by every worker and service, so invalidation
+  is immediate everywhere
+
+Bodies are fresh for RESPONSE_CACHE_TTL_SECONDS (default 300). Endpoints that
+send an ETag pass its value as the body's version: a body cached under another
+version is rebuilt, so a worker that missed an invalidation never serves its
+old body under the new ETag. If rebuilding an expired body fails, or the
+handler cannot reach MongoDB at all (breaker open), a body up to
+RESPONSE_CACHE_STALE_SECONDS (default 3600) older is served instead - without
+an ETag - and counted as a stale hit.
+
+Metrics: response_cache_hits_total, _misses_total, _stale_hits_total,
+_invalidations_total (labelled by key).
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '300'))
+STALE_SECONDS = float(os.environ.get('RESPONSE_CACHE_STALE_SECONDS', '3600'))
+MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '256'))
+CACHE_URL = os.environ.get('RESPONSE_CACHE_URL') or os.environ.get('REDIS_URL')
+
+KEY_PREFIX = 'tracksmart:response:'
+
+# Cache keys - one per response shape (services serialize the same collection differently)
+COMPANIES = 'companies'  # /companies in the combined app
+COMPANIES_FULL = 'companies:full'  # /api/companies in delivery_app
+USERS = 'users'  # /api/users in the combined app
+USERS_FULL = 'users:full'  # /api/users in user_app
+DELIVERY_PARTNERS = 'delivery_partners'
+
+
+def company_partners_key(company_id):
+    return f"company:{company_id}:delivery_partners"
+
+
+class MemoryBackend:
+    """Per-worker LRU of (stored_at, version, body); also the stand-in for Redis in tests"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, stored_at, version, body, expire_seconds):
+        with self._lock:
+            self._entries[key] = (stored_at, version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """Shared backend over the Redis protocol; entries expire once they are too stale to serve"""
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(KEY_PREFIX + key)
+        if value is None:
+            return None
+        stored_at, version, body = value.split(b'\n', 2)
+        return float(stored_at), version.decode() or None, body
+
+    def set(self, key, stored_at, version, body, expire_seconds):
+        header = f"{stored_at}\n{version or ''}\n".encode()
+        self.client.set(KEY_PREFIX + key, header + body, ex=max(int(expire_seconds), 1))
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*[KEY_PREFIX + key for key in keys])
+
+
+class ResponseCache:
+    """Serialized JSON bodies by key, rebuilt on a miss and served stale when rebuilding fails"""
+
+    def __init__(self, backend, ttl=TTL_SECONDS, stale=STALE_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_seconds = stale
+
+    def _get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logger.error(f"Response cache read failed for {key}: {str(e)}")
+            return None
+
+    def fetch(self, key, load, version=None):
+        """
+        Cached JSON body for key; load() returns the data to serialize on a miss.
+        Only a body cached under the same version is reused.
+        """
+        from flask import json
+
+        entry = self._get(key)
+        now = time.time()
+        current = entry is not None and entry[1] == version
+        if current and now - entry[0] < self.ttl:
+            metrics.inc('response_cache_hits_total', key=key)
+            return entry[2]
+
+        try:
+            body = json.dumps(load()).encode()
+        except Exception:
+            # An older version's body must not go out under the caller's newer ETag
+            if current and now - entry[0] < self.ttl + self.stale_seconds:
+                logger.warning(f"Serving stale {key} response after a failed refresh")
+                metrics.inc('response_cache_stale_hits_total', key=key)
+                return entry[2]
+            raise
+
+        metrics.inc('response_cache_misses_total', key=key)
+        try:
+            self.backend.set(key, now, version, body, self.ttl + self.stale_seconds)
+        except Exception as e:
+            logger.error(f"Response cache write failed for {key}: {str(e)}")
+        return body
+
+    def stale(self, key):
+        """Last body for key, whatever its version, if not too stale to serve (None otherwise)"""
+        entry = self._get(key)
+        if entry is None or time.time() - entry[0] >= self.ttl + self.stale_seconds:
+            return None
+        logger.warning(f"Serving stale {key} response while MongoDB is unavailable")
+        metrics.inc('response_cache_stale_hits_total', key=key)
+        return entry[2]
+
+    def invalidate(self, *keys):
+        """Drop cached bodies after a write that changes them"""
+        try:
+            self.backend.delete(keys)
+        except Exception as e:
+            logger.error(f"Response cache invalidation failed for {keys}: {str(e)}")
+        for key in keys:
+            metrics.inc('response_cache_invalidations_total', key=key)
+
+
+def json_response(body):
+    """Flask response for a cached JSON body"""
+    from flask import current_app
+
+    return current_app.response_class(body, mimetype='application/json')
+
+
+def _backend_from_env():
+    if not CACHE_URL:
+        return MemoryBackend()
+    try:
+        return RedisBackend(CACHE_URL)
+    except ImportError:
+        logger.warning("RESPONSE_CACHE_URL/REDIS_URL is set but the redis package is not installed - using the in-process cache")
+        return MemoryBackend()
+
+
+response_cache = ResponseCache(_backend_from_env())
@@ -0,0 +1,72 @@
+"""
+Atomic ID sequences backed by a counters collection.
+
+Each sequence is one document in `counters` ({'_id': name, 'value': last
+issued ID}). Allocating IDs is a single find_one_and_update with $inc, so
+concurrent workers never hand out the same ID. reserve_ids() takes a whole
+block in the same round trip for bulk imports.
+
+The first allocation in a process seeds the counter from the highest ID
+already stored (with $max, so seeding is safe to race and never moves a
+counter backwards).
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_COLLECTION = 'counters'
+
+# sequence name -> (collection holding the IDs or None, first value handed out)
+SEQUENCES = {
+    'company_id': ('companies', 1),
+    'user_id': ('users', 1000),
+    'qr_index': (None, 0),  # position in the QR ID permutation (see qr_ids)
+}
+
+_seeded = set()
+
+
+def seed_sequence(db, name):
+    """Make sure the counter is at least the highest ID already in use"""
+    collection_name, start = SEQUENCES[name]
+
+    highest = None
+    if collection_name:
+        highest = db.get_collection(collection_name).find_one(
+            {name: {'$type': 'number'}},
+            sort=[(name, -1)],
+            projection={name: 1}
+        )
+    floor = max(highest[name] if highest else start - 1, start - 1)
+
+    db.get_collection(COUNTERS_COLLECTION).update_one(
+        {'_id': name},
+        {'$max': {'value': floor}},
+        upsert=True
+    )
+    _seeded.add(name)
+    logger.info(f"Sequence {name} seeded at {floor}")
+
+
+def reserve_ids(db, name, count=1):
+    """Atomically reserve `count` consecutive IDs; returns them as a range"""
+    from pymongo import ReturnDocument
+
+    if count < 1:
+        raise ValueError('count must be at least 1')
+    if name not in _seeded:
+        seed_sequence(db, name)
+
+    counter = db.get_collection(COUNTERS_COLLECTION).find_one_and_update(
+        {'_id': name},
+        {'$inc': {'value': count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    last = counter['value']
+    return range(last - count + 1, last + 1)
+
+
+def next_id(db, name):
+    """Allocate the next ID of a sequence"""
+    return reserve_ids(db, name, 1)[0]
@@ -0,0 +1,529 @@
+"""
+Shipment storage for QR tracking documents.
+
+Every QR code used to get its own MongoDB collection (named after the
+4-digit QR ID) holding its destination_info / qr_info, delivery_location
+and delivery_complete documents. With thousands of QR codes that means
+thousands of collections, each with its own _id index and storage files.
+
+The default "shipments" storage mode keeps all of those documents in a
+single indexed collection instead, tagged with their qr_id. Route handlers
+get a collection-like view scoped to one QR ID from get_qr_collection(), so
+the same find_one / update_one calls work in either mode.
+
+Run `python shipment_store.py migrate` once to move existing numeric QR
+collections into the shipments collection.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SHIPMENTS_COLLECTION = 'shipments'
+
+# 'shipments' (single collection) or 'per_qr' (legacy one collection per QR code)
+STORAGE_MODE = os.environ.get('SHIPMENT_STORAGE', 'shipments').lower()
+
+# Compound indexes backing every per-QR lookup: find_one by type, latest
+# delivery_location by timestamp, and the per-partner delivery_location upsert
+# (created at startup by db_indexes)
+SHIPMENT_INDEXES = [
+    ([('qr_id', 1), ('type', 1), ('timestamp', -1)], {'name': 'qr_id_type_timestamp'}),
+    ([('qr_id', 1), ('type', 1), ('user_email', 1)], {'name': 'qr_id_type_user_email'}),
+    # One delivery_complete per QR code, so concurrent completions (geofence workers,
+    # a double-pressed Done) cannot both insert
+    ([('qr_id', 1), ('type', 1)], {
+        'name': 'qr_id_delivery_complete_unique',
+        'unique': True,
+        'partialFilterExpression': {'type': 'delivery_complete'}
+    }),
+]
+
+def shipments_enabled():
+    """Return True when QR documents are stored in the single shipments collection"""
+    return STORAGE_MODE != 'per_qr'
+
+
+class QRCollection:
+    """Collection-like view over the shipments collection scoped to one QR ID"""
+
+    def __init__(self, collection, qr_id):
+        self.collection = collection
+        self.qr_id = str(qr_id)
+        self.name = self.qr_id
+
+    def _scope(self, filter=None):
+        scoped = dict(filter or {})
+        scoped['qr_id'] = self.qr_id
+        return scoped
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self.collection.find_one(self._scope(filter), *args, **kwargs)
+
+    def find(self, filter=None, *args, **kwargs):
+        return self.collection.find(self._scope(filter), *args, **kwargs)
+
+    def count_documents(self, filter=None, **kwargs):
+        return self.collection.count_documents(self._scope(filter), **kwargs)
+
+    def insert_one(self, document, **kwargs):
+        document['qr_id'] = self.qr_id
+        return self.collection.insert_one(document, **kwargs)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return self.collection.update_one(self._scope(filter), update, upsert=upsert, **kwargs)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return self.collection.update_many(self._scope(filter), update, upsert=upsert, **kwargs)
+
+    def delete_many(self, filter=None, **kwargs):
+        return self.collection.delete_many(self._scope(filter), **kwargs)
+
+
+def get_shipments_collection(db):
+    """Get the shared shipments collection"""
+    return db.get_collection(SHIPMENTS_COLLECTION)
+
+
+def get_qr_collection(db, qr_id):
+    """Get the collection (or scoped shipments view) holding a QR code's documents"""
+    if not shipments_enabled():
+        return db.get_collection(str(qr_id))
+    return QRCollection(get_shipments_collection(db), qr_id)
+
+
+# Unique delivery_complete index for a legacy per-QR collection (the shipments
+# collection has qr_id_delivery_complete_unique instead)
+PER_QR_COMPLETION_INDEX = ([('type', 1)], {
+    'name': 'delivery_complete_unique',
+    'unique': True,
+    'partialFilterExpression': {'type': 'delivery_complete'}
+})
+
+_completion_indexed = set()  # per-QR collections this process has created the index on
+
+
+def get_completion_collection(db, qr_id):
+    """
+    get_qr_collection for writing a delivery_complete document.
+
+    In per_qr mode the QR's collection gets PER_QR_COMPLETION_INDEX on first
+    use, so concurrent completions fail with DuplicateKeyError there as they
+    do on the shipments collection. Only completion writes call this, so
+    reads of unknown QR IDs never create collections.
+    """
+    collection = get_qr_collection(db, qr_id)
+    if not shipments_enabled() and collection.name not in _completion_indexed:
+        keys, options = PER_QR_COMPLETION_INDEX
+        try:
+            collection.create_index(keys, **options)
+        except Exception as e:
+            # Legacy collections may already hold duplicate completions
+            logger.error(f"Failed to create {options['name']} on QR collection {collection.name}: {str(e)}")
+        _completion_indexed.add(collection.name)
+    return collection
+
+
+def qr_bulk_target(db, qr_id):
+    """(raw collection, scope filter) for building bulk_write operations on a QR code's documents"""
+    if not shipments_enabled():
+        return db.get_collection(str(qr_id)), {}
+    return get_shipments_collection(db), {'qr_id': str(qr_id)}
+
+
+# Company orders page size (default and upper bound for ?limit=)
+ORDERS_PAGE_SIZE = 50
+MAX_ORDERS_PAGE_SIZE = 500
+
+# Order status labels shown on the company dashboard, keyed by filter value
+ORDER_STATUSES = {
+    'pending': 'Pending',
+    'in_progress': 'In Progress',
+    'boarded_and_arriving': 'Boarded and Arriving',
+    'delivered': 'Delivered',
+}
+
+
+def normalize_order_status(status):
+    """Map a status filter ('in_progress', 'In Progress', ...) to its dashboard label"""
+    if not status:
+        return None
+    return ORDER_STATUSES.get(status.strip().lower().replace(' ', '_').replace('-', '_'))
+
+
+def _first_shipment_doc(doc_types):
+    """Aggregation expression picking the first looked-up shipment doc of the given types"""
+    return {'$arrayElemAt': [
+        {'$filter': {
+            'input': '$shipment_docs',
+            'as': 'shipment',
+            'cond': {'$in': ['$$shipment._id', doc_types]}
+        }},
+        0
+    ]}
+
+
+def company_orders_pipeline(company_id, status=None, cursor=None, limit=50):
+    """
+    Build the aggregation over `locations` that returns one row per company order.
+
+    Each QR code is joined to its latest shipment document of every type with a
+    single indexed $lookup, so the whole dashboard page is one round trip.
+    Orders are returned newest first; `cursor` is the order_cursor of the last
+    row from the previous page.
+    """
+    match = {'company_id': company_id, 'qr_id': {'$ne': None}}
+    if cursor is not None:
+        match['_id'] = {'$lt': cursor}
+
+    pipeline = [
+        {'$match': match},
+        {'$sort': {'_id': -1}},
+        {'$lookup': {
+            'from': SHIPMENTS_COLLECTION,
+            'localField': 'qr_id',
+            'foreignField': 'qr_id',
+            'pipeline': [
+                {'$match': {'type': {'$in': ['destination_info', 'qr_info', 'delivery_location', 'delivery_complete']}}},
+                {'$sort': {'type': 1, 'timestamp': -1}},
+                {'$project': {
+                    'type': 1,
+                    'location_name': 1,
+                    'delivery_partner_name': 1,
+                    'latitude': 1,
+                    'longitude': 1,
+                    'location_type': 1,
+                    'timestamp': 1,
+                    'delivered_at': 1
+                }},
+                {'$group': {'_id': '$type', 'doc': {'$first': '$$ROOT'}}},
+                # destination_info sorts before qr_info, so it wins when both exist
+                {'$sort': {'_id': 1}}
+            ],
+            'as': 'shipment_docs'
+        }},
+        {'$set': {
+            'destination_doc': _first_shipment_doc(['destination_info', 'qr_info']),
+            'delivery_doc': _first_shipment_doc(['delivery_location']),
+            'complete_doc': _first_shipment_doc(['delivery_complete'])
+        }},
+        {'$set': {
+            'status': {'$switch': {
+                'branches': [
+                    {'case': {'$or': [
+                        {'$ne': [{'$type': '$complete_doc'}, 'missing']},
+                        {'$eq': ['$delivery_status', 'delivered']}
+                    ]}, 'then': ORDER_STATUSES['delivered']},
+                    {'case': {'$eq': [{'$type': '$delivery_doc'}, 'missing']}, 'then': ORDER_STATUSES['pending']},
+                    {'case': {'$eq': ['$delivery_doc.doc.location_type', 'role_only']}, 'then': ORDER_STATUSES['boarded_and_arriving']}
+                ],
+                'default': ORDER_STATUSES['in_progress']
+            }}
+        }}
+    ]
+
+    if status:
+        pipeline.append({'$match': {'status': status}})
+
+    pipeline += [
+        {'$limit': limit},
+        {'$project': {
+            '_id': 0,
+            'order_cursor': {'$toString': '$_id'},
+            'order_id': {'$concat': ['ORD-', {'$toString': '$qr_id'}]},
+            'qr_id': 1,
+            'destination': {'$ifNull': ['$destination_doc.doc.location_name', 'Unknown']},
+            'delivery_partner': {'$ifNull': ['$delivery_doc.doc.delivery_partner_name', 'Not assigned']},
+            'delivery_location': {
+                'latitude': '$delivery_doc.doc.latitude',
+                'longitude': '$delivery_doc.doc.longitude',
+                'timestamp': '$delivery_doc.doc.timestamp'
+            },
+            'delivered_at': {'$ifNull': ['$complete_doc.doc.delivered_at', '$delivered_at']},
+            'status': 1,
+            'created_at': {'$ifNull': ['$timestamp', '$created_at']}
+        }}
+    ]
+
+    return pipeline
+
+
+def is_valid_order_cursor(cursor):
+    """Check that a pagination cursor is a locations ObjectId string"""
+    from bson import ObjectId
+    return ObjectId.is_valid(cursor)
+
+
+def _latest_shipment_docs(db, qr_id, doc_types):
+    """{type: newest document} among one QR code's documents of the given types"""
+    latest = {}
+    for doc in get_qr_collection(db, qr_id).find({'type': {'$in': doc_types}}).sort('timestamp', -1):
+        latest.setdefault(doc['type'], doc)
+    return latest
+
+
+def _order_row(location, docs):
+    """One company_orders_pipeline row computed in Python (per_qr storage)"""
+    destination = docs.get('destination_info') or docs.get('qr_info') or {}
+    delivery = docs.get('delivery_location')
+    complete = docs.get('delivery_complete')
+
+    if complete is not None or location.get('delivery_status') == 'delivered':
+        status = ORDER_STATUSES['delivered']
+    elif delivery is None:
+        status = ORDER_STATUSES['pending']
+    elif delivery.get('location_type') == 'role_only':
+        status = ORDER_STATUSES['boarded_and_arriving']
+    else:
+        status = ORDER_STATUSES['in_progress']
+
+    delivery = delivery or {}
+    return {
+        'order_cursor': str(location['_id']),
+        'order_id': f"ORD-{location['qr_id']}",
+        'qr_id': location['qr_id'],
+        'destination': destination.get('location_name') or 'Unknown',
+        'delivery_partner': delivery.get('delivery_partner_name') or 'Not assigned',
+        'delivery_location': {
+            'latitude': delivery.get('latitude'),
+            'longitude': delivery.get('longitude'),
+            'timestamp': delivery.get('timestamp')
+        },
+        'delivered_at': (complete or {}).get('delivered_at') or location.get('delivered_at'),
+        'status': status,
+        'created_at': location.get('timestamp') or location.get('created_at')
+    }
+
+
+def _company_orders_per_qr(db, company_id, status=None, cursor=None, limit=50):
+    """
+    company_orders_pipeline for SHIPMENT_STORAGE=per_qr, where there is no
+    shipments collection to $lookup: the QR codes' own collections are read
+    one by one, newest order first, until the page is full.
+    """
+    match = {'company_id': company_id, 'qr_id': {'$ne': None}}
+    if cursor is not None:
+        match['_id'] = {'$lt': cursor}
+
+    orders = []
+    for location in db.get_collection("locations").find(match).sort('_id', -1):
+        docs = _latest_shipment_docs(
+            db, location['qr_id'], ['destination_info', 'qr_info', 'delivery_location', 'delivery_complete']
+        )
+        row = _order_row(location, docs)
+        if status and row['status'] != status:
+            continue
+        orders.append(row)
+        if len(orders) >= limit:
+            break
+    return orders
+
+
+def get_company_orders_page(db, company_id, status=None, cursor=None, limit=50):
+    """Run the company orders aggregation and return (orders, next_cursor)"""
+    from bson import ObjectId
+
+    cursor_id = ObjectId(cursor) if cursor else None
+    if shipments_enabled():
+        pipeline = company_orders_pipeline(company_id, status=status, cursor=cursor_id, limit=limit)
+        orders = list(db.get_collection("locations").aggregate(pipeline))
+    else:
+        orders = _company_orders_per_qr(db, company_id, status=status, cursor=cursor_id, limit=limit)
+
+    next_cursor = orders[-1]['order_cursor'] if len(orders) == limit else None
+    return orders, next_cursor
+
+
+def partner_metrics_pipeline(company_id):
+    """
+    Build the aggregation over `locations` that returns delivery counts per partner email.
+
+    Every company QR code is joined to its delivery records (delivery_location
+    per partner plus delivery_complete) and the rows are grouped by partner
+    email, so metrics for the whole fleet come back in one query:
+    active_orders, completed_orders, rating_total and rating_count.
+    """
+    return [
+        {'$match': {'company_id': company_id, 'qr_id': {'$ne': None}}},
+        {'$lookup': {
+            'from': SHIPMENTS_COLLECTION,
+            'localField': 'qr_id',
+            'foreignField': 'qr_id',
+            'pipeline': [
+                {'$match': {'type': {'$in': ['delivery_location', 'delivery_complete']}}},
+                {'$project': {'_id': 0, 'type': 1, 'user_email': 1, 'rating': 1}}
+            ],
+            'as': 'records'
+        }},
+        {'$project': {
+            'partner_emails': {'$setUnion': [{'$map': {
+                'input': {'$filter': {
+                    'input': '$records',
+                    'as': 'record',
+                    'cond': {'$eq': ['$$record.type', 'delivery_location']}
+                }},
+                'as': 'record',
+                'in': '$$record.user_email'
+            }}]},
+            'completed': {'$or': [
+                {'$in': ['delivery_complete', '$records.type']},
+                {'$eq': ['$delivery_status', 'delivered']}
+            ]},
+            'rating': {'$max': '$records.rating'}
+        }},
+        {'$unwind': '$partner_emails'},
+        {'$group': {
+            '_id': '$partner_emails',
+            'active_orders': {'$sum': {'$cond': ['$completed', 0, 1]}},
+            'completed_orders': {'$sum': {'$cond': ['$completed', 1, 0]}},
+            'rating_total': {'$sum': '$rating'},
+            'rating_count': {'$sum': {'$cond': [{'$isNumber': '$rating'}, 1, 0]}}
+        }}
+    ]
+
+
+def _partner_metrics_per_qr(db, company_id):
+    """partner_metrics_pipeline rows for SHIPMENT_STORAGE=per_qr, reading each QR code's collection"""
+    rows = {}
+    locations = db.get_collection("locations").find(
+        {'company_id': company_id, 'qr_id': {'$ne': None}}, {'qr_id': 1, 'delivery_status': 1}
+    )
+    for location in locations:
+        records = list(get_qr_collection(db, location['qr_id']).find(
+            {'type': {'$in': ['delivery_location', 'delivery_complete']}}, {'_id': 0, 'type': 1, 'user_email': 1, 'rating': 1}
+        ))
+        completed = (
+            any(record['type'] == 'delivery_complete' for record in records)
+            or location.get('delivery_status') == 'delivered'
+        )
+        ratings = [
+            record['rating'] for record in records
+            if isinstance(record.get('rating'), (int, float)) and not isinstance(record.get('rating'), bool)
+        ]
+        rating = max(ratings) if ratings else None
+
+        for email in {record.get('user_email') for record in records if record['type'] == 'delivery_location'}:
+            row = rows.setdefault(email, {
+                '_id': email, 'active_orders': 0, 'completed_orders': 0, 'rating_total': 0, 'rating_count': 0
+            })
+            row['completed_orders' if completed else 'active_orders'] += 1
+            if rating is not None:
+                row['rating_total'] += rating
+                row['rating_count'] += 1
+    return list(rows.values())
+
+
+def get_partner_metrics(db, company_id):
+    """Run the partner metrics aggregation and return {partner_email: metrics}"""
+    if shipments_enabled():
+        rows = db.get_collection("locations").aggregate(partner_metrics_pipeline(company_id))
+    else:
+        rows = _partner_metrics_per_qr(db, company_id)
+
+    metrics = {}
+    for row in rows:
+        metrics[row['_id']] = row
+    return metrics
+
+
+def list_qr_collection_names(db):
+    """List legacy per-QR collections (collections with purely numeric names)"""
+    return [name for name in db.list_collection_names() if name.isdigit()]
+
+
+def migrate_qr_collections(db, drop=False, batch_size=500):
+    """
+    Copy every legacy per-QR collection into the shipments collection.
+
+    Documents keep their _id and are upserted, so the migration can be re-run
+    safely. Source collections are only dropped when drop=True.
+
+    shipments allows one delivery_complete per QR code, but a legacy
+    collection may hold several (concurrent mark-delivered requests). Only
+    the earliest is copied - or none, when shipments already has one for
+    that QR code - and the skipped _ids are logged and counted in
+    summary['duplicate_completions'].
+    """
+    from pymongo import ReplaceOne
+
+    shipments = get_shipments_collection(db)
+    for keys, options in SHIPMENT_INDEXES:
+        shipments.create_index(keys, **options)
+
+    summary = {'collections': 0, 'documents': 0, 'dropped': 0, 'duplicate_completions': 0}
+
+    for qr_id in list_qr_collection_names(db):
+        source = db.get_collection(qr_id)
+        operations = []
+
+        existing = shipments.find_one({'qr_id': qr_id, 'type': 'delivery_complete'}, {'_id': 1})
+        if existing:
+            kept_completion = existing['_id']
+        else:
+            completions = sorted(
+                source.find({'type': 'delivery_complete'}, {'_id': 1, 'timestamp': 1}),
+                key=lambda doc: (doc.get('timestamp') or datetime.max, str(doc['_id']))
+            )
+            kept_completion = completions[0]['_id'] if completions else None
+        skipped = []
+
+        for doc in source.find({}):
+            if doc.get('type') == 'delivery_complete' and doc['_id'] != kept_completion:
+                skipped.append(doc['_id'])
+                continue
+            doc['qr_id'] = qr_id
+            operations.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+
+            if len(operations) >= batch_size:
+                shipments.bulk_write(operations, ordered=False)
+                summary['documents'] += len(operations)
+                operations = []
+
+        if operations:
+            shipments.bulk_write(operations, ordered=False)
+            summary['documents'] += len(operations)
+
+        summary['collections'] += 1
+
+        if skipped:
+            summary['duplicate_completions'] += len(skipped)
+            logger.warning(f"QR collection {qr_id}: kept delivery_complete {kept_completion}, "
+                           f"skipped duplicates {', '.join(str(_id) for _id in skipped)}")
+
+        if drop:
+            source.drop()
+            summary['dropped'] += 1
+
+        logger.info(f"Migrated QR collection {qr_id} into '{SHIPMENTS_COLLECTION}'")
+
+    return summary
+
+
+def main(argv=None):
+    """Command line entry point: python shipment_store.py migrate [--drop]"""
+    parser = argparse.ArgumentParser(description='TrackSmart shipment storage tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Move per-QR collections into the shipments collection')
+    migrate_parser.add_argument('--drop', action='store_true', help='Drop each per-QR collection after copying it')
+    migrate_parser.add_argument('--batch-size', type=int, default=500)
+
+    args = parser.parse_args(argv)
+
+    import mongo_pool
+    db = mongo_pool.get_database()
+
+    if args.command == 'migrate':
+        summary = migrate_qr_collections(db, drop=args.drop, batch_size=args.batch_size)
+        print(f"Migrated {summary['documents']} documents from {summary['collections']} QR collections "
+              f"({summary['dropped']} dropped, {summary['duplicate_completions']} duplicate delivery_complete skipped)")
+
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
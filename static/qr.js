@@ -109,6 +109,31 @@ const initializeMap = async () => {
   }
 };
 
+// Address and search lookups go through the server's geocode cache
+const lookupJson = async (url) => {
+  const response = await fetch(url);
+  if (!response.ok) {
+    throw new Error(`Lookup failed with status ${response.status}`);
+  }
+  return response.json();
+};
+
+const reverseGeocode = (coords) => {
+  const params = new URLSearchParams({ at: `${coords.lat},${coords.lng}` });
+  return lookupJson(`/api/reverse-geocode?${params}`);
+};
+
+const searchPlaces = (mode, query, limit) => {
+  const params = new URLSearchParams({
+    q: query,
+    mode: mode,
+    at: '15.3173,75.7139',
+    countryCode: 'IND',
+    limit: limit
+  });
+  return lookupJson(`/api/geocode?${params}`);
+};
+
 // Handle map click events
 const handleMapClick = (evt) => {
   try {
@@ -116,14 +141,14 @@ const handleMapClick = (evt) => {
     const coord = map.screenToGeo(pointer.viewportX, pointer.viewportY);
 
     // Reverse geocode the clicked location
-    geocoder.reverseGeocode({ at: `${coord.lat},${coord.lng}` }, (result) => {
+    reverseGeocode(coord).then((result) => {
       const location = result.items?.[0];
       const name = location?.title || 'Selected Location';
       const address = location?.address?.label || `${coord.lat.toFixed(6)}, ${coord.lng.toFixed(6)}`;
       
       updateLocation(coord, name, address);
       showStatus('Location selected from map', 'success');
-    }, (error) => {
+    }).catch((error) => {
       console.error('Reverse geocoding error:', error);
       const name = 'Selected Location';
       const address = `${coord.lat.toFixed(6)}, ${coord.lng.toFixed(6)}`;
@@ -177,22 +202,13 @@ const setupSearch = () => {
 
 // Get search suggestions
 const getSuggestions = (query) => {
-  if (!geocoder) return;
-
-  const params = {
-    q: query,
-    at: '15.3173,75.7139',
-    countryCode: 'IND',
-    limit: 5
-  };
-
-  geocoder.autosuggest(params, (result) => {
+  searchPlaces('autosuggest', query, 5).then((result) => {
     if (result && result.items) {
       displaySuggestions(result.items);
     } else {
       hideSuggestions();
     }
-  }, (error) => {
+  }).catch((error) => {
     console.error('Suggestion error:', error);
     hideSuggestions();
   });
@@ -241,16 +257,7 @@ const hideSuggestions = () => {
 
 // Search for a specific location
 const searchLocation = (query) => {
-  if (!geocoder) return;
-
-  const params = {
-    q: `${query} Karnataka`,
-    at: '15.3173,75.7139',
-    countryCode: 'IND',
-    limit: 1
-  };
-
-  geocoder.geocode(params, (result) => {
+  searchPlaces('geocode', `${query} Karnataka`, 1).then((result) => {
     if (result.items && result.items.length > 0) {
       const location = result.items[0];
       const coords = location.position;
@@ -262,7 +269,7 @@ const searchLocation = (query) => {
     } else {
       showStatus('Location not found in Karnataka', 'error');
     }
-  }, (error) => {
+  }).catch((error) => {
     console.error('Search error:', error);
     showStatus('Search failed', 'error');
   });
@@ -292,14 +299,14 @@ const setupCurrentLocation = () => {
       map.setZoom(16);
 
       // Reverse geocode current location
-      geocoder.reverseGeocode({ at: `${coords.lat},${coords.lng}` }, (result) => {
+      reverseGeocode(coords).then((result) => {
         const location = result.items?.[0];
         const name = 'My Current Location';
         const address = location?.address?.label || `${coords.lat.toFixed(6)}, ${coords.lng.toFixed(6)}`;
         
         updateLocation(coords, name, address);
         showStatus('Current location found!', 'success');
-      }, (error) => {
+      }).catch((error) => {
         console.error('Reverse geocoding error:', error);
         const name = 'My Current Location';
         const address = `${coords.lat.toFixed(6)}, ${coords.lng.toFixed(6)}`;
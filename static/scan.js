@@ -453,37 +453,17 @@ const calculateRoute = async (from, to) => {
       routeLine = null;
     }
 
-    // Use HERE Maps Routing API v8 directly with fallback
-    let response;
-    let data;
-    
-    // Try different API keys if rate limited
-    for (let i = 0; i < API_KEYS.length; i++) {
-      const apiKey = API_KEYS[(currentApiKeyIndex + i) % API_KEYS.length];
-      const routingUrl = `https://router.hereapi.com/v8/routes?apikey=${apiKey}&origin=${from.lat},${from.lng}&destination=${to.lat},${to.lng}&return=summary,polyline&transportMode=car&routingMode=fast`;
-      
-      try {
-        response = await fetch(routingUrl);
-        
-        if (response.status !== 429) {
-          currentApiKeyIndex = (currentApiKeyIndex + i) % API_KEYS.length;
-          data = await response.json();
-          break;
-        }
-        
-        if (response.status === 429) {
-          console.warn(`API key ${i + 1} rate limited, trying next key...`);
-          continue;
-        }
-      } catch (fetchError) {
-        console.warn(`API key ${i + 1} failed:`, fetchError.message);
-        continue;
-      }
-      
-      if (i === API_KEYS.length - 1) {
-        throw new Error('All API keys exhausted or rate limited');
-      }
+    // Route through the server proxy - it caches routes and budgets HERE quota across API keys
+    const params = new URLSearchParams({
+      origin: `${from.lat},${from.lng}`,
+      destination: `${to.lat},${to.lng}`,
+      transportMode: 'car'
+    });
+    const response = await fetch(`/api/route?${params}`);
+    if (!response.ok) {
+      throw new Error(`Routing proxy returned ${response.status}`);
     }
+    const data = await response.json();
 
     if (!data.routes || data.routes.length === 0) {
       console.warn('No route found in response');
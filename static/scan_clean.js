@@ -10,6 +10,10 @@ let currentLocationMarker = null;
 let destinationMarker = null;
 let routeGroup = null;
 let userLocation = null;
+let uplinkSocket = null;
+let uplinkSeq = 0;
+let uplinkUnacked = new Map();  // seq -> location frame sent but not acknowledged yet
+const UPLINK_MAX_UNACKED = 500;
 
 // DOM Elements
 const startScanBtn = document.getElementById('startScanBtn');
@@ -241,8 +245,108 @@ function trackUserLocation() {
   window.locationWatchId = watchId;
 }
 
+// Open the location uplink WebSocket (falls back to POST when unavailable)
+function openLocationUplink() {
+  if (!('WebSocket' in window) || uplinkSocket) {
+    return;
+  }
+  
+  let partnerData = {};
+  try {
+    partnerData = JSON.parse(localStorage.getItem('deliveryPartner') || '{}');
+  } catch (parseError) {
+    console.error('Error parsing delivery partner data:', parseError);
+  }
+  
+  const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+  const socket = new WebSocket(`${protocol}//${window.location.host}/ws/location`);
+  
+  socket.onopen = () => {
+    socket.send(JSON.stringify({
+      type: 'hello',
+      user_email: partnerData.email || localStorage.getItem('userEmail') || 'anonymous',
+      delivery_partner_name: partnerData.name || localStorage.getItem('deliveryPartnerName') || 'Unknown',
+      role: partnerData.role || 'Boy'
+    }));
+  };
+  
+  socket.onmessage = (event) => {
+    const frame = JSON.parse(event.data);
+    if (frame.type === 'ack') {
+      handleUplinkAck(frame);
+    }
+  };
+  
+  socket.onclose = () => {
+    if (uplinkSocket === socket) {
+      uplinkSocket = null;
+    }
+  };
+  
+  uplinkSocket = socket;
+}
+
+// Drop acknowledged frames and resend the ones the server could not store
+function handleUplinkAck(ack) {
+  if (ack.rejected.length) {
+    console.warn('Location uplink rejected fixes:', ack.rejected);
+  }
+  
+  const failed = new Set(ack.failed);
+  const retry = [];
+  for (const [seq, frame] of uplinkUnacked) {
+    if (seq > ack.seq) {
+      continue;
+    }
+    uplinkUnacked.delete(seq);
+    if (failed.has(seq)) {
+      retry.push(frame);
+    }
+  }
+  
+  if (retry.length) {
+    console.warn(`Resending ${retry.length} location fix(es) the uplink failed to store`);
+    retry.forEach(frame => sendUplinkFrame(frame));
+  }
+}
+
+// Send one location frame over the uplink, or POST it when the socket is not open
+function sendUplinkFrame(frame) {
+  if (uplinkSocket && uplinkSocket.readyState === WebSocket.OPEN) {
+    const seq = ++uplinkSeq;
+    uplinkUnacked.set(seq, frame);
+    if (uplinkUnacked.size > UPLINK_MAX_UNACKED) {
+      uplinkUnacked.delete(uplinkUnacked.keys().next().value);
+    }
+    uplinkSocket.send(JSON.stringify(Object.assign({ seq: seq }, frame)));
+    return;
+  }
+  
+  sendLocationToServer({ lat: frame.latitude, lng: frame.longitude }, frame.qr_id);
+}
+
+// Close the location uplink WebSocket
+function closeLocationUplink() {
+  if (uplinkSocket) {
+    const socket = uplinkSocket;
+    uplinkSocket = null;
+    socket.close();
+  }
+}
+
 // Send location to server
-async function sendLocationToServer(location) {
+async function sendLocationToServer(location, qrId = currentQRId) {
+  // QR tracking fixes go over the uplink socket while it is open
+  if (qrId && uplinkSocket && uplinkSocket.readyState === WebSocket.OPEN) {
+    sendUplinkFrame({
+      qr_id: qrId,
+      latitude: location.lat,
+      longitude: location.lng,
+      timestamp: Date.now()
+    });
+    return;
+  }
+  
   try {
     // Get delivery partner email from localStorage
     let userEmail = 'anonymous';
@@ -269,8 +373,8 @@ async function sendLocationToServer(location) {
         latitude: location.lat,
         longitude: location.lng,
         user_email: userEmail,
-        qr_id: currentQRId,
-        is_qr_tracking: currentQRId ? true : false  // Special flag for QR tracking
+        qr_id: qrId,
+        is_qr_tracking: qrId ? true : false  // Special flag for QR tracking
       })
     });
     
@@ -283,7 +387,7 @@ async function sendLocationToServer(location) {
     
     // Show notification popup for live location update
     if (result.message) {
-      showLocationUpdateNotification(result.message, currentQRId);
+      showLocationUpdateNotification(result.message, qrId);
     }
     
   } catch (error) {
@@ -390,6 +494,8 @@ function startQRTracking() {
   if (window.qrTrackingInterval) {
     clearInterval(window.qrTrackingInterval);
   }
+  openLocationUplink();
+  
   
   window.qrTrackingInterval = setInterval(() => {
     if (navigator.geolocation && isTracking && currentQRId) {
@@ -423,6 +529,8 @@ function stopQRTracking(reason = 'done_button') {
     window.qrTrackingInterval = null;
   }
   
+  closeLocationUplink();
+  
   if (currentQRId) {
     // Get delivery partner info from localStorage
     let userEmail = 'anonymous';
@@ -979,31 +1087,32 @@ function addCurrentLocationMarker() {
   }
 }
 
-// Calculate and display route using HERE Maps API
+// Calculate and display route using the server's HERE routing proxy
 function calculateAndDisplayRoute() {
-  if (!userLocation || !destination || !platform) {
+  if (!userLocation || !destination || !map) {
     console.log('Missing required data for route calculation');
     displayDirectPath(); // Fallback to direct path
     return;
   }
   
-  console.log('Calculating route using HERE Maps API...');
+  console.log('Calculating route via the server routing proxy...');
   
-  // Get routing service
-  const router = platform.getRoutingService(null, 8);
-  
-  const routeRequestParams = {
-    'routingMode': 'fast',
-    'transportMode': 'car',
-    'origin': `${userLocation.lat},${userLocation.lng}`,
-    'destination': `${destination.lat},${destination.lng}`,
-    'return': 'polyline,summary,actions'
-  };
+  // The server caches routes and budgets HERE quota across API keys
+  const params = new URLSearchParams({
+    origin: `${userLocation.lat},${userLocation.lng}`,
+    destination: `${destination.lat},${destination.lng}`,
+    transportMode: 'car'
+  });
   
-  // Make routing request
-  router.calculateRoute(
-    routeRequestParams,
-    (result) => {
+  fetch(`/api/route?${params}`)
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(`Routing proxy returned ${response.status}`);
+      }
+      console.log('Route source:', response.headers.get('X-Route-Source'));
+      return response.json();
+    })
+    .then(result => {
       console.log('Route calculation successful:', result);
       
       if (result.routes && result.routes.length > 0) {
@@ -1013,13 +1122,12 @@ function calculateAndDisplayRoute() {
         console.log('No routes found, using direct path');
         displayDirectPath();
       }
-    },
-    (error) => {
+    })
+    .catch(error => {
       console.error('Route calculation failed:', error);
       console.log('Falling back to direct path');
       displayDirectPath();
-    }
-  );
+    });
 }
 
 // Display HERE Maps route
@@ -57,9 +57,9 @@ class UserDashboard {
     }
     
     if (qrCodeInput) {
-      // Only allow numeric input and limit to 4 digits
+      // Only allow numeric input (4-digit legacy codes or longer extended codes)
       qrCodeInput.addEventListener('input', (e) => {
-        e.target.value = e.target.value.replace(/[^0-9]/g, '').slice(0, 4);
+        e.target.value = e.target.value.replace(/[^0-9]/g, '').slice(0, 16);
       });
     }
   }
@@ -70,13 +70,13 @@ class UserDashboard {
     const qrCodeInput = document.getElementById('qrCodeInput');
     const qrCode = qrCodeInput.value.trim();
     
-    if (!qrCode || qrCode.length !== 4) {
-      this.showMessage('Please enter a valid 4-digit code', 'error');
+    if (!qrCode || qrCode.length < 4) {
+      this.showMessage('Please enter a valid QR code', 'error');
       return;
     }
 
-    if (!/^\d{4}$/.test(qrCode)) {
-      this.showMessage('QR code must be exactly 4 digits', 'error');
+    if (!/^\d{4,16}$/.test(qrCode)) {
+      this.showMessage('QR code must contain only digits', 'error');
       return;
     }
 
@@ -104,6 +104,9 @@ class UserDashboard {
           
           // Display tracking results with map
           this.displayTrackingResults(data);
+          
+          // Keep the results live instead of refreshing by hand
+          this.startLiveUpdates(qrCode, data);
         } else {
           // This shouldn't happen with our new API, but just in case
           this.showMessage('QR code found but incomplete data', 'warning');
@@ -113,6 +116,7 @@ class UserDashboard {
         if (data.message === 'No delivery boy assigned') {
           this.showMessage('No delivery boy assigned', 'warning');
           this.showNoDeliveryBoyMessage(qrCode);
+          this.startLiveUpdates(qrCode, null);
         } else if (data.message === 'No item exists') {
           this.showMessage('No item exists', 'error');
           this.showNoItemMessage();
@@ -433,6 +437,7 @@ class UserDashboard {
       );
       
       const deliveryMarker = new H.map.Marker({ lat: deliveryLat, lng: deliveryLng }, { icon: deliveryIcon });
+      this.deliveryMarker = deliveryMarker;
       
       // Add markers to map
       map.addObject(destMarker);
@@ -677,6 +682,8 @@ class UserDashboard {
   }
 
   handleLogout() {
+    this.stopLiveUpdates();
+    
     // Clear user data
     localStorage.removeItem('userData');
     localStorage.removeItem('userLoggedIn');
@@ -768,6 +775,82 @@ class UserDashboard {
     return degrees * (Math.PI / 180);
   }
 
+  startLiveUpdates(qrCode, trackingData) {
+    // Server-Sent Events push coordinate B moves and delivery; the browser
+    // reconnects on its own and resumes with Last-Event-ID
+    this.stopLiveUpdates();
+    if (!window.EventSource) return;
+    
+    this.liveTrackingData = trackingData;
+    this.trackingStream = new EventSource(`/api/qr-tracking/${qrCode}/stream`);
+    
+    this.trackingStream.addEventListener('snapshot', (event) => {
+      const data = JSON.parse(event.data);
+      if (data.status === 'delivered') {
+        this.showDeliveryCompletionMessage(data);
+        this.stopLiveUpdates();
+      } else if (data.coordinate_A && data.coordinate_B &&
+                 (!this.liveTrackingData || this.liveTrackingData.last_updated !== data.last_updated)) {
+        this.liveTrackingData = data;
+        this.displayTrackingResults(data);
+      }
+    });
+    
+    this.trackingStream.addEventListener('location', (event) => {
+      const update = JSON.parse(event.data);
+      
+      if (update.status === 'boarded_and_arriving') {
+        this.showBoardedAndArrivingMessage(update);
+        return;
+      }
+      
+      if (!this.liveTrackingData || !this.liveTrackingData.coordinate_A) {
+        // First partner fix for this QR - load the full tracking view once
+        this.refreshTrackingData(qrCode);
+        return;
+      }
+      
+      this.liveTrackingData = { ...this.liveTrackingData, ...update };
+      this.updateLivePosition(this.liveTrackingData);
+    });
+    
+    this.trackingStream.addEventListener('delivered', (event) => {
+      const update = JSON.parse(event.data);
+      this.showDeliveryCompletionMessage({ ...(this.liveTrackingData || {}), ...update });
+      this.stopLiveUpdates();
+    });
+  }
+  
+  stopLiveUpdates() {
+    if (this.trackingStream) {
+      this.trackingStream.close();
+      this.trackingStream = null;
+    }
+  }
+  
+  updateLivePosition(trackingData) {
+    const position = trackingData.coordinate_B;
+    
+    if (!this.deliveryMarker) {
+      this.displayTrackingResults(trackingData);
+      return;
+    }
+    
+    // Move the existing marker instead of rebuilding the map
+    this.deliveryMarker.setGeometry({ lat: position.latitude, lng: position.longitude });
+    
+    const lastUpdated = document.getElementById('lastUpdated');
+    if (lastUpdated) {
+      lastUpdated.textContent = `Last updated: ${new Date(trackingData.last_updated).toLocaleString()}`;
+    }
+    
+    const distance = this.calculateDistance(
+      { lat: trackingData.coordinate_A.latitude, lng: trackingData.coordinate_A.longitude },
+      { lat: position.latitude, lng: position.longitude }
+    );
+    this.updateLocationStatusPanel(trackingData, distance);
+  }
+
   async refreshTrackingData(qrCode) {
     if (!qrCode) return;
     
@@ -784,6 +867,9 @@ class UserDashboard {
       const data = await response.json();
 
       if (response.ok) {
+        if (this.trackingStream) {
+          this.liveTrackingData = data;
+        }
         this.displayTrackingResults(data);
         this.showMessage('Tracking data refreshed!', 'success');
       } else {
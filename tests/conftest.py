@@ -0,0 +1,30 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Services connect at import; point them at a closed local port so that fails fast
+os.environ.setdefault('MONGODB_URI', 'mongodb://127.0.0.1:9/')
+os.environ.setdefault('MONGO_SERVER_SELECTION_TIMEOUT_MS', '200')
+os.environ.setdefault('MONGO_CONNECT_TIMEOUT_MS', '200')
+
+
+@pytest.fixture
+def delivery_client(monkeypatch):
+    pytest.importorskip('flask')
+    pytest.importorskip('pymongo')
+    import delivery_app
+    import mongo_pool
+    from location_dead_band import dead_band
+
+    client = mock.MagicMock()
+    # The real pool's failing heartbeats would open the breaker and drop the fake client
+    monkeypatch.setattr(mongo_pool.breaker, '_listeners', [])
+    monkeypatch.setattr(delivery_app, 'mongo_client', client)
+    monkeypatch.setattr(delivery_app, 'mongo_connected', True)
+    monkeypatch.setattr(delivery_app, 'write_behind_enabled', lambda: False)
+    monkeypatch.setattr(dead_band, 'meters', 0)
+    return delivery_app.app.test_client(), client.get_database.return_value
@@ -0,0 +1,229 @@
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_backs_off_and_closes():
+    clock = FakeClock()
+    breaker = CircuitBreaker('test', failure_threshold=2, base_backoff=1, max_backoff=4, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+
+    # One probe after the backoff; it fails, so the next wait doubles
+    clock.now += 1
+    assert breaker.allow_request()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.backoff == 2
+
+    clock.now += 2
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.backoff == 1
+
+
+def test_listeners_may_call_back_into_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker('test', failure_threshold=1, base_backoff=1, clock=clock)
+    seen = []
+    breaker.add_listener(lambda old, new: seen.append((old, new, breaker.snapshot()['state'], breaker.allow_request())))
+
+    breaker.record_failure()
+    clock.now += 1
+    assert breaker.allow_request()
+    breaker.record_success()
+
+    # The half-open listener's own allow_request is refused: the probe is already out
+    assert seen == [(CLOSED, OPEN, OPEN, False), (OPEN, HALF_OPEN, HALF_OPEN, False), (HALF_OPEN, CLOSED, CLOSED, True)]
+
+
+class StandInMongo:
+    """
+    Just enough of the MongoDB wire protocol for the driver's handshake,
+    heartbeats and ping. stop() closes the listener (connections are then
+    refused) and start() listens again on the same port.
+    """
+
+    def __init__(self):
+        self.port = None
+        self._listener = None
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port or 0))
+        listener.listen(16)
+        listener.settimeout(0.05)
+        self.port = listener.getsockname()[1]
+        self._listener = listener
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._listener.close()
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                connection.close()
+            self._connections = []
+
+    def _accept(self, listener):
+        # Poll, since closing the listener does not wake a thread blocked in accept()
+        while listener.fileno() != -1:
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.settimeout(None)
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _read(connection, size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def _serve(self, connection):
+        import bson
+
+        try:
+            while True:
+                length, request_id, _, op_code = struct.unpack('<iiii', self._read(connection, 16))
+                body = self._read(connection, length - 16)
+                if op_code == OP_QUERY:
+                    name_end = body.index(b'\x00', 4)
+                    command = bson.decode(body[name_end + 9:])  # skip numberToSkip and numberToReturn
+                    reply = bson.encode(self._reply(command))
+                    payload = struct.pack('<iqii', 0, 0, 0, 1) + reply
+                    op_reply = OP_REPLY
+                else:
+                    command = bson.decode(body[5:])  # flagBits, then a kind 0 section
+                    payload = struct.pack('<i', 0) + b'\x00' + bson.encode(self._reply(command))
+                    op_reply = OP_MSG
+                header = struct.pack('<iiii', 16 + len(payload), request_id + 1, request_id, op_reply)
+                connection.sendall(header + payload)
+        except (ConnectionError, OSError):
+            connection.close()
+
+    @staticmethod
+    def _reply(command):
+        name = next(iter(command)).lower()
+        if name in ('ismaster', 'hello'):
+            return {
+                'ok': 1.0, 'ismaster': True, 'isWritablePrimary': True, 'helloOk': True,
+                'minWireVersion': 0, 'maxWireVersion': 17, 'maxBsonObjectSize': 16777216,
+                'maxMessageSizeBytes': 48000000, 'maxWriteBatchSize': 100000,
+                'localTime': datetime.utcnow(), 'connectionId': 1
+            }
+        return {'ok': 1.0}
+
+
+def wait_for(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def stand_in_pool(monkeypatch):
+    pytest.importorskip('pymongo')
+    import mongo_pool
+
+    server = StandInMongo()
+    server.start()
+
+    # Start from a fresh client pointed at the stand-in, with a breaker fed only by it
+    if mongo_pool._client is not None:
+        mongo_pool._client.close()
+    monkeypatch.setattr(mongo_pool, '_client', None)
+    monkeypatch.setitem(mongo_pool._health, 'servers', {})
+    monkeypatch.setattr(mongo_pool, 'breaker', CircuitBreaker('mongodb', failure_threshold=3, base_backoff=1, max_backoff=8))
+    monkeypatch.setenv('MONGODB_URI', f'mongodb://127.0.0.1:{server.port}/?directConnection=true')
+    monkeypatch.setenv('MONGO_HEARTBEAT_FREQUENCY_MS', '500')
+    monkeypatch.setenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '1000')
+    monkeypatch.setenv('MONGO_CONNECT_TIMEOUT_MS', '500')
+    monkeypatch.setenv('MONGO_SOCKET_TIMEOUT_MS', '1000')
+
+    yield mongo_pool, server
+
+    if mongo_pool._client is not None:
+        mongo_pool._client.close()
+    server.stop()
+
+
+def test_breaker_trips_short_circuits_and_recovers(stand_in_pool, monkeypatch):
+    pytest.importorskip('flask')
+    import delivery_app
+
+    mongo_pool, server = stand_in_pool
+    mongo_pool.breaker.add_listener(delivery_app.on_breaker_state_change)
+    monkeypatch.setattr(delivery_app, 'mongo_client', None)
+    monkeypatch.setattr(delivery_app, 'mongo_connected', False)
+
+    assert mongo_pool.connect()
+    assert wait_for(mongo_pool.is_healthy)
+    assert delivery_app.initialize_mongodb()
+    assert delivery_app.mongo_client is mongo_pool.get_client()
+
+    # Outage: heartbeats are refused until the breaker opens and the service drops its client
+    server.stop()
+    assert wait_for(lambda: mongo_pool.breaker.state == OPEN)
+    assert delivery_app.mongo_client is None
+
+    # Requests fail without waiting on server selection
+    started = time.monotonic()
+    assert not delivery_app.initialize_mongodb()
+    assert time.monotonic() - started < 0.1
+    assert delivery_app.mongo_client is None
+
+    # After the backoff one probe goes through; the failing heartbeat reopens with a longer backoff
+    assert wait_for(lambda: mongo_pool.breaker.snapshot()['next_probe_in_seconds'] == 0)
+    assert mongo_pool.allow_request()
+    assert mongo_pool.breaker.state == HALF_OPEN
+    assert wait_for(lambda: mongo_pool.breaker.state == OPEN)
+    assert mongo_pool.breaker.backoff == 2
+
+    # Recovery: the first good heartbeat closes the breaker and requests reconnect
+    server.start()
+    assert wait_for(lambda: mongo_pool.breaker.state == CLOSED)
+    assert mongo_pool.breaker.backoff == 1
+    assert delivery_app.initialize_mongodb()
+    assert delivery_app.mongo_client.admin.command('ping')['ok'] == 1.0
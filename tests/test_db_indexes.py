@@ -0,0 +1,18 @@
+import db_indexes
+
+
+def test_every_query_shape_has_a_declared_index():
+    assert db_indexes.check_query_shapes() == []
+
+
+def test_check_reports_a_shape_without_an_index(monkeypatch):
+    monkeypatch.setattr(db_indexes, 'QUERY_SHAPES', [('locations', ['delivery_status'], [])])
+
+    assert db_indexes.check_query_shapes() == [('locations', ['delivery_status'], [])]
+
+
+def test_explain_filter_uses_near_sphere_for_geo_fields():
+    explain_filter = db_indexes._explain_filter('partner_positions', ['location', 'companies'])
+
+    assert '$nearSphere' in explain_filter['location']
+    assert explain_filter['companies'] == 0
@@ -0,0 +1,70 @@
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+
+import geofence
+from geofence import GeofenceEngine
+
+DESTINATION = (12.9700, 77.5900)
+
+
+def make_engine(clock, **options):
+    engine = GeofenceEngine(get_database=None, clock=lambda: clock[0], **options)
+    engine.set_destination('1001', *DESTINATION)
+    return engine
+
+
+def test_arriving_then_arrived_after_dwell():
+    clock = [1000.0]
+    engine = make_engine(clock, dwell=20)
+
+    engine.update('1001', 'a@example.com', 12.9720, 77.5900)  # ~220 m out
+    assert [event[0] for event in engine.evaluate()] == ['arriving']
+
+    engine.update('1001', 'a@example.com', 12.9702, 77.5900)  # ~22 m out
+    clock[0] += 2
+    assert engine.evaluate() == []
+    clock[0] += 20
+    events = engine.evaluate()
+    assert [(event[0], event[1], event[2]) for event in events] == [('arrived', '1001', 'a@example.com')]
+    assert engine.evaluate() == []
+
+
+def test_leaving_clears_arriving():
+    clock = [1000.0]
+    engine = make_engine(clock, dwell=20)
+
+    engine.update('1001', 'a@example.com', 12.9720, 77.5900)
+    engine.evaluate()
+    engine.update('1001', 'a@example.com', 12.9800, 77.5900)  # ~1.1 km out
+    assert engine.evaluate() == []
+    engine.update('1001', 'a@example.com', 12.9720, 77.5900)
+    assert [event[0] for event in engine.evaluate()] == ['arriving']
+
+
+def test_stale_and_delivered_rows_are_dropped():
+    clock = [1000.0]
+    engine = make_engine(clock, max_age=60)
+    engine.update('1001', 'a@example.com', 12.9800, 77.5900)
+    engine.update('1002', 'b@example.com', 12.9800, 77.5900)
+    engine.delivered('1001')
+    assert len(engine) == 1
+
+    clock[0] += 61
+    engine.evaluate()
+    assert len(engine) == 0
+
+
+def test_auto_deliver_loses_race_quietly(monkeypatch):
+    from pymongo.errors import DuplicateKeyError
+
+    db = mock.MagicMock()
+    db.get_collection.return_value.update_one.side_effect = DuplicateKeyError('E11000')
+    published = []
+    monkeypatch.setattr(geofence, 'publish_delivered', lambda *args: published.append(args))
+
+    assert geofence.auto_deliver(db, '1001', 'a@example.com', 'Asha') is False
+    assert published == []
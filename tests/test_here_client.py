@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+import here_client
+from here_client import (
+    HereClient, HereUnavailable, RouteCache, SharedKeyBudget, StubRouter, decode_polyline, encode_polyline
+)
+
+# HERE's flexible polyline reference example (github.com/heremaps/flexible-polyline)
+REFERENCE_POINTS = [(50.1022829, 8.6982122), (50.1020076, 8.6956695), (50.1006313, 8.6914960), (50.0987800, 8.6875156)]
+REFERENCE_POLYLINE = 'BFoz5xJ67i1B1B7PzIhaxL7Y'
+REFERENCE_POLYLINE_3D = 'BlBoz5xJ67i1BU1B7PUzIhaUxL7YU'  # same points with an altitude
+
+
+def test_polyline_matches_here_reference():
+    assert encode_polyline(REFERENCE_POINTS) == REFERENCE_POLYLINE
+
+    precision, points = decode_polyline(REFERENCE_POLYLINE)
+    assert precision == 5
+    assert points == [(round(lat, 5), round(lng, 5)) for lat, lng in REFERENCE_POINTS]
+    assert decode_polyline(REFERENCE_POLYLINE_3D) == (precision, points)
+
+
+def test_polyline_round_trip():
+    points = [(12.97194, 77.59369), (-33.86785, 151.20732), (0.0, -0.00001), (89.99999, -179.99999)]
+
+    for precision in (5, 6):
+        assert decode_polyline(encode_polyline(points, precision)) == (precision, points)
+
+
+def test_truncated_polyline_is_rejected():
+    with pytest.raises(ValueError):
+        decode_polyline(REFERENCE_POLYLINE[:-1])
+
+
+def test_route_cache_hit_reuse_and_miss():
+    stub = StubRouter()
+    cache = RouteCache(stub)
+    start, destination = (12.9700, 77.5900), (12.9900, 77.5900)
+
+    full, source = cache.get_route(start, destination)
+    assert source == 'miss'
+    assert cache.get_route(start, destination)[1] == 'hit'
+
+    # Halfway along the cached straight line: the rest of it is served without HERE
+    halfway = (12.9800, 77.5900)
+    rest, source = cache.get_route(halfway, destination)
+    assert source == 'reuse'
+    assert decode_polyline(rest['routes'][0]['sections'][0]['polyline'])[1][0] == halfway
+    full_length = full['routes'][0]['sections'][0]['summary']['length']
+    assert rest['routes'][0]['sections'][0]['summary']['length'] == pytest.approx(full_length / 2, rel=0.01)
+
+    # A kilometre off the route needs a new one
+    assert cache.get_route((12.9800, 77.6000), destination)[1] == 'miss'
+    assert stub.calls == 2
+
+
+def test_shared_flight_raises_the_leaders_error(monkeypatch):
+    entered, release, follower_waiting = threading.Event(), threading.Event(), threading.Event()
+
+    class WatchedEvent(threading.Event):
+        def wait(self, timeout=None):
+            follower_waiting.set()
+            return super().wait(timeout)
+
+    class WatchedFlight(here_client._Flight):
+        def __init__(self):
+            super().__init__()
+            self.done = WatchedEvent()
+
+    class FailingRouter:
+        calls = 0
+
+        def route(self, origin, destination, transport_mode):
+            self.calls += 1
+            entered.set()
+            release.wait(5)
+            raise HereUnavailable('HERE routing failed with status 503')
+
+    monkeypatch.setattr(here_client, '_Flight', WatchedFlight)
+    upstream = FailingRouter()
+    cache = RouteCache(upstream)
+    errors = {}
+
+    def request(name):
+        try:
+            cache.get_route((12.97, 77.59), (12.99, 77.59))
+        except HereUnavailable as e:
+            errors[name] = e
+
+    leader = threading.Thread(target=request, args=('leader',))
+    leader.start()
+    assert entered.wait(5)
+    follower = threading.Thread(target=request, args=('follower',))
+    follower.start()
+    assert follower_waiting.wait(5)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert upstream.calls == 1
+    assert errors['follower'] is errors['leader']
+
+
+class FakeUsage:
+    """here_key_usage with update_one's upsert semantics for the budget filter"""
+
+    def __init__(self):
+        self.counts = {}
+
+    def update_one(self, query, update, upsert=False):
+        from pymongo.errors import DuplicateKeyError
+
+        count = self.counts.get(query['_id'])
+        if count is not None and count >= query['count']['$lt']:
+            raise DuplicateKeyError('E11000')
+        self.counts[query['_id']] = (count or 0) + update['$inc']['count']
+
+
+class FakeDatabase:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get_collection(self, name):
+        assert name == here_client.KEY_USAGE_COLLECTION
+        return self.collection
+
+
+def test_shared_budget_is_shared_between_clients():
+    pytest.importorskip('pymongo')
+    usage = FakeUsage()
+    budget = SharedKeyBudget(lambda: FakeDatabase(usage), clock=lambda: 600.0)
+
+    # Two workers with one key and a budget of 3 per minute
+    first = HereClient(['key'], budget_per_minute=3, shared_budget=budget)
+    second = HereClient(['key'], budget_per_minute=3, shared_budget=budget)
+
+    assert [first._take_key(), second._take_key(), first._take_key()] == [0, 0, 0]
+    assert second._take_key() is None
+    assert list(usage.counts) == [f"{here_client.key_fingerprint('key')}:10"]
+
+
+def test_worker_count_is_used_while_mongodb_is_unavailable():
+    budget = SharedKeyBudget(lambda: None, is_available=lambda: False)
+    client = HereClient(['a', 'b'], budget_per_minute=1, shared_budget=budget, clock=lambda: 0.0)
+
+    assert [client._take_key(), client._take_key(), client._take_key()] == [0, 1, None]
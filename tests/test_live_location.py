@@ -0,0 +1,99 @@
+from datetime import datetime
+
+from live_location import build_qr_location_doc, validate_fix
+
+
+def test_build_qr_location_doc_coordinates():
+    doc = build_qr_location_doc('1001', 'a@example.com', 'Asha', 'Boy', False, 12.97, 77.59)
+
+    assert doc['type'] == 'delivery_location'
+    assert doc['location_type'] == 'coordinates'
+    assert (doc['latitude'], doc['longitude']) == (12.97, 77.59)
+    assert isinstance(doc['timestamp'], datetime)
+
+
+def test_build_qr_location_doc_role_only():
+    timestamp = datetime(2026, 1, 1, 12, 0)
+    doc = build_qr_location_doc('1001', 'p@example.com', 'Ravi', 'Pilot', True, 12.97, 77.59, timestamp)
+
+    assert doc['location_type'] == 'role_only'
+    assert doc['status'] == 'BOARDED AND ARRIVING'
+    assert 'latitude' not in doc and 'longitude' not in doc
+    assert doc['timestamp'] == timestamp
+
+
+def test_build_qr_location_doc_role_only_needs_aviation_role():
+    doc = build_qr_location_doc('1001', 'a@example.com', 'Asha', 'Boy', True, 12.97, 77.59)
+
+    assert doc['location_type'] == 'coordinates'
+
+
+def _stored_doc(db):
+    """The $set of the delivery_location upsert"""
+    for (query, changes), _ in db.get_collection.return_value.update_one.call_args_list:
+        if query.get('type') == 'delivery_location':
+            return changes['$set']
+    raise AssertionError('no delivery_location upsert')
+
+
+def test_store_live_location_coordinates(delivery_client):
+    client, db = delivery_client
+    response = client.post('/api/store-live-location', json={
+        'qr_id': '1001', 'user_email': 'a@example.com', 'delivery_partner_name': 'Asha',
+        'latitude': 12.97, 'longitude': 77.59
+    })
+
+    assert response.status_code == 200
+    doc = _stored_doc(db)
+    assert doc['location_type'] == 'coordinates'
+    assert (doc['latitude'], doc['longitude']) == (12.97, 77.59)
+
+
+def test_store_live_location_role_only(delivery_client):
+    client, db = delivery_client
+    response = client.post('/api/store-live-location', json={
+        'qr_id': '1001', 'user_email': 'p@example.com', 'delivery_partner_name': 'Ravi',
+        'latitude': 12.97, 'longitude': 77.59, 'role_only': True, 'role': 'Captain'
+    })
+
+    assert response.status_code == 200
+    assert response.get_json()['coordinate_type'] == 'role_only'
+    doc = _stored_doc(db)
+    assert doc['location_type'] == 'role_only'
+    assert 'latitude' not in doc
+
+
+def test_uplink_location_doc(delivery_client):
+    import delivery_app
+
+    timestamp = datetime(2026, 1, 1, 12, 0)
+    frame = {
+        'qr_id': '1001', 'user_email': 'a@example.com', 'latitude': 12.97, 'longitude': 77.59,
+        'timestamp': timestamp, 'role_only': False, 'role': None, 'delivery_partner_name': None
+    }
+    doc = delivery_app.uplink_location_doc(frame)
+    assert doc['location_type'] == 'coordinates'
+    assert doc['delivery_partner_name'] == 'Unknown'
+    assert doc['timestamp'] == timestamp
+
+    doc = delivery_app.uplink_location_doc(dict(frame, role_only=True, role='tc'))
+    assert doc['location_type'] == 'role_only'
+
+
+def test_validate_fix_clamps_future_timestamps():
+    fix, error = validate_fix({
+        'qr_id': '1001', 'user_email': 'a@example.com', 'latitude': 12.97, 'longitude': 77.59,
+        'timestamp': 4102444800000  # 2100-01-01
+    })
+
+    assert error is None
+    assert fix['timestamp'] <= datetime.utcnow()
+
+
+def test_validate_fix_keeps_past_timestamps():
+    fix, _ = validate_fix({
+        'qr_id': '1001', 'user_email': 'a@example.com', 'latitude': 12.97, 'longitude': 77.59,
+        'timestamp': '2026-01-01T12:00:00Z'
+    })
+
+    assert fix['timestamp'] == datetime(2026, 1, 1, 12, 0)
@@ -0,0 +1,36 @@
+from unittest import mock
+
+
+def test_mark_delivered_records_delivery_complete(delivery_client, monkeypatch):
+    import delivery_app
+
+    client, db = delivery_client
+    bumped = []
+    monkeypatch.setattr(delivery_app, 'bump_qr_versions', lambda db, qr_ids: bumped.extend(qr_ids))
+    shipments = db.get_collection.return_value
+    shipments.update_one.return_value = mock.Mock(upserted_id='new')
+
+    response = client.post('/mark-delivered', json={
+        'qr_id': '1001', 'delivery_partner_name': 'Asha', 'user_email': 'a@example.com'
+    })
+
+    assert response.status_code == 200
+    (query, update), kwargs = shipments.update_one.call_args_list[0]
+    assert query == {'qr_id': '1001', 'type': 'delivery_complete'}
+    assert update['$setOnInsert']['delivery_partner_name'] == 'Asha'
+    assert kwargs['upsert'] is True
+    assert bumped == ['1001']
+
+
+def test_mark_delivered_twice_keeps_the_first_completion(delivery_client, monkeypatch):
+    import delivery_app
+
+    client, db = delivery_client
+    bumped = []
+    monkeypatch.setattr(delivery_app, 'bump_qr_versions', lambda db, qr_ids: bumped.extend(qr_ids))
+    db.get_collection.return_value.update_one.return_value = mock.Mock(upserted_id=None)
+
+    response = client.post('/mark-delivered', json={'qr_id': '1001', 'delivery_partner_name': 'Asha'})
+
+    assert response.status_code == 200
+    assert bumped == []
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+pytest.importorskip('flask')
+
+from response_cache import ResponseCache, MemoryBackend
+
+
+def failing_load():
+    raise RuntimeError('MongoDB down')
+
+
+def test_body_cached_under_an_older_version_is_rebuilt():
+    cache = ResponseCache(MemoryBackend())
+    assert json.loads(cache.fetch('users', lambda: ['a'], version='users.1')) == ['a']
+
+    # Another worker registered a user: same key, newer version
+    assert json.loads(cache.fetch('users', lambda: ['a', 'b'], version='users.2')) == ['a', 'b']
+    assert json.loads(cache.fetch('users', failing_load, version='users.2')) == ['a', 'b']
+
+
+def test_older_version_is_not_served_when_the_rebuild_fails():
+    cache = ResponseCache(MemoryBackend())
+    cache.fetch('users', lambda: ['a'], version='users.1')
+
+    with pytest.raises(RuntimeError):
+        cache.fetch('users', failing_load, version='users.2')
+
+
+def test_stale_serves_the_last_body_until_it_is_too_old():
+    backend = MemoryBackend()
+    cache = ResponseCache(backend, ttl=10, stale=100)
+    assert cache.stale('companies') is None
+
+    cache.fetch('companies', lambda: [1])
+    assert json.loads(cache.stale('companies')) == [1]
+
+    stored_at, version, body = backend.get('companies')
+    backend.set('companies', stored_at - 200, version, body, 110)
+    assert cache.stale('companies') is None
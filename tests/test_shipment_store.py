@@ -0,0 +1,158 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('bson')
+from bson import ObjectId
+
+import shipment_store
+
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$ne' in condition and value == condition['$ne']:
+                return False
+            if '$lt' in condition and not (value is not None and value < condition['$lt']):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda doc: doc.get(field) or datetime.min, reverse=direction < 0))
+
+
+class FakeCollection:
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(doc for doc in self.docs if _matches(doc, query or {}))
+
+    def aggregate(self, pipeline):
+        raise AssertionError('per_qr storage has no shipments collection to aggregate over')
+
+
+class FakeDatabase:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def get_collection(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def per_qr_db(monkeypatch):
+    monkeypatch.setattr(shipment_store, 'STORAGE_MODE', 'per_qr')
+    first, second, third = ObjectId(), ObjectId(), ObjectId()
+    return FakeDatabase({
+        'locations': FakeCollection([
+            {'_id': first, 'qr_id': '1001', 'company_id': 7, 'timestamp': datetime(2026, 1, 1)},
+            {'_id': second, 'qr_id': '1002', 'company_id': 7, 'timestamp': datetime(2026, 1, 2)},
+            {'_id': third, 'qr_id': '1003', 'company_id': 7, 'timestamp': datetime(2026, 1, 3)},
+        ]),
+        '1001': FakeCollection([
+            {'type': 'destination_info', 'location_name': 'Depot', 'timestamp': datetime(2026, 1, 1)},
+            {'type': 'delivery_location', 'user_email': 'a@example.com', 'delivery_partner_name': 'Asha',
+             'latitude': 12.9, 'longitude': 77.5, 'location_type': 'coordinates', 'timestamp': datetime(2026, 1, 1, 9)},
+            {'type': 'delivery_complete', 'delivered_at': datetime(2026, 1, 1, 10), 'rating': 4,
+             'timestamp': datetime(2026, 1, 1, 10)},
+        ]),
+        '1002': FakeCollection([
+            {'type': 'qr_info', 'location_name': 'Office', 'timestamp': datetime(2026, 1, 2)},
+            {'type': 'delivery_location', 'user_email': 'a@example.com', 'delivery_partner_name': 'Asha',
+             'location_type': 'coordinates', 'latitude': 12.8, 'longitude': 77.6, 'timestamp': datetime(2026, 1, 2, 9)},
+        ]),
+    })
+
+
+def test_company_orders_per_qr(per_qr_db):
+    orders, next_cursor = shipment_store.get_company_orders_page(per_qr_db, 7, limit=2)
+
+    assert [(order['qr_id'], order['status'], order['destination']) for order in orders] == [
+        ('1003', 'Pending', 'Unknown'),
+        ('1002', 'In Progress', 'Office'),
+    ]
+    assert orders[1]['delivery_partner'] == 'Asha'
+
+    orders, next_cursor = shipment_store.get_company_orders_page(per_qr_db, 7, cursor=next_cursor, limit=2)
+    assert [(order['qr_id'], order['status']) for order in orders] == [('1001', 'Delivered')]
+    assert orders[0]['delivered_at'] == datetime(2026, 1, 1, 10)
+    assert next_cursor is None
+
+
+def test_company_orders_per_qr_status_filter(per_qr_db):
+    orders, _ = shipment_store.get_company_orders_page(per_qr_db, 7, status='Delivered')
+
+    assert [order['qr_id'] for order in orders] == ['1001']
+
+
+def test_partner_metrics_per_qr(per_qr_db):
+    metrics = shipment_store.get_partner_metrics(per_qr_db, 7)
+
+    assert metrics == {'a@example.com': {
+        '_id': 'a@example.com', 'active_orders': 1, 'completed_orders': 1, 'rating_total': 4, 'rating_count': 1
+    }}
+
+
+def test_completion_collection_gets_a_unique_index_per_qr(monkeypatch):
+    from unittest import mock
+
+    monkeypatch.setattr(shipment_store, 'STORAGE_MODE', 'per_qr')
+    monkeypatch.setattr(shipment_store, '_completion_indexed', set())
+    db = mock.MagicMock()
+    db.get_collection.return_value.name = '1001'
+
+    shipment_store.get_completion_collection(db, '1001')
+    shipment_store.get_completion_collection(db, '1001')
+
+    db.get_collection.assert_called_with('1001')
+    create_index = db.get_collection.return_value.create_index
+    create_index.assert_called_once_with(
+        [('type', 1)], name='delivery_complete_unique', unique=True,
+        partialFilterExpression={'type': 'delivery_complete'}
+    )
+
+
+class FakeShipments(FakeCollection):
+    def create_index(self, keys, **options):
+        pass
+
+    def find_one(self, query, projection=None):
+        return next(iter(self.find(query)), None)
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.docs = [doc for doc in self.docs if doc['_id'] != operation._filter['_id']]
+            self.docs.append(operation._doc)
+
+
+def test_migration_keeps_the_earliest_delivery_complete():
+    pytest.importorskip('pymongo')
+    first, second, location = ObjectId(), ObjectId(), ObjectId()
+    shipments = FakeShipments()
+    db = FakeDatabase({
+        'shipments': shipments,
+        '1001': FakeCollection([
+            {'_id': location, 'type': 'delivery_location', 'timestamp': datetime(2026, 1, 1, 9)},
+            {'_id': second, 'type': 'delivery_complete', 'timestamp': datetime(2026, 1, 1, 10, 0, 1)},
+            {'_id': first, 'type': 'delivery_complete', 'timestamp': datetime(2026, 1, 1, 10)},
+        ]),
+    })
+    db.list_collection_names = lambda: list(db.collections)
+
+    summary = shipment_store.migrate_qr_collections(db)
+
+    assert summary['duplicate_completions'] == 1
+    assert sorted(doc['_id'] for doc in shipments.docs) == sorted([location, first])
+    assert all(doc['qr_id'] == '1001' for doc in shipments.docs)
+
+    # Re-running keeps the completion already in shipments
+    assert shipment_store.migrate_qr_collections(db)['duplicate_completions'] == 1
+    assert len(shipments.docs) == 2
@@ -0,0 +1,17 @@
+from tracking_events import TrackingEventBus
+
+
+def test_failing_listener_does_not_fail_the_publish():
+    bus = TrackingEventBus()
+    received = []
+
+    def broken(qr_id, event):
+        raise RuntimeError('listener bug')
+
+    bus.add_listener(broken)
+    bus.add_listener(lambda qr_id, event: received.append((qr_id, event[1])))
+
+    event_id = bus.publish('1001', 'location', {'qr_id': '1001'})
+
+    assert bus.latest_id('1001') == event_id
+    assert received == [('1001', 'location')]
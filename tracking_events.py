@@ -0,0 +1,208 @@
+"""
+In-process event bus and Server-Sent Events stream for QR tracking.
+
+store_live_location, the batch endpoint and mark_delivered publish an event
+whenever coordinate B moves or an order is delivered. Tracking pages
+subscribe through /api/qr-tracking/<qr_id>/stream instead of polling
+/api/qr-tracking/<qr_id>, so reads scale with updates rather than with
+watchers x poll rate.
+
+Event types:
+- snapshot: the full /api/qr-tracking/<qr_id> body (sent on connect and
+  whenever a resume is impossible)
+- location: {'qr_id', 'status', 'coordinate_B', 'last_updated'}
+- delivered: {'qr_id', 'status', 'delivered_at', 'delivery_partner_name'}
+- arriving / arrived: {'qr_id', 'status', 'user_email', 'distance_m', ...}
+  (GEOFENCE_ENABLED=true, see geofence)
+
+Event IDs grow across restarts (they start from the clock), and the last
+TRACKING_EVENT_HISTORY events per QR are kept so a client reconnecting with
+Last-Event-ID gets what it missed. With TRACKING_EVENT_SOURCE=change_stream
+events come from the MongoDB change stream (see change_hub) instead of the
+writing request, so every service sees every write. Streams send a heartbeat comment every
+SSE_HEARTBEAT_SECONDS and close after SSE_MAX_STREAM_SECONDS (browsers
+reconnect automatically).
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = int(os.environ.get('TRACKING_EVENT_HISTORY', '50'))
+MAX_TRACKED_QRS = int(os.environ.get('TRACKING_EVENT_MAX_QRS', '10000'))
+HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+MAX_STREAM_SECONDS = float(os.environ.get('SSE_MAX_STREAM_SECONDS', '300'))
+
+# 'local' (events published by the request that made the write) or 'change_stream'
+EVENT_SOURCE = os.environ.get('TRACKING_EVENT_SOURCE', 'local').lower()
+
+# Reconnect delay suggested to EventSource clients
+RETRY_MILLISECONDS = 3000
+
+
+class TrackingEventBus:
+    """Per-QR event history with blocking waits for new events"""
+
+    def __init__(self, history_size=HISTORY_SIZE, max_qrs=MAX_TRACKED_QRS):
+        self.history_size = history_size
+        self.max_qrs = max_qrs
+        self._condition = threading.Condition()
+        self._history = OrderedDict()  # qr_id -> deque of (event_id, event_type, data), least recently used first
+        self._last_id = int(time.time() * 1000)
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(qr_id, (event_id, event_type, data)) after every publish"""
+        self._listeners.append(listener)
+
+    def publish(self, qr_id, event_type, data):
+        """Record an event for a QR code and wake its subscribers; returns the event ID"""
+        qr_id = str(qr_id)
+        with self._condition:
+            self._last_id += 1
+            history = self._history.get(qr_id)
+            if history is None:
+                history = self._history[qr_id] = deque(maxlen=self.history_size)
+                if len(self._history) > self.max_qrs:
+                    self._history.popitem(last=False)
+            else:
+                self._history.move_to_end(qr_id)
+            history.append((self._last_id, event_type, data))
+            self._condition.notify_all()
+            event_id = self._last_id
+
+        for listener in self._listeners:
+            try:
+                listener(qr_id, (event_id, event_type, data))
+            except Exception as e:
+                # The write that published the event has already happened - never fail it
+                logger.error(f"Tracking event listener failed for QR {qr_id}: {str(e)}")
+        metrics.inc('tracking_events_published_total', type=event_type)
+        return event_id
+
+    def latest_id(self, qr_id):
+        """ID of the newest event kept for a QR code (0 if none)"""
+        with self._condition:
+            history = self._history.get(str(qr_id))
+            return history[-1][0] if history else 0
+
+    def can_resume(self, qr_id, last_event_id):
+        """True if every event after last_event_id is still in the history"""
+        with self._condition:
+            history = self._history.get(str(qr_id))
+            if not history:
+                return False
+            return any(event_id == last_event_id for event_id, _, _ in history)
+
+    def wait(self, qr_id, last_event_id, timeout):
+        """Block until an event newer than last_event_id exists (or timeout); returns the new events"""
+        qr_id = str(qr_id)
+        with self._condition:
+            self._condition.wait_for(lambda: self._newest(qr_id) > last_event_id, timeout)
+            return [event for event in self._history.get(qr_id) or () if event[0] > last_event_id]
+
+    def _newest(self, qr_id):
+        history = self._history.get(qr_id)
+        return history[-1][0] if history else 0
+
+
+bus = TrackingEventBus()
+
+
+def event_source():
+    """'local' or 'change_stream' - where tracking events come from"""
+    return EVENT_SOURCE
+
+
+def _timestamp(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def publish_location(doc, source='local'):
+    """Publish a delivery_location document (as stored by store_live_location)"""
+    if source != EVENT_SOURCE:
+        return
+    if doc.get('location_type') == 'role_only':
+        data = {
+            'qr_id': doc['qr_id'],
+            'status': 'boarded_and_arriving',
+            'delivery_partner_name': doc.get('delivery_partner_name', 'Unknown'),
+            'role': doc.get('role', '')
+        }
+    else:
+        data = {
+            'qr_id': doc['qr_id'],
+            'status': 'tracking_active',
+            'delivery_status': 'driver_assigned',
+            'coordinate_B': {
+                'type': 'delivery_partner',
+                'latitude': doc.get('latitude'),
+                'longitude': doc.get('longitude'),
+                'user_email': doc.get('user_email', ''),
+                'delivery_partner_name': doc.get('delivery_partner_name', 'Unknown'),
+                'timestamp': _timestamp(doc.get('timestamp'))
+            },
+            'last_updated': _timestamp(doc.get('timestamp'))
+        }
+    bus.publish(doc['qr_id'], 'location', data)
+
+
+def publish_delivered(qr_id, delivery_partner_name, delivered_at, source='local'):
+    """Publish the delivered transition for a QR code"""
+    if source != EVENT_SOURCE:
+        return
+    bus.publish(qr_id, 'delivered', {
+        'qr_id': str(qr_id),
+        'status': 'delivered',
+        'delivery_status': 'delivered',
+        'delivered_at': _timestamp(delivered_at),
+        'delivery_partner_name': delivery_partner_name
+    })
+
+
+def parse_last_event_id(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def format_event(event_id, event_type, data):
+    """One SSE frame"""
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def event_stream(qr_id, cursor, snapshot=None, heartbeat=HEARTBEAT_SECONDS, max_duration=MAX_STREAM_SECONDS):
+    """
+    Generate SSE frames for a QR code starting after event ID `cursor`.
+
+    snapshot (if given) is sent first with ID `cursor`. The stream ends after
+    a delivered event or after max_duration seconds.
+    """
+    metrics.inc('tracking_streams_opened_total')
+    started = time.monotonic()
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        if snapshot is not None:
+            yield format_event(cursor, 'snapshot', snapshot)
+            if snapshot.get('status') == 'delivered':
+                return
+
+        while time.monotonic() - started < max_duration:
+            events = bus.wait(qr_id, cursor, heartbeat)
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+            for event_id, event_type, data in events:
+                cursor = event_id
+                yield format_event(event_id, event_type, data)
+                if event_type == 'delivered':
+                    return
+    finally:
+        metrics.inc('tracking_streams_closed_total')
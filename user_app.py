@@ -1,11 +1,22 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
 import sys
 import time
 import random
+import mongo_pool
+import metrics
+from db_indexes import ensure_indexes_once
+from sequences import next_id
+from shipment_store import get_qr_collection
+from qr_ids import is_valid_qr_id
+from location_trail import get_trail, parse_time, trail_enabled, MAX_TRAIL_POINTS
+from tracking_events import bus as tracking_bus, event_stream, event_source, parse_last_event_id
+from change_hub import hub as tracking_hub
+from change_versions import bump_versions, current_etag, not_modified, tag_response, qr_scope, USERS_SCOPE
+from response_cache import response_cache, json_response, USERS, USERS_FULL
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -55,19 +66,35 @@ def get_users():
         
         if mongo_client:
             try:
-                users_collection = mongo_client.get_database("tracksmart").get_collection("users")
-                users = list(users_collection.find({}, {'password': 0}))  # Exclude passwords
+                db = mongo_client.get_database("tracksmart")
+                
+                # No registration since the client's copy - skip the scan
+                etag = current_etag(db, USERS_SCOPE)
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
                 
-                # Convert ObjectId to string for JSON serialization
-                for user in users:
-                    user['_id'] = str(user['_id'])
+                users_collection = db.get_collection("users")
                 
-                return jsonify(users)
+                def load_users():
+                    users = list(users_collection.find({}, {'password': 0}))  # Exclude passwords
+                    
+                    # Convert ObjectId to string for JSON serialization
+                    for user in users:
+                        user['_id'] = str(user['_id'])
+                    return users
+                
+                # Cached until the next user registration
+                return tag_response(json_response(response_cache.fetch(USERS_FULL, load_users, version=etag)), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error fetching users: {str(db_error)}")
                 return jsonify({'message': 'Database error'}), 500
         else:
+            # MongoDB unreachable (breaker open) - fall back to the last cached body
+            stale_body = response_cache.stale(USERS_FULL)
+            if stale_body is not None:
+                return json_response(stale_body)
             app.logger.error("MongoDB not connected - cannot fetch users")
             return jsonify({'message': 'Database connection failed'}), 500
     
@@ -86,7 +113,14 @@ def get_qr_tracking_data(qr_id):
         if mongo_client:
             try:
                 db = mongo_client.get_database("tracksmart")
-                qr_collection = db.get_collection(qr_id)
+                
+                # Nothing written for this QR since the client's copy - skip the queries
+                etag = current_etag(db, qr_scope(qr_id))
+                unchanged = not_modified(etag)
+                if unchanged:
+                    return unchanged
+                
+                qr_collection = get_qr_collection(db, qr_id)
                 
                 # Get destination info (Coordinate A)
                 destination_info = qr_collection.find_one({'type': 'destination_info'})
@@ -136,7 +170,7 @@ def get_qr_tracking_data(qr_id):
                         }
                         response_data['status'] = 'in_progress'
                 
-                return jsonify(response_data)
+                return tag_response(jsonify(response_data), etag)
                 
             except Exception as db_error:
                 app.logger.error(f"Database error retrieving QR tracking: {str(db_error)}")
@@ -148,6 +182,74 @@ def get_qr_tracking_data(qr_id):
         app.logger.error(f"Error retrieving QR tracking data: {str(e)}")
         return jsonify({'message': 'Failed to retrieve tracking data'}), 500
 
+@app.route('/api/qr-tracking/<qr_id>/stream')
+def stream_qr_tracking(qr_id):
+    """Push coordinate B updates and the delivered transition as Server-Sent Events"""
+    if not is_valid_qr_id(qr_id):
+        return jsonify({'message': 'Invalid QR ID format'}), 400
+    
+    if event_source() != 'change_stream':
+        # Writes happen in delivery_app - only the change stream carries them here
+        return jsonify({'message': 'Live updates need TRACKING_EVENT_SOURCE=change_stream'}), 503
+    
+    tracking_hub.start()
+    
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    if last_event_id is not None and tracking_bus.can_resume(qr_id, last_event_id):
+        cursor = last_event_id
+    else:
+        # The page loaded the current state from /api/qr-tracking/<qr_id>; stream what happens next
+        cursor = tracking_bus.latest_id(qr_id)
+    
+    return Response(
+        stream_with_context(event_stream(qr_id, cursor)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/qr-tracking/<qr_id>/trail')
+def get_qr_trail(qr_id):
+    """Get the recorded path of a QR delivery (?start=&end= ISO 8601, ?interval= seconds to downsample)"""
+    try:
+        if not is_valid_qr_id(qr_id):
+            return jsonify({'message': 'Invalid QR ID format'}), 400
+        
+        try:
+            start = parse_time(request.args.get('start'))
+            end = parse_time(request.args.get('end'))
+            interval = request.args.get('interval', type=int)
+            limit = request.args.get('limit', MAX_TRAIL_POINTS, type=int)
+        except ValueError:
+            return jsonify({'message': 'Invalid start or end time'}), 400
+        
+        if interval is not None and interval < 1:
+            return jsonify({'message': 'interval must be a positive number of seconds'}), 400
+        
+        # Try to initialize MongoDB if not connected
+        if not mongo_connected:
+            initialize_mongodb()
+        
+        if not mongo_client:
+            return jsonify({'message': 'Database connection failed'}), 500
+        
+        points = get_trail(
+            mongo_client.get_database("tracksmart"), qr_id,
+            start=start, end=end, interval_seconds=interval,
+            user_email=request.args.get('user_email'), limit=max(limit, 1)
+        )
+        
+        return jsonify({
+            'qr_id': qr_id,
+            'points': points,
+            'count': len(points),
+            'interval': interval,
+            'trail_enabled': trail_enabled()
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Error retrieving trail for QR {qr_id}: {str(e)}")
+        return jsonify({'message': 'Failed to retrieve location trail'}), 500
+
 @app.route('/api/check-qr-access/<qr_id>/<user_id>')
 def check_qr_access(qr_id, user_id):
     """Check if a user has access to a specific QR code"""
@@ -234,16 +336,8 @@ def user_register():
                 if existing_user:
                     return jsonify({'message': 'Email already registered'}), 400
                 
-                # Generate unique user ID starting from 1000
-                highest_id_user = users_collection.find_one(
-                    {},
-                    sort=[('user_id', -1)]
-                )
-                
-                if highest_id_user and 'user_id' in highest_id_user:
-                    user_id = highest_id_user['user_id'] + 1
-                else:
-                    user_id = 1000
+                # Allocate the next user ID atomically from the counters collection
+                user_id = next_id(mongo_client.get_database("tracksmart"), 'user_id')
                 
                 # Create user document
                 user = {
@@ -260,6 +354,8 @@ def user_register():
                 
                 # Store in users collection
                 result = users_collection.insert_one(user)
+                bump_versions(mongo_client.get_database("tracksmart"), [USERS_SCOPE])
+                response_cache.invalidate(USERS, USERS_FULL)
                 
                 app.logger.info(f"User registered: {data['name']} ({email})")
                 
@@ -342,37 +438,75 @@ def user_login():
         return jsonify({'message': 'Login failed'}), 500
 
 def initialize_mongodb():
-    """Initialize MongoDB connection"""
+    """Attach to the process-wide pooled MongoDB client (see mongo_pool)"""
     global mongo_client, mongo_connected
     
     try:
-        # Direct pymongo import
-        from pymongo import MongoClient
+        # Fail fast (no server selection wait) while the circuit breaker is open
+        if not mongo_pool.allow_request():
+            mongo_client = None
+            mongo_connected = False
+            return False
         
-        # Get MongoDB URI from environment variable
-        mongodb_uri = os.environ.get('MONGODB_URI', 'mongodb+srv://in:in@in.hfxejxb.mongodb.net/?retryWrites=true&w=majority&appName=in')
+        # One client per worker process - no reconnect or ping on the request path
+        mongo_client = mongo_pool.get_client()
+        mongo_connected = mongo_pool.is_available()
         
-        # Create connection
-        mongo_client = MongoClient(mongodb_uri)
+        if mongo_connected:
+            try:
+                db = mongo_client.get_database("tracksmart")
+                ensure_indexes_once(db)
+            except Exception as index_error:
+                app.logger.error(f"Failed to ensure indexes: {index_error}")
         
-        # Test connection
-        mongo_client.admin.command('ping')
-        app.logger.info("MongoDB connected successfully")
-        mongo_connected = True
-        return True
+        return mongo_connected
         
     except ImportError as import_error:
         app.logger.error(f"MongoDB import failed: {import_error}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
     except Exception as e:
         app.logger.error(f"MongoDB connection failed: {e}")
         app.logger.info("Application will continue without MongoDB connection")
         mongo_connected = False
+        mongo_client = None
         return False
 
-# Initialize MongoDB on startup
+def reset_mongodb_after_fork():
+    """Forget the parent process's client after a fork (e.g. gunicorn --preload)"""
+    global mongo_client, mongo_connected
+    mongo_client = None
+    mongo_connected = False
+
+mongo_pool.register_fork_callback(reset_mongodb_after_fork)
+
+def on_breaker_state_change(old_state, new_state):
+    """Make the next request re-check the breaker instead of using the cached client"""
+    global mongo_client, mongo_connected
+    if new_state != 'closed':
+        mongo_client = None
+        mongo_connected = False
+
+mongo_pool.breaker.add_listener(on_breaker_state_change)
+
+@app.route('/api/health')
+def health_check():
+    """Report MongoDB connection health from driver heartbeats (no ping per request)"""
+    health = mongo_pool.health_state()
+    status_code = 200 if health['state'] != 'down' else 503
+    return jsonify({'status': 'ok' if status_code == 200 else 'degraded', 'mongodb': health}), status_code
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Expose in-process metrics (JSON, or Prometheus text with ?format=prometheus)"""
+    if request.args.get('format') == 'prometheus':
+        return metrics.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+    return jsonify(metrics.snapshot())
+
+# Initialize MongoDB on startup - one ping, then driver heartbeats track health
+mongo_pool.connect()
 initialize_mongodb()
 
 if __name__ == '__main__':